@@ -0,0 +1,306 @@
+import os
+import errno
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+
+import loclogger
+from compressed_file import FrameWriter
+from sync import isProcessAlive
+from path_factory import PathTransformer
+from loclogger import DEBUG, INFO
+
+
+def diskBytes(st):
+    return min(st.st_size, st.st_blocks * 512)
+
+
+class BlobStore(object):
+    '''Content addressed store of file bodies. Every distinct content is
+    kept once as blob named by its sha1, cached paths are hard links to
+    blobs. Blob has one link of its own, so it is garbage as soon as the
+    last cached path linking to it is removed, which unlink() takes care of.
+    Blobs are found by inode through symbolic links in the inodes directory,
+    so whichever process sharing the store removes the last link drops the
+    blob.
+
+    Source file is read (and hashed) only when its identity (device, inode,
+    size, mtime) was not seen before, identities of stored contents are
+    saved on close. Store has to be on the same device as the cache.
+    With compression (codec, frame size) set new blobs are compressed files,
+    still named by sha1 of the content with suffix of compressed file, so
+    plain and compressed blobs of the same content are not mixed up.'''
+
+    COPY_BUFFER_SIZE = 2**20
+    IDENTITIES = 'identities'
+    INODES = 'inodes' # inode number of blob -> link to the blob
+    IDENTITY = struct.Struct('<QQqd20s') # device, inode, size, mtime, sha1
+
+    def __init__(self, root, compression=None):
+        self.root = root
+        self._compression = compression
+        self._lock = threading.Lock()
+        self._identities = {} # (dev, ino, size, mtime) of source -> sha1
+        self._blobs = {} # (dev, ino) of blob -> path to blob
+        self._inodes = os.path.join(root, BlobStore.INODES)
+        self.hits = 0 # content found in the store
+        self.identityHits = 0 # ... without reading the source
+        if not os.path.isdir(self._inodes):
+            os.makedirs(self._inodes)
+        self._scan()
+        self._loadIdentities()
+
+    def link(self, src, dst):
+        '''Makes dst a copy of src, returns (bytes, inodes) newly taken'''
+        try:
+            return self._link(src, dst)
+        except _CopyNeeded, e:
+            # outside of the lock, copy of any size doesn't hold up the store
+            return self._copyBlob(e.fd, dst)
+
+    def unlink(self, path):
+        '''Removes cached copy at path, returns (bytes, inodes) freed'''
+        with self._lock:
+            st = os.lstat(path)
+            os.unlink(path)
+            if st.st_nlink == 1:
+                return diskBytes(st), 1 # not a blob (or blob copied over)
+            if st.st_nlink == 2:
+                # the other link is the blob, possibly stored by another process
+                blob = self._findBlob(st.st_ino)
+                if blob:
+                    return diskBytes(st), self._dropBlob(st, blob)
+            return 0, 0
+
+    def close(self):
+        '''Saves identities of contents still stored'''
+        with self._lock:
+            stored = set(os.path.basename(blob).split('.')[0] for blob in self._blobs.itervalues())
+            chunks = [BlobStore.IDENTITY.pack(*(identity + (digest.decode('hex'),)))
+                      for identity, digest in self._identities.iteritems() if digest in stored]
+        path = os.path.join(self.root, BlobStore.IDENTITIES)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp%d-' % os.getpid())
+        with os.fdopen(fd, 'wb') as f:
+            f.write(''.join(chunks))
+        os.rename(tmp, path)
+
+    def _link(self, src, dst):
+        st = os.stat(src)
+        identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        with self._lock:
+            digest = self._identities.get(identity)
+            if digest is not None:
+                taken = self._linkBlob(digest, dst, identityHit=True)
+                if taken is not None:
+                    return taken
+                del self._identities[identity]
+
+        tmp, digest = self._copy(src)
+        with self._lock:
+            self._identities[identity] = digest
+            try:
+                taken = self._linkBlob(digest, dst)
+            except _CopyNeeded, e:
+                os.unlink(tmp)
+                raise
+            if taken is not None:
+                os.unlink(tmp)
+                return taken
+            return self._storeBlob(tmp, digest, dst)
+
+    def _blobPath(self, digest):
+        blob = os.path.join(self.root, digest[:2], digest)
+        if self._compression:
+            blob = PathTransformer().transformCompressedPath(blob)
+        return blob
+
+    def _linkBlob(self, digest, dst, identityHit=False):
+        '''Returns (bytes, inodes) taken, None when content is not stored.
+        Raises _CopyNeeded when the blob can't be linked.'''
+        blob = self._blobPath(digest)
+        try:
+            os.link(blob, dst)
+            linked = True
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None # not stored
+            if e.errno not in (errno.EMLINK, errno.EXDEV):
+                raise
+            linked = False
+        self.hits += 1
+        if identityHit:
+            self.identityHits += 1
+        if not linked:
+            # too many links, plain copy is the best one can do
+            raise _CopyNeeded(os.open(blob, os.O_RDONLY))
+        return 0, 0
+
+    def _copyBlob(self, fd, dst):
+        '''Copies blob open as fd to dst through temporary file renamed into
+        place, blob dropped meanwhile stays readable through fd'''
+        with os.fdopen(fd, 'rb') as blob:
+            tmpFd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or os.curdir,
+                                          prefix=os.path.basename(dst) + '.tmp')
+            try:
+                with os.fdopen(tmpFd, 'wb') as f:
+                    shutil.copyfileobj(blob, f, BlobStore.COPY_BUFFER_SIZE)
+                os.rename(tmp, dst)
+            except:
+                os.unlink(tmp)
+                raise
+        return diskBytes(os.lstat(dst)), 1
+
+    def _storeBlob(self, tmp, digest, dst):
+        blob = self._blobPath(digest)
+        inodes = 1
+        try:
+            os.mkdir(os.path.dirname(blob))
+            inodes += 1
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.chmod(tmp, 0444)
+        # linked first, blob with one link is garbage to _scan() of another process
+        os.link(tmp, dst)
+        os.rename(tmp, blob)
+        st = os.lstat(blob)
+        self._blobs[(st.st_dev, st.st_ino)] = blob
+        return diskBytes(st), inodes + self._indexBlob(st.st_ino, blob)
+
+    def _indexPath(self, ino):
+        return os.path.join(self._inodes, str(ino))
+
+    def _findBlob(self, ino):
+        '''Returns path to blob of given inode, None when there is no such'''
+        try:
+            blob = os.path.join(self._inodes, os.readlink(self._indexPath(ino)))
+            if os.lstat(blob).st_ino == ino:
+                return os.path.normpath(blob)
+        except OSError, e:
+            pass
+        return None # not indexed or stale entry of inode reused since
+
+    def _indexBlob(self, ino, blob):
+        '''Returns number of inodes taken'''
+        target = os.path.relpath(blob, self._inodes)
+        try:
+            os.symlink(target, self._indexPath(ino))
+            return 1
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if self._findBlob(ino) != os.path.normpath(blob):
+            # blob of reused inode is gone
+            os.unlink(self._indexPath(ino))
+            os.symlink(target, self._indexPath(ino))
+        return 0
+
+    def _dropBlob(self, st, blob):
+        '''Returns number of inodes freed'''
+        try:
+            os.unlink(blob)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0 # dropped by another process meanwhile
+        self._blobs.pop((st.st_dev, st.st_ino), None)
+        if loclogger.debug:
+            DEBUG("Dropped blob %s" % blob)
+        try:
+            os.unlink(self._indexPath(st.st_ino))
+            return 2
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 1
+
+    def _copy(self, src):
+        '''Copies src to temporary file in the store, hashing it on the way'''
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp%d-' % os.getpid())
+        sha1 = hashlib.sha1()
+        try:
+            srcFd = os.open(src, os.O_RDONLY)
+            try:
+                writer = None
+                if self._compression:
+                    writer = FrameWriter(fd, *self._compression)
+                while True:
+                    buf = os.read(srcFd, BlobStore.COPY_BUFFER_SIZE)
+                    if not buf:
+                        break
+                    sha1.update(buf)
+                    if writer:
+                        writer.write(buf)
+                        continue
+                    while buf:
+                        buf = buf[os.write(fd, buf):]
+                if writer:
+                    writer.close()
+            finally:
+                os.close(srcFd)
+        except:
+            os.close(fd)
+            os.unlink(tmp)
+            raise
+        os.close(fd)
+        return tmp, sha1.hexdigest()
+
+    def _scan(self):
+        for name in os.listdir(self.root):
+            fullPath = os.path.join(self.root, name)
+            if name.startswith('.tmp'):
+                if not self._isWrittenByLiveProcess(name):
+                    os.unlink(fullPath) # left by crash
+            elif name == BlobStore.INODES:
+                continue
+            elif os.path.isdir(fullPath):
+                for digest in os.listdir(fullPath):
+                    blob = os.path.join(fullPath, digest)
+                    st = os.lstat(blob)
+                    if st.st_nlink == 1:
+                        os.unlink(blob) # garbage, e.g. cache was wiped
+                    else:
+                        self._blobs[(st.st_dev, st.st_ino)] = blob
+
+        # entries of dropped blobs go, blobs of older store get theirs
+        for name in os.listdir(self._inodes):
+            if not name.isdigit() or self._findBlob(int(name)) is None:
+                try:
+                    os.unlink(os.path.join(self._inodes, name))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        for (dev, ino), blob in self._blobs.items():
+            if self._findBlob(ino) != os.path.normpath(blob):
+                self._indexBlob(ino, blob)
+        INFO("Blob store: %d blobs" % len(self._blobs))
+
+    @staticmethod
+    def _isWrittenByLiveProcess(name):
+        '''Temporary file may belong to another process sharing the store'''
+        try:
+            pid = int(name[len('.tmp'):].split('-')[0])
+        except ValueError, e:
+            return False # older naming
+        return pid != os.getpid() and isProcessAlive(pid)
+
+    def _loadIdentities(self):
+        path = os.path.join(self.root, BlobStore.IDENTITIES)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        size = BlobStore.IDENTITY.size
+        for offset in xrange(0, len(data) - len(data) % size, size):
+            dev, ino, fileSize, mtime, digest = BlobStore.IDENTITY.unpack_from(data, offset)
+            self._identities[(dev, ino, fileSize, mtime)] = digest.encode('hex')
+
+
+class _CopyNeeded(Exception):
+    '''Blob can't take another link, its content is copied from fd instead'''
+
+    def __init__(self, fd):
+        Exception.__init__(self, fd)
+        self.fd = fd
@@ -0,0 +1,80 @@
+import os
+import struct
+
+
+class BlockMap(object):
+    '''Presence bitmap of fixed size blocks of a sparse file in disk cache.
+
+    Stored along with the cached file, removed as soon as all blocks are
+    present, so a cached file without a block map is always complete.'''
+
+    MAGIC = 'CFBM'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQ') # magic, version, block size, file size
+
+    def __init__(self, path, fileSize, blockSize):
+        self.path = path
+        self.fileSize = fileSize
+        self.blockSize = blockSize
+        self.numOfBlocks = (fileSize + blockSize - 1) // blockSize
+        self._bits = bytearray((self.numOfBlocks + 7) // 8)
+        self._missing = self.numOfBlocks
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, blockSize, fileSize = BlockMap.HEADER.unpack_from(data)
+        if magic != BlockMap.MAGIC or version != BlockMap.VERSION:
+            raise ValueError("%s is not a block map" % path)
+        blockMap = BlockMap(path, fileSize, blockSize)
+        blockMap._bits = bytearray(data[BlockMap.HEADER.size:])
+        blockMap._missing = blockMap.numOfBlocks - sum(
+            1 for idx in xrange(blockMap.numOfBlocks) if blockMap.isPresent(idx))
+        return blockMap
+
+    def save(self, tmp_path=None):
+        '''Written to tmp_path first, next to path by default'''
+        if tmp_path is None:
+            tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(BlockMap.HEADER.pack(BlockMap.MAGIC, BlockMap.VERSION,
+                                         self.blockSize, self.fileSize))
+            f.write(self._bits)
+        os.rename(tmp_path, self.path)
+
+    def isPresent(self, idx):
+        return bool(self._bits[idx >> 3] & (1 << (idx & 7)))
+
+    def isComplete(self):
+        return self._missing == 0
+
+    def markPresent(self, first, last):
+        '''Marks blocks in range [first, last)'''
+        for idx in xrange(first, last):
+            if not self.isPresent(idx):
+                self._bits[idx >> 3] |= 1 << (idx & 7)
+                self._missing -= 1
+
+    def missingRanges(self, offset, size):
+        '''Returns list of [first, last) block ranges which are not present
+        and overlap with byte range [offset, offset + size)'''
+        if size <= 0 or offset >= self.fileSize:
+            return []
+        first = offset // self.blockSize
+        last = min(self.numOfBlocks, (offset + size + self.blockSize - 1) // self.blockSize)
+        ranges = []
+        start = None
+        for idx in xrange(first, last):
+            if self.isPresent(idx):
+                if start is not None:
+                    ranges.append((start, idx))
+                    start = None
+            elif start is None:
+                start = idx
+        if start is not None:
+            ranges.append((start, last))
+        return ranges
+
+    def __repr__(self):
+        return "<BlockMap %s missing=%d/%d>" % (self.path, self._missing, self.numOfBlocks)
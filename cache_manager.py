@@ -4,6 +4,8 @@ import loclogger
 import stat
 import errno
 import shutil
+import struct
+import threading
 
 from memory_cache import MemoryCache
 import memory_cache # ugly
@@ -11,27 +13,153 @@ import memory_cache # ugly
 import os
 import path_factory
 import disk_cache
+from fs_stats import FsStats
+
+class Lookup(object):
+    '''Everything CacheFs needs to know about a path, gathered in one pass'''
+
+    def __init__(self, path, st, target=None, childrenCached=False):
+        self.path = path
+        self.stat = st
+        self.target = target
+        self.childrenCached = bool(childrenCached)
+
+    @property
+    def exists(self):
+        return self.stat is not None
+
+    @property
+    def isDirectory(self):
+        return self.stat is not None and stat.S_ISDIR(self.stat.st_mode)
+
+    @property
+    def isLink(self):
+        return self.stat is not None and stat.S_ISLNK(self.stat.st_mode)
+
+    def __repr__(self):
+        return "<Lookup %s stat=%s target=%s childrenCached=%s>" % (
+            self.path, self.stat, self.target, self.childrenCached)
 
 class CacheManager(object):
        
     def __init__(self, cfg):
         self._cfg = cfg
         self._prepare_directories()
-        self._memoryCache = MemoryCache(self._cfg.memory_cache_lifetime)
+        self._memoryCache = MemoryCache(self._cfg.memory_cache_lifetime,
+                                        self._cfg.memory_cache_max_entries,
+                                        self._cfg.negative_cache_lifetime,
+                                        self._cfg.negative_cache_max_entries)
         self._diskCache = disk_cache.DiskCache(self._cfg, self._memoryCache)
+        self._fsStats = FsStats(self._cfg, self._diskCache.usage)
+        self._sweeper = None
+        self._evictor = None
+        self._snapshotPath = path_factory.PathFactory(cfg).createPathToMemoryCacheSnapshot()
+
+    def start(self):
+        '''Starts loading of memory cache snapshot, expiration of memory
+        cache and, with capacity limit, disk cache eviction in background'''
+        self._stopSweeper = threading.Event()
+        self._sweeper = threading.Thread(target=self._sweep, name="memory-cache-sweeper")
+        self._sweeper.daemon = True
+        self._sweeper.start()
+        if self._cfg.cache_max_bytes:
+            self._evictor = threading.Thread(target=self._evict, name="disk-cache-evictor")
+            self._evictor.daemon = True
+            self._evictor.start()
+
+    def stop(self):
+        if self._sweeper:
+            self._stopSweeper.set()
+            self._sweeper.join()
+            self._sweeper = None
+        if self._evictor:
+            self._evictor.join()
+            self._evictor = None
+
+    def close(self):
+        '''Releases disk cache resources, called once on unmount'''
+        self._diskCache.close()
+
+    def expire(self):
+        '''Removes expired memory cache entries and deletes what invalidate()
+        left behind, returns number of expired entries'''
+        expired = self._memoryCache.expire()
+        self._diskCache.reclaim()
+        self._diskCache.flushIndex()
+        return expired
+
+    def loadSnapshot(self):
+        '''Warms memory cache up with snapshot saved on last unmount,
+        snapshot is used only once. Requests are served (cold) meanwhile.'''
+        if not os.path.exists(self._snapshotPath):
+            return
+        try:
+            self._memoryCache.load(self._snapshotPath)
+        except (IOError, OSError, ValueError, struct.error), e:
+            ERROR("Cannot load memory cache snapshot: %s" % e)
+        os.remove(self._snapshotPath)
+
+    def saveSnapshot(self):
+        try:
+            self._memoryCache.save(self._snapshotPath)
+        except (IOError, OSError), e:
+            ERROR("Cannot save memory cache snapshot: %s" % e)
 
     @trace
-    def getAttributes(self, path, pathToCache=False):
-        memstat = self._memoryCache.getAttributes(path)
+    def invalidate(self, path):
+        '''Drops everything cached at path and below it, e.g. when source
+        subtree got republished. Takes constant time, stale data is reclaimed
+        in background. Mounted file system invalidates on setxattr, see
+        CacheFs.setxattr().'''
+        self._diskCache.invalidate(path)
+        self._memoryCache.invalidate(path)
+
+    def _sweep(self):
+        self.loadSnapshot()
+        while not self._stopSweeper.wait(self._memoryCache.sweep_interval):
+            try:
+                self.expire()
+            except Exception, e:
+                ERROR("Expiration failed: %s" % e)
 
-        if not memstat:
+    def _evict(self):
+        while not self._stopSweeper.is_set():
+            try:
+                if self._diskCache.waitForEviction(self._memoryCache.sweep_interval):
+                    self._diskCache.evict()
+            except Exception, e:
+                ERROR("Eviction failed: %s" % e)
+
+    @trace
+    def lookup(self, path):
+        '''Returns Lookup with type, stat, link target and children state
+        of path, walking the memory cache once per call'''
+        node = self._memoryCache.getAttributes(path)
+
+        # node without stat is only a placeholder created for its descendants
+        if node is None or (path != os.sep and node.stat is None):
+            if self._memoryCache.isMissing(path):
+                return Lookup(path, None)
             if loclogger.debug:
                 DEBUG("Checking cache directory for %s" % path)
             st = self._getAttributesFromDiskCache(path)
+            if st is None:
+                self._memoryCache.cacheMissing(path)
+                return Lookup(path, None)
             self._memoryCache.cacheAttributes(path, st)
-            memstat = self._memoryCache.getAttributes(path)
+            node = self._memoryCache.getAttributes(path)
+            if node is None:
+                # evicted straight away, memory cache budget is too small
+                return Lookup(path, st)
 
-        return memstat.stat
+        result = Lookup(path, node.stat, node.target, node.has_all_children)
+        if result.isLink and result.target is None:
+            result.target = self.readLink(path)
+        return result
+
+    @trace
+    def getAttributes(self, path, pathToCache=False):
+        return self.lookup(path).stat
 
     @trace
     def listDirectory(self, path):
@@ -43,36 +171,83 @@ class CacheManager(object):
             return self._diskCache.listDirectory(path)
 
     @trace
-    def getPathToCachedFile(self, path):
-        return self._diskCache.getPathToCachedFile(path)
+    def listDirectoryEntries(self, path, lookup=None):
+        '''Returns sorted (name, file type, inode) of directory entries.
+        Attributes known while listing end up in the memory cache, so lookups
+        following the listing are served from memory. Result of lookup(path)
+        saves checking the memory cache when children aren't there.'''
+        if lookup is None or lookup.childrenCached:
+            try:
+                return self._memoryCache.listDirectoryEntries(path)
+            except memory_cache.MemoryCacheNotValid, e:
+                if loclogger.debug:
+                    DEBUG("Memory cache is not valid")
+
+        entries = []
+        for name, fileType, st in self._diskCache.listDirectoryEntries(path):
+            entryPath = os.path.join(path, name)
+            if st is not None:
+                self._memoryCache.cacheAttributes(entryPath, st)
+            else:
+                # not fetched yet, attributes are known only from memory
+                memstat = self._memoryCache.getAttributes(entryPath)
+                st = memstat and memstat.stat
+            entries.append((name, fileType, st.st_ino if st else 0))
+
+        return sorted(entries)
+
+    @trace
+    def getPathToCachedFile(self, path, pin=False):
+        '''With pin set the file is not evicted until unpin(path)'''
+        return self._diskCache.getPathToCachedFile(path, pin)
+
+    def unpin(self, path):
+        self._diskCache.unpin(path)
+
+    def setEvictionCallback(self, callback):
+        '''callback gets path to cache of every file removed from the disk
+        cache (evicted or dropped as stale)'''
+        self._diskCache.onEvict = callback
+
+    @trace
+    def getFsStats(self):
+        return self._fsStats.get()
+
+    @trace
+    def fetchRange(self, path, offset, size, generation=None):
+        return self._diskCache.fetchRange(path, offset, size, generation)
+
+    def getFileGeneration(self, path):
+        '''Changes whenever content of cached file gets refetched'''
+        return self._diskCache.getFileGeneration(path)
 
     @trace
     def readLink(self, filepath):
         target_entry = self._memoryCache.readLink(filepath)
-        if not target_entry or not target_entry.target:
-            readLink = self._diskCache.readLink(filepath)
-            self._memoryCache.cacheLinkTarget(filepath, readLink)
-            target_entry = self._memoryCache.readLink(filepath)
-        return target_entry.target
+        if target_entry and target_entry.target:
+            return target_entry.target
+        target = self._diskCache.readLink(filepath)
+        self._memoryCache.cacheLinkTarget(filepath, target)
+        return target
+
+    def getStatistics(self):
+        statistics = dict(memory_cache_entries=len(self._memoryCache),
+                          memory_cache_evictions=self._memoryCache.evictions,
+                          memory_cache_evicted_entries=self._memoryCache.evicted_entries,
+                          memory_cache_expired_entries=self._memoryCache.expired_entries,
+                          negative_cache_hits=self._memoryCache.negative_hits)
+        for key, value in self._diskCache.getStatistics().iteritems():
+            statistics['disk_cache_' + key] = value
+        return statistics
 
 
     @trace
     def isDirectory(self, path):
-        memstat = self._memoryCache.getAttributes(path)
-        if memstat:
-            if memstat.stat:
-                return stat.S_ISDIR(memstat.stat.st_mode)
-            if not memstat.stat:
-                return False
-
-        return self._diskCache.isDirectory(path)
+        return self.lookup(path).isDirectory
 
     @trace
     def exists(self, path):
-        fileExists = self._memoryCache.exists(path)
-        if not fileExists is None:
-            return fileExists
-        return self._diskCache.exists(path)
+        return self.lookup(path).exists
 
     def _getAttributesFromDiskCache(self, path):
 
@@ -18,7 +18,11 @@ import loclogger
 from loclogger import DEBUG, INFO, ERROR, trace
 from memory_cache import MemoryCache
 import memory_cache # ugly
+import disk_cache
 from file import File
+from readahead import ReadaheadEngine
+from open_file_table import OpenFileTable
+from compressed_file import FrameCache
 
 from cache_manager import CacheManager
 
@@ -32,18 +36,31 @@ fuse.fuse_python_api = (0, 2)
 
 class CacheFs(fuse.Fuse):
 
+    # setting it on path drops everything cached at and below path
+    INVALIDATE_XATTR = 'user.cachefs.invalidate'
+
     def __init__(self, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
         self.cfg = None
         self.cacheManager = None
-        self.filebuffer = None
+        self.readahead = None
+        self.openFiles = None
+        self.frameCache = None
 
     def run(self):
         self.cacheManager = CacheManager(self.cfg.cache_manager)
+        self.frameCache = FrameCache(self.cfg.cache_fs.frame_cache_size)
+        self.openFiles = OpenFileTable(self.cfg.cache_fs.max_open_files, self.frameCache)
+        # idle descriptors would keep space of removed files taken
+        self.cacheManager.setEvictionCallback(self.openFiles.discard)
+        self.multithreaded = self.cfg.cache_fs.multithreaded
         self.main()
 
     def stop(self):
-        pass
+        if self.readahead:
+            self.readahead.stop()
+        if self.cacheManager:
+            self.cacheManager.stop()
 
     def parse(self, *args, **kw):
         '''This method shall be moved somewhere in config module'''
@@ -63,23 +80,47 @@ class CacheFs(fuse.Fuse):
 
         self.cfg.parse(options, arguments, self.fuse_args.mountpoint)
 
+        # inodes of source files reported by getattr() and readdir() are
+        # ignored (replaced by ones generated by fuse) otherwise
+        self.fuse_args.add('use_ino')
+
+        if self.cfg.cache_fs.kernel_cache:
+            # kernel may keep entries and attributes as long as memory cache would
+            timeout = str(self.cfg.cache_manager.memory_cache_lifetime)
+            for option in ['entry_timeout', 'attr_timeout']:
+                self.fuse_args.add(option, timeout)
+            self.fuse_args.add('negative_timeout',
+                               str(self.cfg.cache_manager.negative_cache_lifetime))
+
     @trace
     def fsinit(self):
         INFO("Initializing file system")
+        # threads have to be started here, i.e. after fuse daemonized
+        self.cacheManager.start()
+        if (self.cfg.cache_manager.fetch_policy == 'chunked'
+            and self.cfg.cache_fs.readahead_window):
+            self.readahead = ReadaheadEngine(self.cacheManager,
+                                             self.cfg.cache_fs.readahead_window,
+                                             self.cfg.cache_fs.readahead_max_window)
+            self.readahead.start()
 
     @trace
     def fsdestroy(self):
         self.stop()
+        self.cacheManager.saveSnapshot()
+        INFO("Statistics: %s" % self.cacheManager.getStatistics())
+        if self.frameCache.hits or self.frameCache.misses:
+            INFO("Frame cache: %d hits, %d misses" % (self.frameCache.hits, self.frameCache.misses))
+        self.cacheManager.close()
         INFO("Unmounting file system")
 
     @trace
     def statfs(self):
-        stats = fuse.StatVfs()
-        return stats
+        return fuse.StatVfs(**self.cacheManager.getFsStats())
 
     @trace
     def getattr(self, path):
-        st = self.cacheManager.getAttributes(path)
+        st = self.cacheManager.lookup(path).stat
         if not st:
             return -errno.ENOENT
         return st
@@ -87,7 +128,7 @@ class CacheFs(fuse.Fuse):
     @trace
     def access(self, path, flags):
         if flags == os.F_OK:
-            if self.cacheManager.exists(path):
+            if self.cacheManager.lookup(path).exists:
                 return 0
             else:
                 return -errno.EACCES
@@ -97,48 +138,72 @@ class CacheFs(fuse.Fuse):
 
     @trace
     def readlink(self, path):
-        pathToCachedFile = self.cacheManager.readLink(path)
-        if pathToCachedFile:
-            return pathToCachedFile
-        return -errno.ENOENT
+        lookup = self.cacheManager.lookup(path)
+        if not lookup.exists:
+            return -errno.ENOENT
+        if not lookup.isLink:
+            return -errno.EINVAL
+        return lookup.target
 
     @trace
     def opendir(self, path):
-        if not (self.cacheManager.exists(path) and self.cacheManager.isDirectory(path)):
+        if not self.cacheManager.lookup(path).isDirectory:
             return -errno.ENOENT
         return None # success
 
     @trace
     def readdir(self, path, offset = None, dh = None):
         # TODO: Update timestamps: readdir updates atime
-        if not self.cacheManager.exists(path):
-            yield
-        elif not self.cacheManager.isDirectory(path):
+        lookup = self.cacheManager.lookup(path)
+        if not lookup.isDirectory:
             yield
+            return
 
         yield fuse.Direntry(".")
         yield fuse.Direntry("..")
-        for entry in self.cacheManager.listDirectory(path):
-            yield fuse.Direntry(entry)
+        # type and inode let kernel and tools like find skip getattr per entry
+        for name, fileType, ino in self.cacheManager.listDirectoryEntries(path, lookup):
+            yield fuse.Direntry(name, type=fileType >> 12, ino=ino)
 
     @trace
     def read(self, path, size, offset, fh):
-        if fh.lseek != offset:
-            os.lseek(fh.fh, offset, 0)
-        self.filebuffer = os.read(fh.fh, size)
+        if fh.partial:
+            if self.readahead:
+                self.readahead.onRead(path, fh, offset, size)
+            # buffered read may go past requested size
+            fh.partial = self.cacheManager.fetchRange(path, offset, max(size, fh.buffer_size),
+                                                      fh.entry.generation)
         fh.lseek = offset + size
-        return self.filebuffer
+        return fh.read(size, offset)
 
     @trace
     def open(self, path, flags):
-        st = self.cacheManager.getAttributes(path)
+        st = self.cacheManager.lookup(path).stat
         if st:
-            cache_path = self.cacheManager.getPathToCachedFile(path)
-            return File(os.open(cache_path, flags), os.path.basename(path), st)
+            # file stays in the disk cache while opened, see release()
+            cache_path = self.cacheManager.getPathToCachedFile(path, pin=True)
+            try:
+                entry = self.openFiles.acquire(cache_path, st,
+                                               self.cacheManager.getFileGeneration(path))
+            except:
+                self.cacheManager.unpin(path)
+                raise
+            fh = File(entry.fd, os.path.basename(path), st, entry.stat)
+            fh.entry = entry
+            fh.frames = entry.frames
+            fh.partial = self.cfg.cache_manager.fetch_policy == 'chunked'
+            fh.buffer_size = self.cfg.cache_fs.read_buffer_size
+            if self.cfg.cache_fs.kernel_cache:
+                # pages cached by kernel are dropped on open with keep_cache
+                # unset, which has to happen whenever disk cache refetched the
+                # file, i.e. descriptor of the cached file is a new one
+                fh.keep_cache = entry.opens > 1
+            return fh
 
     @trace
     def release(self, path, flags, fh):
-        os.close(fh.fh)
+        self.openFiles.release(fh.entry)
+        self.cacheManager.unpin(path)
 
     @trace
     def fgetattr(self, path, fh):
@@ -188,6 +253,18 @@ class CacheFs(fuse.Fuse):
     def chown(self, path, uid, gid):
         return -errno.EOPNOTSUPP
 
+    @trace
+    def setxattr(self, path, name, value, flags):
+        '''The only control path of mounted file system: setting
+        INVALIDATE_XATTR (any value) invalidates path, e.g. after its source
+        got republished. Path has to be visible, new entries of a directory
+        show up when the directory is invalidated. With kernel_cache set the
+        kernel serves what it keeps until its timeouts expire.'''
+        if name != CacheFs.INVALIDATE_XATTR:
+            return -errno.EOPNOTSUPP
+        self.cacheManager.invalidate(path)
+        return 0
+
     @trace
     def truncate(self, path, size):
         return 0
@@ -211,36 +288,67 @@ class CacheFs(fuse.Fuse):
 def main():
     usage = """
     CacheFs: Read-only cache virtual filesystem.
-    """ + fuse.Fuse.fusage
+
+    Cached content of PATH and everything below it is dropped (fetched again
+    on next access) by: setfattr -n %s PATH
+    """ % CacheFs.INVALIDATE_XATTR + fuse.Fuse.fusage
     server = CacheFs(version="%prog " + fuse.__version__,
                      usage=usage,
                      dash_s_do='setsingle')
 
-    server.parser.add_option('-x', '--source-dir', 
-                             dest="source_dir", 
-                             help="Source directory which will be cached",
-                             metavar="MANDATORY_SOURCE_DIR_PATH",
-                             type="str")
-
-    server.parser.add_option('-c', '--cache-dir',
-                             dest='cache_dir',
-                             help="Path to directory with cache (will be created if not exists)",
-                             metavar="MANDATORY_EXISTING_CACHE_DIR_PATH",
-                             type="str")
-
-    server.parser.add_option('--disk-cache-lifetime',
-                             dest="disk_cache_lifetime", 
-                             help="Long time stamp lifetime in seconds. (default: 600)", 
-                             metavar="TIME_IN_SECONDS", 
+    config_canonical.addCacheManagerOptions(server.parser)
+
+    server.parser.add_option('--readahead-window',
+                             dest="readahead_window",
+                             help="Initial readahead window in bytes for sequential reads "
+                                  "with chunked fetch policy, 0 disables readahead. (default: 1048576)",
+                             metavar="BYTES",
                              type="int",
-                             default=600)
+                             default=2**20)
 
-    server.parser.add_option('--memory-cache-lifetime',
-                             dest="memory_cache_lifetime", 
-                             help="Short time stamp lifetime in seconds. (default: 60)", 
-                             metavar="TIME_IN_SECONDS",
+    server.parser.add_option('--readahead-max-window',
+                             dest="readahead_max_window",
+                             help="Maximal readahead window in bytes. (default: 67108864)",
+                             metavar="BYTES",
                              type="int",
-                             default=60)
+                             default=2**26)
+
+    server.parser.add_option('--frame-cache-size',
+                             dest="frame_cache_size",
+                             help="Max bytes of decompressed frames kept in memory. "
+                                  "(default: 67108864)",
+                             metavar="BYTES",
+                             type="int",
+                             default=2**26)
+
+    server.parser.add_option('--kernel-cache',
+                             dest="kernel_cache",
+                             help="Let kernel keep file pages between opens and cache "
+                                  "entries and attributes for memory cache lifetime",
+                             action="store_true",
+                             default=False)
+
+    server.parser.add_option('--read-buffer-size',
+                             dest="read_buffer_size",
+                             help="Reads smaller than this are served from per-handle buffer "
+                                  "of this size, 0 disables buffering. (default: 0)",
+                             metavar="BYTES",
+                             type="int",
+                             default=0)
+
+    server.parser.add_option('--max-open-files',
+                             dest="max_open_files",
+                             help="Max number of descriptors of cached files kept open, "
+                                  "0 means half of RLIMIT_NOFILE. (default: 0)",
+                             metavar="NUMBER",
+                             type="int",
+                             default=0)
+
+    server.parser.add_option('--multithreaded',
+                             dest="multithreaded",
+                             help="Serve FUSE requests from multiple threads",
+                             action="store_true",
+                             default=False)
 
     server.parser.add_option('--debug',
                              dest="debug",
@@ -273,6 +381,7 @@ if __name__ == '__main__':
         import mocks.time_mock # file available in tests directory
         time = mocks.time_mock.ModuleInterface()
         memory_cache.time = time
+        disk_cache.time = time
         time_stubbed = True
 
     except Exception, e:
@@ -280,6 +389,7 @@ if __name__ == '__main__':
         import time as time_module
         time = time_module
         memory_cache.time = time_module
+        disk_cache.time = time_module
         time_stubbed = False
 
     try:
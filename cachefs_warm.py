@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+'''cachefs-warm: fills disk cache of CacheFs ahead of use.
+
+Lists directories and fetches files of given subtrees (paths relative to the
+source dir, '/' by default, '-' reads paths from stdin) straight into the
+cache from pool of threads, instead of reading them through the mount. It
+runs fine next to cachefs mounted on the same cache: every fill is locked
+against the other process, files it has already fetched are skipped. Pass
+the same cache options (fetch policy, dedup, compression, ...) the mount uses.
+
+Nothing is evicted, warm-up stops fetching as soon as --max-size bytes were
+fetched or the cache would go over high watermark of --cache-max-bytes.
+
+Usage: cachefs_warm.py -x SOURCE_DIR -c CACHE_DIR [--threads=8] [--max-depth=N]
+           [--max-size=BYTES] [cache options] [PATH ...]
+'''
+
+import os
+import sys
+import stat
+import time
+import copy
+import Queue
+import threading
+import optparse
+
+import loclogger
+from loclogger import DEBUG, INFO, ERROR
+import config as config_canonical
+import disk_cache
+import path_factory
+
+
+class NoMemoryCache(object):
+    '''Warm-up looks nothing up twice, attributes are not kept'''
+
+    def cacheAttributes(self, path, st):
+        pass
+
+    def markAsChildrenCached(self, path, cached):
+        pass
+
+    def invalidate(self, path):
+        pass
+
+
+class Warmer(object):
+    '''Fills disk cache with subtrees. Directory tasks list directory (into
+    its manifest) and queue its entries, file tasks fetch files; both are
+    run by pool of workers.'''
+
+    def __init__(self, diskCache, cfg, workers=8, maxDepth=-1, maxBytes=0, cacheLimit=0):
+        self._diskCache = diskCache
+        self._cfg = cfg
+        self._pathFactory = path_factory.PathFactory(cfg)
+        self._numOfWorkers = workers
+        self._maxDepth = maxDepth # -1 means unlimited
+        self._maxBytes = maxBytes # 0 means unlimited
+        self._cacheLimit = cacheLimit
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock() # guards budget and counters
+        self._reserved = 0
+        self._full = False
+        self.directories = 0
+        self.files = 0
+        self.bytes = 0
+        self.cached = 0 # found in the cache already
+        self.skipped = 0 # over the limits
+        self.errors = 0
+
+    def warm(self, paths):
+        for path in paths:
+            self._queue.put((self._warmPath, path))
+        workers = []
+        for idx in range(self._numOfWorkers):
+            worker = threading.Thread(target=self._loop, name="warm-%d" % idx)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self._queue.join()
+        for worker in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _loop(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                task[0](*task[1:])
+            except Exception, e:
+                ERROR("Warming %s failed: %s" % (task[1], e))
+                with self._lock:
+                    self.errors += 1
+            finally:
+                self._queue.task_done()
+
+    def _warmPath(self, path):
+        if path == os.sep:
+            return self._warmDirectory(path, 0)
+        entries = dict((name, (fileType, st)) for name, fileType, st
+                       in self._diskCache.listDirectoryEntries(os.path.dirname(path)))
+        entry = entries.get(os.path.basename(path))
+        if entry is None:
+            ERROR("No such path in source: %s" % path)
+            with self._lock:
+                self.errors += 1
+        elif entry[0] == stat.S_IFDIR:
+            self._warmDirectory(path, 0)
+        else:
+            self._warmFile(path, entry[0], entry[1].st_size)
+
+    def _warmDirectory(self, path, depth):
+        if self._full:
+            return
+        entries = self._diskCache.listDirectoryEntries(path)
+        with self._lock:
+            self.directories += 1
+        for name, fileType, st in entries:
+            entryPath = os.path.join(path, name)
+            if fileType == stat.S_IFDIR:
+                if self._maxDepth < 0 or depth < self._maxDepth:
+                    self._queue.put((self._warmDirectory, entryPath, depth + 1))
+            elif fileType in (stat.S_IFREG, stat.S_IFLNK):
+                self._queue.put((self._warmFile, entryPath, fileType, st.st_size))
+
+    def _warmFile(self, path, fileType, size):
+        if not self._reserve(path, size if fileType == stat.S_IFREG else 0):
+            return
+        self._diskCache.getPathToCachedFile(path)
+        if self._cfg.fetch_policy == 'chunked' and fileType == stat.S_IFREG:
+            self._diskCache.fetchRange(path, 0, size)
+        with self._lock:
+            self.files += 1
+            if fileType == stat.S_IFREG:
+                self.bytes += size
+        if loclogger.debug:
+            DEBUG("Warmed %s (%d bytes)" % (path, size))
+
+    def _reserve(self, path, size):
+        '''Returns False when file is cached already or doesn't fit in limits'''
+        if ((os.path.lexists(self._pathFactory.createPathToDiskCache(path))
+             or os.path.lexists(self._pathFactory.createPathToDiskCacheCompressed(path)))
+            and not os.path.lexists(self._pathFactory.createPathToDiskCacheBlockMap(path))):
+            with self._lock:
+                self.cached += 1
+            return False
+        with self._lock:
+            if not self._full:
+                overSize = self._maxBytes and self._reserved + size > self._maxBytes
+                overLimit = (self._cacheLimit
+                             and self._diskCache.usage.bytes + size > self._cacheLimit)
+                if overSize or overLimit:
+                    self._full = True
+                    INFO("Warm-up limit reached at %s, fetching stops" % path)
+            if self._full:
+                self.skipped += 1
+                return False
+            self._reserved += size
+            return True
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    config_canonical.addCacheManagerOptions(parser)
+    parser.add_option('--threads',
+                      dest="threads",
+                      help="Number of files fetched at once. (default: 8)",
+                      metavar="NUMBER",
+                      type="int",
+                      default=8)
+    parser.add_option('--max-depth',
+                      dest="max_depth",
+                      help="Descend at most this many directory levels below every path, "
+                           "-1 means unlimited. (default: -1)",
+                      metavar="NUMBER",
+                      type="int",
+                      default=-1)
+    parser.add_option('--max-size',
+                      dest="max_size",
+                      help="Stop after fetching this many bytes, 0 means no limit. (default: 0)",
+                      metavar="BYTES",
+                      type="long",
+                      default=0)
+    parser.add_option('--debug',
+                      dest="debug",
+                      help="Enable more verbose logging",
+                      action="store_true",
+                      default=False)
+    parser.add_option('-l', '--log',
+                      dest="log_path",
+                      help="Path to log file",
+                      metavar='LOG_FILE',
+                      type="str",
+                      default="logs/WARM")
+    options, arguments = parser.parse_args(argv)
+
+    loclogger.initialize(options.log_path)
+    if options.debug:
+        loclogger.enableDebug()
+
+    cfg = config_canonical.getConfig()
+    cfg.parseCacheManager(options)
+    try:
+        config_canonical.ConfigValidator().validateCacheManager(cfg.cache_manager)
+        if options.threads <= 0:
+            raise config_canonical.ConfigValidator.ConfigError("Number of threads has to be positive")
+    except config_canonical.ConfigValidator.ConfigError, e:
+        print "\nError: {error} \n".format(error = str(e.msg))
+        parser.print_help()
+        return 2
+
+    paths = arguments or [os.sep]
+    if paths == ['-']:
+        paths = [line.strip() for line in sys.stdin if line.strip()]
+    paths = [os.sep + os.path.normpath(path).strip(os.sep) if path.strip(os.sep) else os.sep
+             for path in paths]
+
+    if not os.path.exists(cfg.cache_manager.cache_root_dir):
+        os.makedirs(cfg.cache_manager.cache_root_dir)
+    cacheLimit = (cfg.cache_manager.cache_max_bytes
+                  * cfg.cache_manager.cache_high_watermark // 100)
+    # evicting is left to the mount, which knows what is open
+    warmCfg = copy.copy(cfg.cache_manager)
+    warmCfg.cache_max_bytes = 0
+    diskCache = disk_cache.DiskCache(warmCfg, NoMemoryCache())
+
+    warmer = Warmer(diskCache, warmCfg, options.threads, options.max_depth,
+                    options.max_size, cacheLimit)
+    start = time.time()
+    try:
+        warmer.warm(paths)
+    finally:
+        diskCache.flushIndex()
+        diskCache.close()
+    seconds = time.time() - start
+
+    summary = ("%d directories, %d files (%d bytes) fetched in %.1fs (%.1f MB/s), "
+               "%d cached already, %d skipped, %d errors"
+               % (warmer.directories, warmer.files, warmer.bytes, seconds,
+                  warmer.bytes / 2.0**20 / max(seconds, 1e-6),
+                  warmer.cached, warmer.skipped, warmer.errors))
+    INFO("Warm-up: " + summary)
+    print summary
+    return 1 if warmer.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import os
+import zlib
+import bz2
+import struct
+import threading
+import itertools
+import collections
+
+import file_io
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None # not in python 2 stdlib
+
+# Compressed cached file: header, frames, index and trailer. Every frame
+# holds frameSize bytes of content (the last one may be shorter) compressed
+# on its own, so a read decompresses just the frames it covers. Frame that
+# doesn't shrink is stored as it is.
+#
+#   header:  magic, version, codec, frame size
+#   index:   length of every frame, RAW_FRAME bit set for stored ones
+#   trailer: content size, number of frames, offset of index, magic
+
+MAGIC = 'CFZF'
+VERSION = 1
+HEADER = struct.Struct('<4sBBxxI')
+FRAME_LENGTH = struct.Struct('<I')
+TRAILER = struct.Struct('<QIQ4s')
+RAW_FRAME = 1 << 31
+
+CODECS = collections.OrderedDict([
+    ('zlib', (1, lambda data: zlib.compress(data, 6), zlib.decompress)),
+    ('bz2', (2, lambda data: bz2.compress(data, 9), bz2.decompress)),
+])
+if lzma is not None:
+    CODECS['lzma'] = (3, lzma.compress, lzma.decompress)
+
+_DECOMPRESSORS = dict((codecId, decompress) for codecId, compress, decompress in CODECS.values())
+
+
+class FrameWriter(object):
+    '''Writes content passed to write() compressed into descriptor'''
+
+    def __init__(self, fd, codec, frameSize):
+        self._fd = fd
+        self._codecId, self._compress = CODECS[codec][:2]
+        self._frameSize = frameSize
+        self._pending = []
+        self._pendingSize = 0
+        self._lengths = []
+        self._offset = 0
+        self.size = 0 # of content written so far
+        self._write(HEADER.pack(MAGIC, VERSION, self._codecId, frameSize))
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pendingSize += len(data)
+        self.size += len(data)
+        if self._pendingSize >= self._frameSize:
+            data = ''.join(self._pending)
+            end = len(data) - len(data) % self._frameSize
+            for start in xrange(0, end, self._frameSize):
+                self._writeFrame(data[start:start + self._frameSize])
+            self._pending = [data[end:]]
+            self._pendingSize = len(data) - end
+
+    def close(self):
+        '''Writes the rest of content with index, returns size of the file'''
+        if self._pendingSize:
+            self._writeFrame(''.join(self._pending))
+        indexOffset = self._offset
+        self._write(''.join(FRAME_LENGTH.pack(length) for length in self._lengths))
+        self._write(TRAILER.pack(self.size, len(self._lengths), indexOffset, MAGIC))
+        return self._offset
+
+    def _writeFrame(self, frame):
+        compressed = self._compress(frame)
+        if len(compressed) < len(frame):
+            self._lengths.append(len(compressed))
+        else:
+            compressed = frame
+            self._lengths.append(len(frame) | RAW_FRAME)
+        self._write(compressed)
+
+    def _write(self, data):
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+            self._offset += written
+
+
+def compressFile(src, dst, codec, frameSize, bufferSize=2**20):
+    '''Writes src compressed to dst, returns size of dst'''
+    srcFd = os.open(src, os.O_RDONLY)
+    try:
+        dstFd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            writer = FrameWriter(dstFd, codec, frameSize)
+            while True:
+                buf = os.read(srcFd, bufferSize)
+                if not buf:
+                    break
+                writer.write(buf)
+            return writer.close()
+        finally:
+            os.close(dstFd)
+    finally:
+        os.close(srcFd)
+
+
+class FrameCache(object):
+    '''Recently decompressed frames of all files, least recently used are
+    dropped when frames take more than maxBytes'''
+
+    def __init__(self, maxBytes):
+        self._maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._frames = collections.OrderedDict() # (reader key, frame) -> content
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.pop(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames[key] = frame
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame):
+        if len(frame) > self._maxBytes:
+            return
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._frames[key] = frame
+            self._bytes += len(frame)
+            while self._bytes > self._maxBytes:
+                self._bytes -= len(self._frames.popitem(last=False)[1])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._frames)
+
+
+class FrameReader(object):
+    '''Random access to content of compressed file opened as fd'''
+
+    _keys = itertools.count() # frames of every reader are cached under own key
+
+    def __init__(self, fd, codecId, frameSize, size, lengths, cache=None):
+        self._fd = fd
+        self._decompress = _DECOMPRESSORS[codecId]
+        self._frameSize = frameSize
+        self.size = size
+        self._frames = [] # (offset, length, raw)
+        offset = HEADER.size
+        for length in lengths:
+            self._frames.append((offset, length & ~RAW_FRAME, bool(length & RAW_FRAME)))
+            offset += length & ~RAW_FRAME
+        self._cache = cache
+        self._key = next(FrameReader._keys)
+
+    @staticmethod
+    def open(fd, cache=None):
+        '''Returns FrameReader when fd is a compressed file, None otherwise'''
+        header = file_io.pread(fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            return None
+        magic, version, codecId, frameSize = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or codecId not in _DECOMPRESSORS or not frameSize:
+            return None
+
+        fileSize = os.fstat(fd).st_size
+        if fileSize < HEADER.size + TRAILER.size:
+            return None
+        size, numOfFrames, indexOffset, magic = TRAILER.unpack(
+            file_io.pread(fd, TRAILER.size, fileSize - TRAILER.size))
+        if (magic != MAGIC or numOfFrames != -(-size // frameSize)
+            or indexOffset + numOfFrames * FRAME_LENGTH.size + TRAILER.size != fileSize):
+            return None
+        index = file_io.pread(fd, numOfFrames * FRAME_LENGTH.size, indexOffset)
+        lengths = struct.unpack('<%dI' % numOfFrames, index)
+        if HEADER.size + sum(length & ~RAW_FRAME for length in lengths) != indexOffset:
+            return None
+        return FrameReader(fd, codecId, frameSize, size, lengths, cache)
+
+    def read(self, size, offset):
+        if offset >= self.size or size <= 0:
+            return ''
+        end = min(offset + size, self.size)
+        first, last = offset // self._frameSize, (end - 1) // self._frameSize
+        chunks = [self._frame(idx) for idx in xrange(first, last + 1)]
+        start = offset - first * self._frameSize
+        if len(chunks) == 1:
+            return chunks[0][start:start + end - offset]
+        return ''.join(chunks)[start:start + end - offset]
+
+    def _frame(self, idx):
+        key = (self._key, idx)
+        frame = None
+        if self._cache is not None:
+            frame = self._cache.get(key)
+        if frame is None:
+            offset, length, raw = self._frames[idx]
+            frame = file_io.pread(self._fd, length, offset)
+            if not raw:
+                frame = self._decompress(frame)
+            if self._cache is not None:
+                self._cache.put(key, frame)
+        return frame
@@ -2,6 +2,8 @@ import os
 import sys
 
 from loclogger import INFO
+import metadata_index
+import compressed_file
 
 def getProjectRoot():
     return os.path.dirname(os.path.abspath('cachefs.py'))
@@ -17,13 +19,33 @@ class Config(object):
             self.cache_root_dir = os.path.join(getCommonPrefix(), '.cache')
             self.source_dir = os.path.join(getCommonPrefix(), '.source')
             self.disk_cache_lifetime = 600
+            self.cache_max_bytes = 0
+            self.cache_high_watermark = 90
+            self.cache_low_watermark = 80
             self.memory_cache_lifetime = 60
+            self.memory_cache_max_entries = 0
+            self.negative_cache_lifetime = 60
+            self.negative_cache_max_entries = 100000
+            self.fetch_policy = 'whole'
+            self.block_size = 2**20
+            self.statfs_source = 'cache'
+            self.metadata_index = False
+            self.dedup = False
+            self.compression = None
+            self.compression_frame_size = 2**18
 
     class CacheFsConfig(object):
 
         def __init__(self):
             self.cache_fs_mountpoint = os.path.join(getCommonPrefix(), 'cachefs')
             self.fusermount_bin = '/bin/fusermount'
+            self.multithreaded = False
+            self.readahead_window = 2**20
+            self.readahead_max_window = 2**26
+            self.kernel_cache = False
+            self.read_buffer_size = 0
+            self.max_open_files = 0
+            self.frame_cache_size = 2**26
 
     def __init__(self):
         self.cache_manager = Config.CacheManagerConfig()
@@ -33,6 +55,29 @@ class Config(object):
 
         INFO("Options to be interpreted: " + str(options))
 
+        self.parseCacheManager(options)
+
+        self.cache_fs.cache_fs_mountpoint = mountpoint
+        INFO("Mountpoint: %s" % self.cache_fs.cache_fs_mountpoint)
+
+        self.cache_fs.multithreaded = options.multithreaded
+        INFO("Multithreaded: %s" % self.cache_fs.multithreaded)
+
+        self.cache_fs.readahead_window = options.readahead_window
+        self.cache_fs.readahead_max_window = options.readahead_max_window
+
+        self.cache_fs.kernel_cache = options.kernel_cache
+        self.cache_fs.read_buffer_size = options.read_buffer_size
+        self.cache_fs.max_open_files = options.max_open_files
+        self.cache_fs.frame_cache_size = options.frame_cache_size
+        INFO("Kernel cache: %s" % self.cache_fs.kernel_cache)
+
+        validator = ConfigValidator()
+        validator.validate(self)
+
+    def parseCacheManager(self, options):
+        '''Takes options added by addCacheManagerOptions()'''
+
         self.cache_manager.cache_root_dir = options.cache_dir
         INFO("Cache root dir: %s" % self.cache_manager.cache_root_dir)
 
@@ -40,16 +85,38 @@ class Config(object):
         INFO("Cache source dir: %s" % self.cache_manager.source_dir)
 
         self.cache_manager.disk_cache_lifetime = options.disk_cache_lifetime
+        self.cache_manager.cache_max_bytes = options.cache_max_bytes
+        self.cache_manager.cache_high_watermark = options.cache_high_watermark
+        self.cache_manager.cache_low_watermark = options.cache_low_watermark
+        if self.cache_manager.cache_max_bytes:
+            INFO("Disk cache limit: %d bytes (watermarks: %d%%, %d%%)"
+                 % (self.cache_manager.cache_max_bytes, self.cache_manager.cache_high_watermark,
+                    self.cache_manager.cache_low_watermark))
         self.cache_manager.memory_cache_lifetime = options.memory_cache_lifetime
+        self.cache_manager.memory_cache_max_entries = options.memory_cache_max_entries
+        self.cache_manager.negative_cache_lifetime = options.negative_cache_lifetime
+        self.cache_manager.negative_cache_max_entries = options.negative_cache_max_entries
 
-        self.cache_fs.cache_fs_mountpoint = mountpoint
-        INFO("Mountpoint: %s" % self.cache_fs.cache_fs_mountpoint)
+        self.cache_manager.fetch_policy = options.fetch_policy
+        self.cache_manager.block_size = options.block_size
+        INFO("Fetch policy: %s (block size: %d)" % (self.cache_manager.fetch_policy,
+                                                    self.cache_manager.block_size))
 
-        validator = ConfigValidator()
-        validator.validate(self)
+        self.cache_manager.statfs_source = options.statfs_source
+        self.cache_manager.metadata_index = options.metadata_index
+        INFO("Metadata index: %s" % self.cache_manager.metadata_index)
+        self.cache_manager.dedup = options.dedup
+        INFO("Deduplication: %s" % self.cache_manager.dedup)
+        if options.compression != 'none':
+            self.cache_manager.compression = options.compression
+        self.cache_manager.compression_frame_size = options.compression_frame_size
+        INFO("Compression: %s (frame size: %d)" % (self.cache_manager.compression,
+                                                   self.cache_manager.compression_frame_size))
 
 class ConfigValidator(object):
 
+    FETCH_POLICIES = ['whole', 'chunked']
+
     class ConfigError(BaseException):
         def __init__(self, msg):
             self.msg = msg
@@ -63,8 +130,32 @@ class ConfigValidator(object):
     def validate(self, cfg):
 
         mountpoint = cfg.cache_fs.cache_fs_mountpoint
-        source_dir = cfg.cache_manager.source_dir
-        cache_dir  = cfg.cache_manager.cache_root_dir
+
+        self.validateCacheManager(cfg.cache_manager)
+
+        if not mountpoint:
+            raise ConfigValidator.ConfigError("Mountpoint is mandatory")
+
+        if cfg.cache_fs.readahead_window < 0 or cfg.cache_fs.readahead_max_window < 0:
+            raise ConfigValidator.ConfigError("Readahead window can't be negative")
+
+        if cfg.cache_fs.read_buffer_size < 0:
+            raise ConfigValidator.ConfigError("Read buffer size can't be negative")
+
+        if cfg.cache_fs.max_open_files < 0:
+            raise ConfigValidator.ConfigError("Max open files can't be negative")
+
+        if cfg.cache_fs.frame_cache_size < 0:
+            raise ConfigValidator.ConfigError("Frame cache size can't be negative")
+
+        if not os.path.lexists(mountpoint):
+            raise ConfigValidator.ConfigError("Mountpoint dir " + mountpoint + " does not exist")
+
+    def validateCacheManager(self, cfg):
+        '''Validates CacheManagerConfig alone, e.g. of cachefs-warm'''
+
+        source_dir = cfg.source_dir
+        cache_dir  = cfg.cache_root_dir
 
         if not source_dir:
             raise ConfigValidator.ConfigError("Parameter source_dir is mandatory")
@@ -74,11 +165,190 @@ class ConfigValidator(object):
         if not cache_dir:
             raise ConfigValidator.ConfigError("Parameter cache_dir is mandatory")
 
-        if not mountpoint:
-            raise ConfigValidator.ConfigError("Mountpoint is mandatory")
+        if cfg.fetch_policy not in ConfigValidator.FETCH_POLICIES:
+            raise ConfigValidator.ConfigError("Fetch policy has to be one of: "
+                                              + ", ".join(ConfigValidator.FETCH_POLICIES))
+
+        if cfg.disk_cache_lifetime < 0:
+            raise ConfigValidator.ConfigError("Disk cache lifetime can't be negative")
+
+        if cfg.cache_max_bytes < 0:
+            raise ConfigValidator.ConfigError("Cache max bytes can't be negative")
+
+        if not 0 < cfg.cache_low_watermark <= cfg.cache_high_watermark <= 100:
+            raise ConfigValidator.ConfigError("Cache watermarks have to satisfy "
+                                              "0 < low <= high <= 100")
+
+        if cfg.dedup and cfg.fetch_policy != 'whole':
+            raise ConfigValidator.ConfigError("Deduplication needs whole fetch policy")
+
+        compression = cfg.compression
+        if compression:
+            if compression == 'lzma' and compressed_file.lzma is None:
+                raise ConfigValidator.ConfigError("Compression with lzma needs python with "
+                                                  "lzma module (backports.lzma on python 2)")
+            if compression not in compressed_file.CODECS:
+                raise ConfigValidator.ConfigError("Compression codec has to be one of: "
+                                                  + ", ".join(compressed_file.CODECS.keys()))
+            if cfg.fetch_policy != 'whole':
+                raise ConfigValidator.ConfigError("Compression needs whole fetch policy")
+        if not 0 < cfg.compression_frame_size < compressed_file.RAW_FRAME:
+            raise ConfigValidator.ConfigError("Compression frame size has to be positive "
+                                              "and below 2GB")
+
+        if cfg.memory_cache_max_entries < 0:
+            raise ConfigValidator.ConfigError("Memory cache max entries can't be negative")
+
+        if cfg.negative_cache_lifetime < 0:
+            raise ConfigValidator.ConfigError("Negative cache lifetime can't be negative")
+
+        if cfg.negative_cache_max_entries < 0:
+            raise ConfigValidator.ConfigError("Negative cache max entries can't be negative")
+
+        if cfg.metadata_index and metadata_index.sqlite3 is None:
+            raise ConfigValidator.ConfigError("Metadata index needs python with sqlite3 module")
+
+        if cfg.block_size <= 0:
+            raise ConfigValidator.ConfigError("Block size has to be positive")
+
+
+def addCacheManagerOptions(parser):
+    '''Options of disk and memory cache, shared by cachefs and cachefs-warm'''
+
+    parser.add_option('-x', '--source-dir', 
+                      dest="source_dir", 
+                      help="Source directory which will be cached",
+                      metavar="MANDATORY_SOURCE_DIR_PATH",
+                      type="str")
+
+    parser.add_option('-c', '--cache-dir',
+                      dest='cache_dir',
+                      help="Path to directory with cache (will be created if not exists)",
+                      metavar="MANDATORY_EXISTING_CACHE_DIR_PATH",
+                      type="str")
+
+    parser.add_option('--disk-cache-lifetime',
+                      dest="disk_cache_lifetime", 
+                      help="Directory listings older than this are compared with source "
+                           "on next access, files whose size or mtime changed are "
+                           "fetched again, 0 disables revalidation. (default: 600)", 
+                      metavar="TIME_IN_SECONDS", 
+                      type="int",
+                      default=600)
+
+    parser.add_option('--cache-max-bytes',
+                      dest="cache_max_bytes",
+                      help="Limit of disk cache size, least recently used files are "
+                           "evicted (fetched again on next access), files being open "
+                           "never. 0 means no limit. (default: 0)",
+                      metavar="BYTES",
+                      type="long",
+                      default=0)
+
+    parser.add_option('--cache-high-watermark',
+                      dest="cache_high_watermark",
+                      help="Eviction starts when disk cache takes this percentage "
+                           "of --cache-max-bytes. (default: 90)",
+                      metavar="PERCENT",
+                      type="int",
+                      default=90)
+
+    parser.add_option('--cache-low-watermark',
+                      dest="cache_low_watermark",
+                      help="Eviction stops at this percentage of --cache-max-bytes. "
+                           "(default: 80)",
+                      metavar="PERCENT",
+                      type="int",
+                      default=80)
+
+    parser.add_option('--memory-cache-lifetime',
+                      dest="memory_cache_lifetime", 
+                      help="Short time stamp lifetime in seconds. (default: 60)", 
+                      metavar="TIME_IN_SECONDS",
+                      type="int",
+                      default=60)
+
+    parser.add_option('--memory-cache-max-entries',
+                      dest="memory_cache_max_entries",
+                      help="Max number of entries in memory cache, least recently "
+                           "used subtrees are evicted, 0 means unbounded. (default: 0)",
+                      metavar="NUMBER",
+                      type="int",
+                      default=0)
+
+    parser.add_option('--negative-cache-lifetime',
+                      dest="negative_cache_lifetime",
+                      help="How long a path known not to exist is answered "
+                           "from memory, in seconds. (default: 60)",
+                      metavar="TIME_IN_SECONDS",
+                      type="int",
+                      default=60)
+
+    parser.add_option('--negative-cache-max-entries',
+                      dest="negative_cache_max_entries",
+                      help="Max number of paths known not to exist kept in memory, "
+                           "0 disables negative cache. (default: 100000)",
+                      metavar="NUMBER",
+                      type="int",
+                      default=100000)
+
+    parser.add_option('--fetch-policy',
+                      dest="fetch_policy",
+                      help="How files are fetched into the disk cache: "
+                           "'whole' file on open or 'chunked' on read. (default: whole)",
+                      metavar="POLICY",
+                      type="choice",
+                      choices=['whole', 'chunked'],
+                      default='whole')
+
+    parser.add_option('--block-size',
+                      dest="block_size",
+                      help="Block size in bytes used by chunked fetch policy. (default: 1048576)",
+                      metavar="BYTES",
+                      type="int",
+                      default=2**20)
+
+    parser.add_option('--statfs-source',
+                      dest="statfs_source",
+                      help="Which figures statfs reports: 'cache' - capacity of cache device "
+                           "and cache usage, 'source' - source directory. (default: cache)",
+                      metavar="SOURCE",
+                      type="choice",
+                      choices=['cache', 'source'],
+                      default='cache')
+
+    parser.add_option('--metadata-index',
+                      dest="metadata_index",
+                      help="Keep sqlite index of disk cache content (state, size, "
+                           "fetch and access times of cached paths) next to cache dir",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--dedup',
+                      dest="dedup",
+                      help="Store identical file contents once, cached files become "
+                           "hard links to content addressed blobs kept next to cache dir "
+                           "(whole fetch policy only)",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--compression',
+                      dest="compression",
+                      help="Store file bodies compressed in independently decompressed "
+                           "frames with given codec, one of: "
+                           + ", ".join(['none'] + compressed_file.CODECS.keys())
+                           + " (whole fetch policy only). (default: none)",
+                      metavar="CODEC",
+                      default='none')
+
+    parser.add_option('--compression-frame-size',
+                      dest="compression_frame_size",
+                      help="Bytes of content in each compressed frame, "
+                           "the least read decompresses. (default: 262144)",
+                      metavar="BYTES",
+                      type="int",
+                      default=2**18)
 
-        if not os.path.lexists(mountpoint):
-            raise ConfigValidator.ConfigError("Mountpoint dir " + mountpoint + " does not exist")
 
 def getConfig():
     return Config()
@@ -1,10 +1,24 @@
 import loclogger
-from loclogger import DEBUG, INFO, trace
+from loclogger import DEBUG, INFO, ERROR, trace
 import path_factory
 import os
 import shutil
 import stat
 import errno
+import struct
+import tempfile
+import threading
+import itertools
+import collections
+from sync import KeyedLock, ProcessLocks, SingleFlight, isProcessAlive
+from block_map import BlockMap
+from manifest import Manifest
+from metadata_index import MetadataIndex
+from blob_store import BlobStore
+import compressed_file
+from fill_engine import FillEngine
+from fs_stats import CacheUsage
+import time
 
 class ParentDirNotCached(Exception):
     pass
@@ -13,79 +27,123 @@ class OriginFileNotExists(Exception):
     pass
 
 class DiskCache(object):
+
+    LEGACY_INITIALIZATION_STAMP = '.cache_initialized'
+    MANIFEST_CACHE_SIZE = 64 # parsed manifests kept in memory
+    EVICTION_BATCH = 64 # files evicted per holding of the lock
     
     def __init__(self, config, memoryCache):
         self._config = config
         self._pathFactory = path_factory.PathFactory(self._config)
         self._memoryCache = memoryCache
+        # guards bookkeeping (manifests, pins, LRU), listings of directories
+        # and file fetches are serialized per path only so they don't block
+        # each other
+        self._lock = threading.RLock()
+        self._fetchLocks = KeyedLock()
+        # ... and between processes sharing the cache (e.g. cachefs-warm),
+        # taken inside of fetch lock, no other lock is taken under it
+        self._processLocks = ProcessLocks(self._pathFactory.createPathToLockFile())
+        # callers of getPathToCachedFile() wait for fetch of the same path in
+        # progress and share its outcome instead of fetching it again
+        self._fills = SingleFlight()
+        self._adoptLegacyDirectories()
+        self._fillDirectory = self._pathFactory.createPathToFillDirectory()
+        self._fillIds = itertools.count()
+        self._removeStaleFills()
+        self._blockMaps = {}
+        # path -> {generation: BlockMap} of copies dropped (e.g. changed in
+        # source) while opened, kept until path is unpinned, see fetchRange()
+        self._retiredBlockMaps = {}
+        # directory path -> (identity of manifest file, Manifest), oldest first
+        self._manifests = collections.OrderedDict()
+        # path -> generation of file fetched by this process, new one whenever
+        # content is (re)fetched, numbers are never reused, so that entry goes
+        # away with cached copy and missing one (0) doesn't match stale ones
+        self._generations = {}
+        self._nextGeneration = itertools.count(1)
+        self._filler = FillEngine()
+        self._blobs = None
+        if self._config.dedup:
+            compression = None
+            if self._config.compression:
+                compression = (self._config.compression, self._config.compression_frame_size)
+            self._blobs = BlobStore(self._pathFactory.createPathToBlobStore(), compression)
+        self.usage = CacheUsage()
+        if os.path.isdir(self._config.cache_root_dir):
+            if self._blobs:
+                # cached files are links to blobs, each is counted once
+                self.usage.scan(self._config.cache_root_dir, self._blobs.root)
+            else:
+                self.usage.scan(self._config.cache_root_dir)
+        # (grave, inodes in it not counted in usage) of invalidated directories
+        # to be deleted, None when whole grave is not counted
+        self._graveyard = self._pathFactory.createPathToGraveyard()
+        self._graves = []
+        if os.path.isdir(self._graveyard):
+            # left over by previous run, usage scan doesn't see them
+            self._graves = [(os.path.join(self._graveyard, grave), None)
+                            for grave in os.listdir(self._graveyard)]
+        self._index = None
+        if self._config.metadata_index:
+            self._index = MetadataIndex(self._pathFactory.createPathToMetadataIndex())
+            if self._index.isEmpty() and self.usage.inodes:
+                self._rebuildIndex()
+
+        # capacity limit: fetched files in order of access, oldest first,
+        # files with open handles are pinned and never evicted
+        self._maxBytes = self._config.cache_max_bytes
+        self._highWatermark = self._maxBytes * self._config.cache_high_watermark // 100
+        self._lowWatermark = self._maxBytes * self._config.cache_low_watermark // 100
+        self._lru = collections.OrderedDict()
+        self._pins = collections.defaultdict(int)
+        self._evictionNeeded = threading.Event()
+        self.onEvict = None # called with path to cache of removed (e.g. evicted) file
+        self.evictedFiles = 0
+        self.evictedBytes = 0
+        if self._maxBytes:
+            self._loadLru()
+            self._checkCapacity()
 
     @trace
     def isDirectory(self, path):
+        if path == os.sep:
+            return True
 
-        pathToCachedDir = self._pathFactory.createPathToDiskCache(path)
-        if os.path.lexists(pathToCachedDir):
-            return os.path.isdir(pathToCachedDir)
-
-        dirpath = os.path.dirname(pathToCachedDir)
-        if self._isDirectoryCached(dirpath):
-            directoryMarker = self._pathFactory.createPathToDiskCacheDirectoryMarker(path)
-            return (os.path.exists(pathToCachedDir) or os.path.exists(directoryMarker))
+        manifest = self._getManifest(os.path.dirname(path))
+        if manifest is not None:
+            entry = manifest.get(os.path.basename(path))
+            return entry is not None and entry[0] == stat.S_IFDIR
 
         return os.path.isdir(self._pathFactory.createAbsoluteSourcePath(path))
 
     @trace
     def exists(self, path):
-        pathToCache = self._pathFactory.createPathToDiskCache(path)
-
-        if os.path.lexists(pathToCache):
+        if path == os.sep:
             return True
 
-        dirpath = os.path.dirname(path)
-        if self._isDirectoryCached(dirpath):
-            fileMarker = self._pathFactory.createPathToDiskCacheFileMarker(path)
-            return os.path.lexists(fileMarker)
+        manifest = self._getManifest(os.path.dirname(path))
+        if manifest is not None:
+            return os.path.basename(path) in manifest
 
         pathToSource = self._pathFactory.createAbsoluteSourcePath(path)
         return os.path.lexists(pathToSource)
 
     @trace
     def getAttributes(self, path):
+        '''Attributes of source file as of listing of its directory'''
 
-        pathToDiskCache = self._pathFactory.createPathToDiskCache(path)
-
-        try:
-
-            return os.lstat(pathToDiskCache)
-
-        except OSError, e:
-            
-            # FIXME: check errno
-
-            if not self._isDirectoryCached(os.path.dirname(path)):
-                # XXX: know it seems to be exceptional case when someone is messing up the disk cache
-                # Might be a case when disk cache expriation will be implemented
-                raise ParentDirNotCached()
-
-            try:
+        if path == os.sep:
+            return os.lstat(self._pathFactory.createPathToDiskCache(path))
 
-                pathToSource = self._pathFactory.createAbsoluteSourcePath(path) 
+        manifest = self._getManifest(os.path.dirname(path))
+        if manifest is None:
+            raise ParentDirNotCached()
 
-                fileMarker = self._pathFactory.createPathToDiskCacheFileMarker(path)
-                if os.path.lexists(fileMarker):
-                    return os.lstat(pathToSource)
-
-                directoryMarker = self._pathFactory.createPathToDiskCacheDirectoryMarker(path)
-                if os.path.lexists(directoryMarker):
-                    st = os.lstat(pathToSource)
-                    self._cacheDirectory(path)
-                    return st
-
-                return None # file doesn't exists
-
-            except OSError, e:
-
-                 # FIXME: check errno
-                 raise OriginFileNotExists()
+        entry = manifest.get(os.path.basename(path))
+        if entry is None:
+            return None # file doesn't exist
+        return entry[1]
 
     @trace
     def readLink(self, path):
@@ -95,8 +153,7 @@ class DiskCache(object):
             return os.readlink(pathToCachedFile)
 
         if not pathToCachedFile:
-            self._cacheFile(path)
-            pathToCachedFile = self._getPathToCachedFile(path)
+            pathToCachedFile = self.getPathToCachedFile(path)
 
         if os.path.islink(pathToCachedFile):
             return os.readlink(pathToCachedFile)
@@ -105,148 +162,841 @@ class DiskCache(object):
 
     @trace
     def listDirectory(self, path):
-        pathToCache = self._pathFactory.createPathToDiskCache(path)
+        return self._getInitializedManifest(path).names()
 
-        try:
-
-            cacheWalker = self._createCachedDirWalker(pathToCache)
+    @trace
+    def listDirectoryEntries(self, path):
+        '''Returns (name, file type, stat) of directory entries, stat is the
+        one of source file as of the listing'''
+        return self._getInitializedManifest(path).entries()
 
-        except OSError: 
+    @trace
+    def cacheDirectory(self, path):
+        parent = os.path.dirname(path)
+        if path != os.sep and not os.path.isdir(self._pathFactory.createPathToDiskCache(parent)):
+            # parents first, never under the lock of path
+            self.cacheDirectory(parent)
+        with self._fetchLocks.locked(path):
+            if not self._isDirectoryCached(path):
+                return self._cacheDirectory(path)
 
-            self.cacheDirectory(path)
-            cacheWalker = self._createCachedDirWalker(pathToCache)
+    @trace
+    def getPathToCachedFile(self, path, pin=False):
+        '''Fetches file unless cached already. Pinned file is not evicted
+        until unpin(), which has to follow every call with pin set.'''
 
-        return cacheWalker.files + cacheWalker.dirs + cacheWalker.links
+        if path != os.sep:
+            # revalidates listing of parent, cached copy goes away if stale
+            self._getManifest(os.path.dirname(path))
 
+        with self._lock:
+            # evictor leaves it alone from now on
+            self._pins[path] += 1
+        try:
+            pathToCache = self._getPathToCachedFile(path)
+            if pathToCache is None:
+                self._fills.do(path, self._fetch, path)
+                pathToCache = (self._getPathToCachedFile(path)
+                               or self._pathFactory.createPathToDiskCache(path))
+
+            with self._lock:
+                if path not in self._generations:
+                    # fetched by another process sharing the cache
+                    self._generations[path] = next(self._nextGeneration)
+                if path in self._lru:
+                    del self._lru[path]
+                    self._lru[path] = None
+                elif self._maxBytes:
+                    self._adopt(path)
+        finally:
+            if not pin:
+                self.unpin(path)
+
+        if self._index:
+            self._index.touch(path)
+        return pathToCache
+
+    def unpin(self, path):
+        with self._lock:
+            self._pins[path] -= 1
+            if not self._pins[path]:
+                del self._pins[path]
+                self._retiredBlockMaps.pop(path, None)
 
     @trace
-    def cacheDirectory(self, path):
-        if not self._isDirectoryCached(path):
-            return self._cacheDirectory(path)
+    def fetchRange(self, path, offset, size, generation=None):
+        '''Makes sure that bytes [offset, offset + size) of already allocated
+        file are present in the disk cache. Returns False as soon as the whole
+        file is cached, i.e. there is no need to call it anymore.
+        generation is the one of the copy caller reads (see getFileGeneration()),
+        copy dropped meanwhile is never fetched into, missing bytes of it
+        raise IOError with ESTALE.'''
+
+        blockMap = self._getBlockMap(path, generation)
+        if blockMap is None:
+            return False
+
+        with self._fetchLocks.locked(path):
+            if generation is not None and generation != self.getFileGeneration(path):
+                blockMap = self._getBlockMap(path, generation)
+                if blockMap is None:
+                    return False # was complete when dropped
+                if blockMap.missingRanges(offset, size):
+                    raise IOError(errno.ESTALE, "Cached copy dropped while open", path)
+                return True
+
+            ranges = blockMap.missingRanges(offset, size)
+            if ranges:
+                with self._processLocks.locked(path):
+                    # another process sharing the cache might have fetched them
+                    blockMap = self._reloadBlockMap(path)
+                    if blockMap is None:
+                        return False
+                    ranges = blockMap.missingRanges(offset, size)
+                    if ranges:
+                        self._fetchBlocks(path, blockMap, ranges)
+            if blockMap.isComplete():
+                self._dropBlockMap(path)
+                if self._index:
+                    self._index.setState(path, stat.S_IFREG, MetadataIndex.POPULATED)
+                return False
+
+        return True
+
+    def getFileGeneration(self, path):
+        return self._generations.get(path, 0)
 
     @trace
-    def getPathToCachedFile(self, path):
-
-        if self._getPathToCachedFile(path) is None:
-            self._cacheFile(path)
-
-        return self._pathFactory.createPathToDiskCache(path)
+    def invalidate(self, path):
+        '''Drops cached copy of path with everything below it, path is fetched
+        again on next access. Directory is just moved to the graveyard (cache
+        root entry by entry), so it takes constant time, it is deleted later by
+        reclaim(). Parent directory is listed again as its manifest might be
+        stale as well.'''
+        pathToCache = self._pathFactory.createPathToDiskCache(path)
+        with self._lock:
+            prefix = path.rstrip(os.sep) + os.sep
+            for manifestPath in [p for p in self._manifests if p == path or p.startswith(prefix)]:
+                del self._manifests[manifestPath]
+            if path != os.sep:
+                self._dropManifest(os.path.dirname(path))
+            if self._index:
+                self._index.removeTree(path)
+
+            if os.path.isdir(pathToCache) and not os.path.islink(pathToCache):
+                for pinnedPath in [p for p in self._pins if p.startswith(prefix)]:
+                    self._retireBlockMap(pinnedPath)
+                for generationPath in [p for p in self._generations if p.startswith(prefix)]:
+                    del self._generations[generationPath]
+                for blockMapPath in [p for p in self._blockMaps if p.startswith(prefix)]:
+                    del self._blockMaps[blockMapPath]
+                if not os.path.isdir(self._graveyard):
+                    os.makedirs(self._graveyard)
+                grave = tempfile.mkdtemp(dir=self._graveyard)
+                if path == os.sep:
+                    # cache root keeps the private directory, graveyard included
+                    os.mkdir(os.path.join(grave, 'data'))
+                    for name in os.listdir(pathToCache):
+                        if name != path_factory.PathFactory.PRIVATE:
+                            os.rename(os.path.join(pathToCache, name),
+                                      os.path.join(grave, 'data', name))
+                else:
+                    os.rename(pathToCache, os.path.join(grave, 'data'))
+                # cache root itself is not counted in usage
+                self._graves.append((grave, int(path == os.sep)))
+            else:
+                self._removeCachedFile(path)
+
+    def reclaim(self):
+        '''Deletes directories invalidated so far'''
+        with self._lock:
+            graves, self._graves = self._graves, []
+        for grave, uncounted in graves:
+            if self._blobs:
+                self._releaseBlobs(grave)
+            if uncounted is not None:
+                bytes, inodes = CacheUsage.measure(grave)
+                self.usage.add(-bytes, uncounted - inodes)
+            shutil.rmtree(grave, ignore_errors=True)
+
+    def waitForEviction(self, timeout):
+        '''Returns True as soon as usage crosses high watermark, False
+        after timeout'''
+        return self._evictionNeeded.wait(timeout)
+
+    def evict(self, target=None):
+        '''Demotes least recently used files to not fetched state (still
+        listed, fetched again on next access) until usage drops to target,
+        low watermark by default. Returns number of evicted files.'''
+        if target is None:
+            target = self._lowWatermark
+        self._evictionNeeded.clear()
+        self.reclaim() # graves are counted in usage as well
+        if self._index:
+            evicted, freed = self._evictIndexed(target)
+        else:
+            evicted, freed = self._evictLru(target)
+
+        self.evictedFiles += evicted
+        self.evictedBytes += freed
+        if evicted:
+            INFO("Evicted %d files (%d bytes), disk cache usage: %d bytes"
+                 % (evicted, freed, self.usage.bytes))
+        if self.usage.bytes > target:
+            INFO("Disk cache usage %d bytes exceeds %d, remaining files are in use"
+                  % (self.usage.bytes, target))
+        return evicted
+
+    def _evictLru(self, target):
+        evicted, freed = 0, 0
+        with self._lock:
+            # every file is looked at once, pinned ones go back behind the rest
+            remaining = len(self._lru)
+        while remaining and self.usage.bytes > target:
+            with self._lock:
+                pinned = []
+                for idx in xrange(min(DiskCache.EVICTION_BATCH, remaining)):
+                    if not self._lru or self.usage.bytes <= target:
+                        break
+                    remaining -= 1
+                    path = self._lru.popitem(last=False)[0]
+                    if path in self._pins:
+                        pinned.append(path)
+                        continue
+                    freed += self._demote(path)
+                    evicted += 1
+                for path in pinned:
+                    self._lru[path] = None
+                if not self._lru:
+                    break
+        return evicted, freed
+
+    def _evictIndexed(self, target):
+        '''Candidates come from the metadata index, which knows files fetched
+        by other processes sharing the cache too, not only the ones this
+        process accessed'''
+        evicted, freed = 0, 0
+        skipped = 0 # pinned files stay in the index, they are skipped over
+        while self.usage.bytes > target:
+            candidates = self._index.leastRecentlyUsed(DiskCache.EVICTION_BATCH, skipped)
+            if not candidates:
+                break
+            with self._lock:
+                for path, size in candidates:
+                    if self.usage.bytes <= target:
+                        break
+                    if path in self._pins:
+                        skipped += 1
+                        continue
+                    if path not in self._lru:
+                        self._adopt(path) # counted in usage before it is freed
+                    self._lru.pop(path, None)
+                    freed += self._demote(path)
+                    evicted += 1
+        return evicted, freed
+
+    def flushIndex(self):
+        '''Writes accesses gathered since last call to the metadata index'''
+        if self._index:
+            self._index.flush()
+
+    def getStatistics(self):
+        statistics = dict(evicted_files=self.evictedFiles,
+                          evicted_bytes=self.evictedBytes)
+        statistics.update(self._filler.getStatistics())
+        if self._blobs:
+            statistics.update(dedup_hits=self._blobs.hits,
+                              dedup_identity_hits=self._blobs.identityHits)
+        if self._index:
+            statistics.update(self._index.usage())
+        return statistics
+
+    def close(self):
+        if self._index:
+            self._index.close()
+            self._index = None
+        if self._blobs:
+            self._blobs.close()
+        self._processLocks.close()
 
     def _getPathToCachedFile(self, path):
+        '''Returns path to cached copy as stored (plain or compressed), None
+        when not fetched'''
         fullPath = self._pathFactory.createPathToDiskCache(path)
+        if os.path.lexists(fullPath):
+            return fullPath
+        fullPath = self._pathFactory.createPathToDiskCacheCompressed(path)
         if os.path.lexists(fullPath):
             return fullPath
         return None
 
+    def _fetch(self, path):
+        with self._fetchLocks.locked(path), self._processLocks.locked(path):
+            # another thread or process might have fetched it in the meantime
+            if self._getPathToCachedFile(path) is None:
+                if self._config.fetch_policy == 'chunked':
+                    self._allocateFile(path)
+                else:
+                    self._cacheFile(path)
+
     def _isDirectoryCached(self, path):
+        return os.path.lexists(self._pathFactory.createPathToDiskCacheManifest(path))
 
-        initStampPath = self._pathFactory.createPathInitializationMarker(
-            path, CachedDirWalker.INITIALIZATION_STAMP)
+    def _getInitializedManifest(self, path):
+        manifest = self._getManifest(path)
+        if manifest is None:
+            self.cacheDirectory(path)
+            manifest = self._getManifest(path)
+        return manifest
+
+    def _getManifest(self, path):
+        '''Returns Manifest of directory or None when it is not cached yet.
+        Listing older than disk cache lifetime is revalidated first.'''
+        manifest = self._loadManifest(path)
+        if manifest is not None and self._isStale(manifest):
+            manifest = self._revalidateDirectory(path)
+        return manifest
+
+    def _isStale(self, manifest):
+        lifetime = self._config.disk_cache_lifetime
+        return lifetime and time.time() - manifest.timestamp >= lifetime
+
+    def _loadManifest(self, path):
+        '''Parsed manifests are reused as long as the file stays the same'''
+        manifestPath = self._pathFactory.createPathToDiskCacheManifest(path)
+        try:
+            st = os.lstat(manifestPath)
+        except OSError, e:
+            return None
+        identity = (st.st_ino, st.st_size, st.st_mtime)
 
-        return os.path.lexists(initStampPath)
+        with self._lock:
+            cached = self._manifests.pop(path, None)
+            if cached and cached[0] == identity:
+                self._manifests[path] = cached
+                return cached[1]
 
-    def _cacheDirectory(self, path):
+        try:
+            manifest = Manifest.load(manifestPath)
+        except IOError, e:
+            return None # invalidated meanwhile
+        except (ValueError, struct.error), e:
+            # e.g. written by older version, directory is listed again
+            ERROR("Dropping manifest: %s" % e)
+            self._dropManifest(path)
+            return None
+        self._rememberManifest(path, identity, manifest)
+        return manifest
+
+    def _rememberManifest(self, path, identity, manifest):
+        with self._lock:
+            self._manifests.pop(path, None)
+            self._manifests[path] = (identity, manifest)
+            while len(self._manifests) > DiskCache.MANIFEST_CACHE_SIZE:
+                self._manifests.popitem(last=False)
+
+    def _dropManifest(self, path):
+        '''Directory gets listed again on next access'''
+        manifestPath = self._pathFactory.createPathToDiskCacheManifest(path)
+        with self._lock:
+            self._manifests.pop(path, None)
+            try:
+                st = os.lstat(manifestPath)
+                os.unlink(manifestPath)
+                self.usage.add(-min(st.st_size, st.st_blocks * 512), -1)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _revalidateDirectory(self, path):
+        '''Lists source directory again. Cached copies of entries whose type,
+        size or mtime changed since last listing are dropped (fetched again on
+        next access), unchanged ones stay as they are.'''
+        with self._fetchLocks.locked(path):
+            previous = self._loadManifest(path)
+            if previous is None or not self._isStale(previous):
+                return previous # revalidated or invalidated meanwhile
+            if loclogger.debug:
+                DEBUG("Revalidating %s listed at %s" % (path, previous.timestamp))
+            return self._cacheDirectory(path, previous)
+
+    def _dropChangedEntries(self, path, previous, entries):
+        current = dict((name, (fileType, st)) for name, fileType, st in entries)
+        for name, fileType, st in previous.entries():
+            entry = current.get(name)
+            if entry is not None and entry[0] == fileType and (
+                fileType == stat.S_IFDIR # has its own listing revalidated
+                or (entry[1].st_size, entry[1].st_mtime) == (st.st_size, st.st_mtime)):
+                continue
+
+            entryPath = os.path.join(path, name)
+            if loclogger.debug:
+                DEBUG("Changed in source: %s" % entryPath)
+            if fileType == stat.S_IFDIR:
+                self.invalidate(entryPath)
+            else:
+                self._dropCachedFile(entryPath)
+
+            if entry is None or entry[0] != fileType or fileType == stat.S_IFLNK:
+                # memory cache may keep children or link target of the old one
+                self._memoryCache.invalidate(entryPath)
+                if entry is not None:
+                    self._memoryCache.cacheAttributes(entryPath, entry[1])
+
+    def _dropCachedFile(self, path):
+        '''Cached copy of file (if any) is fetched again on next access'''
+        with self._fetchLocks.locked(path):
+            with self._lock:
+                self._removeCachedFile(path)
+            if self._index:
+                self._index.removeTree(path)
+
+    def _removeCachedFile(self, path):
+        '''Returns number of bytes freed, has to be called under the lock'''
+        if path in self._pins:
+            self._retireBlockMap(path)
+        self._blockMaps.pop(path, None)
+        self._generations.pop(path, None)
+        pathToCache = self._getPathToCachedFile(path)
+        try:
+            st = os.lstat(pathToCache or '')
+        except OSError, e:
+            return 0 # not fetched
+        if self._blobs and stat.S_ISREG(st.st_mode):
+            bytes, inodes = self._blobs.unlink(pathToCache)
+        else:
+            os.unlink(pathToCache)
+            bytes, inodes = min(st.st_size, st.st_blocks * 512), 1
+        self.usage.add(-bytes, -inodes)
+        blockMapPath = self._pathFactory.createPathToDiskCacheBlockMap(path)
+        if os.path.lexists(blockMapPath):
+            os.unlink(blockMapPath)
+            self.usage.add(inodes=-1)
+        if self.onEvict:
+            self.onEvict(pathToCache)
+        return bytes
+
+    def _retireBlockMap(self, path):
+        '''Keeps block map of opened file about to be dropped, so that its
+        readers know which blocks the dropped copy has, has to be called under
+        the lock'''
+        blockMap = self._blockMaps.get(path)
+        if blockMap is None and os.path.lexists(self._pathFactory.createPathToDiskCacheBlockMap(path)):
+            blockMap = self._loadBlockMap(path)
+        if blockMap is not None:
+            self._retiredBlockMaps.setdefault(path, {})[self.getFileGeneration(path)] = blockMap
+
+    def _releaseBlobs(self, grave):
+        '''Unlinks files of invalidated directory from their blobs, so that
+        blobs nobody else links to are dropped'''
+        for dirpath, dirnames, filenames in os.walk(grave):
+            for name in filenames:
+                fullPath = os.path.join(dirpath, name)
+                try:
+                    if os.lstat(fullPath).st_nlink > 1:
+                        bytes, inodes = self._blobs.unlink(fullPath)
+                        self.usage.add(-bytes, -inodes)
+                except OSError, e:
+                    ERROR("Cannot release %s: %s" % (fullPath, e))
+
+    def _demote(self, path):
+        '''Removes cached copy of file, has to be called under the lock'''
+        freed = self._removeCachedFile(path)
+        if self._index:
+            self._index.setUnfetched(path)
+        if loclogger.debug:
+            DEBUG("Evicted %s (%d bytes)" % (path, freed))
+        return freed
+
+    def _loadLru(self):
+        '''Fetched files in order of last access, as remembered by metadata
+        index or by access times in the cache'''
+        if self._index:
+            for path, size in self._index.leastRecentlyUsed():
+                self._lru[path] = None
+            return
+
+        files = []
+        for path, entries in self._walkCache():
+            for name, fullPath in entries:
+                st = os.lstat(fullPath)
+                if stat.S_ISREG(st.st_mode):
+                    files.append((st.st_atime, os.path.join(path, name)))
+        for atime, path in sorted(files):
+            self._lru[path] = None
+
+    def _walkCache(self):
+        '''Yields (path, [(name, path to cached copy)]) of cached directories
+        with their fetched entries, stored plain or compressed'''
+        root = self._config.cache_root_dir.rstrip(os.sep)
+        factory = path_factory.PathFactory
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == root and factory.PRIVATE in dirnames:
+                dirnames.remove(factory.PRIVATE)
+            entries = [(name, os.path.join(dirpath, name)) for name in filenames
+                       if not name.startswith(factory.MANIFEST)]
+            if factory.COMPRESSED in dirnames:
+                compressed = os.path.join(dirpath, factory.COMPRESSED)
+                entries.extend((name, os.path.join(compressed, name))
+                               for name in os.listdir(compressed))
+            dirnames[:] = [name for name in dirnames
+                           if name not in (factory.BLOCKMAPS, factory.COMPRESSED)]
+            yield dirpath[len(root):] or os.sep, entries
+
+    def _makeRoom(self, bytes):
+        '''Evicts just enough synchronously when fetching bytes would exceed
+        the limit, evictor gets to low watermark in background'''
+        if self._maxBytes and self.usage.bytes + bytes > self._maxBytes:
+            self.evict(max(0, self._maxBytes - bytes))
+
+    def _adopt(self, path):
+        '''File fetched by another process sharing the cache becomes known
+        (counted in usage, candidate for eviction) on first access, has to be
+        called under the lock'''
+        try:
+            st = os.lstat(self._getPathToCachedFile(path) or '')
+        except OSError, e:
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        if st.st_nlink == 1: # blob is counted by whoever stored it
+            self.usage.add(min(st.st_size, st.st_blocks * 512), 1)
+        self._lru[path] = None
+        self._checkCapacity()
+
+    def _checkCapacity(self):
+        if self._maxBytes and self.usage.bytes >= self._highWatermark:
+            self._evictionNeeded.set()
+
+    def _remember(self, path):
+        '''Fetched file becomes candidate for eviction'''
+        if self._maxBytes:
+            with self._lock:
+                self._lru.pop(path, None)
+                self._lru[path] = None
+            self._checkCapacity()
+
+    def _cacheDirectory(self, path, previous=None):
+        '''Lists source directory into manifest, previous is the manifest
+        being revalidated'''
         sourcePath = self._pathFactory.createAbsoluteSourcePath(path)
         pathToCache = self._pathFactory.createPathToDiskCache(path)
         try:
             os.mkdir(pathToCache)
+            self.usage.add(inodes=1)
         except OSError, e:
             parent_path = os.path.dirname(path)
             if e.errno == errno.ENOENT and '/' <> parent_path:
                 self._cacheDirectory(parent_path)
                 os.mkdir(pathToCache)
+                self.usage.add(inodes=1)
             if loclogger.debug:
                 DEBUG("most likely directory %s already exists" % pathToCache)
 
-        cacheWalker = self._createCachedDirWalker(pathToCache)
         sourceDirWalker = self._createDirectoryWalker(self._config.source_dir, path)
         sourceDirWalker.initialize()
 
-        notCachedFiles = list(set(sourceDirWalker.files) - set(cacheWalker.files))
-        notCachedDirectories = list(set(sourceDirWalker.dirs) - set(cacheWalker.dirs))
-        notCachedLinks = list(set(sourceDirWalker.links) - set(cacheWalker.links))
-
         if loclogger.debug:
             DEBUG("REMOTE PATH: %s" % sourcePath)
-            DEBUG("Files to be cached: %s" % notCachedFiles)
-            DEBUG("Directories to be cached: %s" % notCachedDirectories)
-            DEBUG("Links to be cached: %s" % notCachedLinks)
-
-        for filename in notCachedFiles:
-            fileMarker = self._pathFactory.createPathToDiskCacheFileMarker(os.path.join(path, filename))
-            os.symlink(filename, fileMarker)
-
-        for dirname in notCachedDirectories:
-            directoryMarker = self._pathFactory.createPathToDiskCacheDirectoryMarker(os.path.join(path, dirname))
-            os.mkdir(directoryMarker)
+            DEBUG("Files: %s" % sourceDirWalker.files)
+            DEBUG("Directories: %s" % sourceDirWalker.dirs)
+            DEBUG("Links: %s" % sourceDirWalker.links)
 
-        for link in notCachedLinks:
-            link_target = os.readlink(os.sep.join([sourcePath, link]))
-            os.symlink(link_target, os.sep.join([pathToCache, link]))
+        stats = sourceDirWalker.stats
+        entries = ([(name, stat.S_IFREG, stats[name]) for name in sourceDirWalker.files]
+                   + [(name, stat.S_IFDIR, stats[name]) for name in sourceDirWalker.dirs]
+                   + [(name, stat.S_IFLNK, stats[name]) for name in sourceDirWalker.links])
 
-        self._markDirectoryAsInitialized(path)
-
-
-    def _markDirectoryAsInitialized(self, path):
+        if previous is None:
+            self._removeLegacyMarkers(pathToCache)
+        else:
+            self._dropChangedEntries(path, previous, entries)
 
-        dir_cache_stamp = self._pathFactory.createPathToDiskCacheDirectoryMarker(os.path.dirname(path))
+        manifest = Manifest(self._pathFactory.createPathToDiskCacheManifest(path), entries,
+                            time.time())
         try:
-            os.rmdir(dir_cache_stamp)
-        except:
+            replaced = os.lstat(manifest.path)
+            self.usage.add(-min(replaced.st_size, replaced.st_blocks * 512), -1)
+        except OSError, e:
             pass
-        self._createDirectoryInitMarker(path)
-        self._memoryCache.markAsChildrenCached(path, True)
+        manifest.save()
+        st = os.lstat(manifest.path)
+        self.usage.add(min(st.st_size, st.st_blocks * 512), 1)
+        self._rememberManifest(path, (st.st_ino, st.st_size, st.st_mtime), manifest)
+        if self._index:
+            self._index.recordListing(path, entries)
+            self._index.setState(path, stat.S_IFDIR, MetadataIndex.POPULATED)
 
+        self._memoryCache.markAsChildrenCached(path, True)
+        return manifest
+
+    def _rebuildIndex(self):
+        '''Indexes what is in the disk cache already, when index got enabled
+        for existing cache or was lost'''
+        for path, entries in self._walkCache():
+            manifest = self._loadManifest(path)
+            if manifest is None:
+                continue # not listed yet or cached by older version
+            self._index.recordListing(path, manifest.entries())
+            self._index.setState(path, stat.S_IFDIR, MetadataIndex.POPULATED)
+            for name, fullPath in entries:
+                entry = manifest.get(name)
+                if entry is None or entry[0] == stat.S_IFDIR:
+                    continue
+                entryPath = os.path.join(path, name)
+                state = MetadataIndex.POPULATED
+                if os.path.lexists(self._pathFactory.createPathToDiskCacheBlockMap(entryPath)):
+                    state = MetadataIndex.PARTIAL
+                self._index.setState(entryPath, entry[0], state)
+        INFO("Metadata index rebuilt: %s" % self._index.usage())
+
+    def _removeLegacyMarkers(self, pathToCache):
+        '''Directories cached by older versions have marker per entry
+        not fetched yet and initialization stamp instead of manifest'''
+        transformer = path_factory.PathTransformer()
+        for name in os.listdir(pathToCache):
+            fullPath = os.path.join(pathToCache, name)
+            try:
+                if name == DiskCache.LEGACY_INITIALIZATION_STAMP or (
+                    transformer.isFileMarker(name) and os.path.islink(fullPath)):
+                    os.unlink(fullPath)
+                elif transformer.isDirectoryMarker(name) and not os.path.islink(fullPath):
+                    os.rmdir(fullPath)
+                else:
+                    continue
+                self.usage.add(inodes=-1)
+            except OSError, e:
+                if loclogger.debug:
+                    DEBUG("Cannot remove %s: %s" % (fullPath, e))
 
     @trace
     def _cacheFile(self, path):
+        '''Fetches file into the fill directory and renames it into place
+        when complete, so that interrupted fetch never leaves truncated file
+        looking cached'''
 
         src = os.sep.join([self._config.source_dir, path])
         dst = self._pathFactory.createPathToDiskCache(path)
-        parent_dir = os.path.dirname(dst)
-
-        if not os.path.exists(parent_dir):
-            os.makedirs(parent_dir)
+        self._makeParentDirs(dst)
 
+        tmp = self._createFillPath()
+        try:
+            bytes, inodes, compressed = self._fill(src, tmp)
+            if compressed:
+                dst = self._pathFactory.createPathToDiskCacheCompressed(path)
+                self._makeParentDirs(dst)
+            os.rename(tmp, dst)
+        except:
+            self._discardFill(tmp)
+            raise
+        self.usage.add(bytes, inodes)
+        st = os.lstat(dst)
+        self._renewGeneration(path)
+        if stat.S_ISREG(st.st_mode):
+            self._remember(path)
+        if self._index:
+            self._index.setState(path, stat.S_IFMT(st.st_mode), MetadataIndex.POPULATED, st.st_size)
+
+    def _fill(self, src, tmp):
+        '''Returns (bytes, inodes) taken by the copy and whether it is
+        compressed'''
         if os.path.islink(src):
-            link_target = os.readlink(src)
-            os.symlink(link_target, dst)
+            os.symlink(os.readlink(src), tmp)
+            return os.lstat(tmp).st_size, 1, False
+
+        compressed = bool(self._config.compression)
+        self._makeRoom(os.lstat(src).st_size)
+        if self._blobs:
+            return self._blobs.link(src, tmp) + (compressed,)
+        if compressed:
+            compressed_file.compressFile(src, tmp, self._config.compression,
+                                         self._config.compression_frame_size)
+            shutil.copymode(src, tmp)
         else:
-            shutil.copyfile(src, dst)
-            shutil.copymode(src, dst)
+            self._filler.fillFile(src, tmp)
+        return os.lstat(tmp).st_size, 1, compressed
+
+    def _createFillPath(self):
+        # pid tells fetches of processes still running from leftovers
+        return os.path.join(self._fillDirectory,
+                            '%d.%d' % (os.getpid(), next(self._fillIds)))
+
+    def _discardFill(self, tmp):
+        try:
+            if self._blobs and os.lstat(tmp).st_nlink > 1:
+                self._blobs.unlink(tmp) # taken and freed cancel out
+            else:
+                os.unlink(tmp)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                ERROR("Cannot remove %s: %s" % (tmp, e))
+
+    def _adoptLegacyDirectories(self):
+        '''Older versions kept fill directory, blob store and graveyard next
+        to cache root, which breaks renames and links when cache root is
+        mount point. They are moved in when they can be.'''
+        for current in [self._pathFactory.createPathToFillDirectory(),
+                        self._pathFactory.createPathToBlobStore(),
+                        self._pathFactory.createPathToGraveyard()]:
+            legacy = self._pathFactory.createLegacyPathToPrivateDirectory(current)
+            if not os.path.isdir(legacy) or os.path.lexists(current):
+                continue
+            try:
+                if not os.path.isdir(os.path.dirname(current)):
+                    os.makedirs(os.path.dirname(current))
+                os.rename(legacy, current)
+                INFO("Moved %s to %s" % (legacy, current))
+            except OSError, e:
+                ERROR("Cannot move %s to %s: %s" % (legacy, current, e))
+
+    def _removeStaleFills(self):
+        '''Fetches interrupted by crash of this or another process sharing
+        the cache are left in the fill directory, never counted in usage'''
+        try:
+            os.makedirs(self._fillDirectory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        for name in os.listdir(self._fillDirectory):
+            try:
+                pid = int(name.split('.')[0])
+            except ValueError, e:
+                pid = None
+            if pid is not None and pid != os.getpid() and isProcessAlive(pid):
+                continue # being fetched by another process
+            try:
+                os.unlink(os.path.join(self._fillDirectory, name))
+                if loclogger.debug:
+                    DEBUG("Removed interrupted fetch %s" % name)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
 
-        stamp = self._pathFactory.createPathToDiskCacheFileMarker(path)
-        if os.path.lexists(stamp):
-            os.unlink(stamp)
+    def _renewGeneration(self, path):
+        with self._lock:
+            self._generations[path] = next(self._nextGeneration)
+
+    def _makeParentDirs(self, dst):
+        missing = []
+        parent_dir = os.path.dirname(dst)
+        while not os.path.exists(parent_dir):
+            missing.append(parent_dir)
+            parent_dir = os.path.dirname(parent_dir)
+        for parent_dir in reversed(missing):
+            try:
+                os.mkdir(parent_dir)
+                self.usage.add(inodes=1)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
 
     @trace
-    def _createDirectoryInitMarker(self, dirpath):
-        stamp_path = self._pathFactory.createPathInitializationMarker(
-            dirpath, CachedDirWalker.INITIALIZATION_STAMP)
-        os.symlink('.', stamp_path)
+    def _allocateFile(self, path):
+        '''Creates sparse file of source size in the disk cache, its content is
+        fetched block by block by fetchRange()'''
 
-    def _createCachedDirWalker(self, path):
-        return CachedDirWalker(path)
+        src = os.sep.join([self._config.source_dir, path])
+        if os.path.islink(src):
+            return self._cacheFile(path)
 
-    def _createDirectoryWalker(self, rootpath, path):
-        return DirWalker(rootpath, path, self._memoryCache)
+        dst = self._pathFactory.createPathToDiskCache(path)
+        self._makeParentDirs(dst)
+
+        st = os.stat(src)
+        blockMap = BlockMap(self._pathFactory.createPathToDiskCacheBlockMap(path),
+                            st.st_size, self._config.block_size)
+        if not blockMap.isComplete():
+            # block map has to be there first, so that partially fetched
+            # file never looks like completely cached one
+            self._makeParentDirs(blockMap.path)
+            blockMap.save(self._createFillPath())
+            self.usage.add(inodes=1)
+            with self._lock:
+                self._blockMaps[path] = blockMap
+
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.ftruncate(fd, st.st_size)
+        finally:
+            os.close(fd)
+        shutil.copymode(src, dst)
+        self.usage.add(inodes=1)
+        self._renewGeneration(path)
+        self._remember(path)
+        if self._index:
+            state = MetadataIndex.POPULATED if blockMap.isComplete() else MetadataIndex.PARTIAL
+            self._index.setState(path, stat.S_IFREG, state, st.st_size)
+
+    def _getBlockMap(self, path, generation=None):
+        '''Block map of copy of given generation, current one by default'''
+        with self._lock:
+            if generation is not None and generation != self.getFileGeneration(path):
+                return self._retiredBlockMaps.get(path, {}).get(generation)
+            blockMap = self._blockMaps.get(path)
+            if blockMap is None:
+                blockMapPath = self._pathFactory.createPathToDiskCacheBlockMap(path)
+                if os.path.lexists(blockMapPath):
+                    blockMap = self._loadBlockMap(path)
+            return blockMap
+
+    def _reloadBlockMap(self, path):
+        '''Returns block map as saved, None when file got complete'''
+        with self._lock:
+            self._blockMaps.pop(path, None)
+            return self._loadBlockMap(path)
+
+    def _loadBlockMap(self, path):
+        try:
+            blockMap = BlockMap.load(self._pathFactory.createPathToDiskCacheBlockMap(path))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None # dropped by another process meanwhile
+        self._blockMaps[path] = blockMap
+        return blockMap
+
+    def _dropBlockMap(self, path):
+        with self._lock:
+            blockMap = self._blockMaps.pop(path, None)
+            if blockMap:
+                try:
+                    os.unlink(blockMap.path)
+                    self.usage.add(inodes=-1)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def _fetchBlocks(self, path, blockMap, ranges):
+        src = os.sep.join([self._config.source_dir, path])
+        dst = self._pathFactory.createPathToDiskCache(path)
+        blockSize = blockMap.blockSize
 
-    '''
-    def _removeDirectoryInitMarker(self, dirpath):
-        os.unlink(self._get_init_stamp(dirpath))
+        if loclogger.debug:
+            DEBUG("Fetching blocks %s of %s" % (ranges, path))
+        self._makeRoom(sum(last - first for first, last in ranges) * blockSize)
 
-    def _create_file_stamp(self, filepath):
-        pathToCache = self._cache_path(filepath)
-        stamp = self._pathTransformer.transform_filepath(pathToCache)
-        if not os.path.lexists(stamp):
-            os.symlink('#', stamp)
+        srcFd = os.open(src, os.O_RDONLY)
+        try:
+            dstFd = os.open(dst, os.O_WRONLY)
+            try:
+                for first, last in ranges:
+                    offset = first * blockSize
+                    length = min(last * blockSize, blockMap.fileSize) - offset
+                    copied = self._filler.fillRange(srcFd, dstFd, offset, length)
+                    self.usage.add(copied)
+                    if copied == length:
+                        blockMap.markPresent(first, last)
+            finally:
+                os.close(dstFd)
+        finally:
+            os.close(srcFd)
+
+        if not blockMap.isComplete():
+            blockMap.save(self._createFillPath())
+        self._checkCapacity()
 
-    def _remove_file_stamp(self, filepath):
-        pathToCache = self._cache_path(filepath)
-        stamp = self._pathTransformer.transform_filepath(pathToCache)
-        if not os.path.lexists(stamp):
-            os.unlink(stamp)
-    '''
+    def _createDirectoryWalker(self, rootpath, path):
+        return DirWalker(rootpath, path, self._memoryCache)
 
 
 class DirWalker(object):
@@ -261,6 +1011,7 @@ class DirWalker(object):
         self.memoryCache = memoryCache
         self.rootpath = rootpath
         self.relpath = relpath
+        self.stats = {} # entry name -> stat, filled by walk()
 
     def walk(self):
         dirs, files, links = [], [], []
@@ -284,6 +1035,7 @@ class DirWalker(object):
                 # TODO: check if we don't need to slightly modify 
                 # st struct (because of some i-node info)
                 self.memoryCache.cacheAttributes(os.sep.join([self.relpath, entry]), st)
+                self.stats[entry] = st
 
             except OSError:
                 ERROR("cannot stat: %s" % full_path)
@@ -291,37 +1043,3 @@ class DirWalker(object):
 
     def initialize(self):
         self.dirs, self.files, self.links = self.walk()
-
-
-class CachedDirWalker(object):
-
-    INITIALIZATION_STAMP = '.cache_initialized'
-
-    def __init__(self, path):
-        self._dirs, self._files, self._links = DirWalker(path).walk()
-        self.path_transformer = path_factory.PathTransformer()
-
-    @property
-    def files(self):
-        stamp = CachedDirWalker.INITIALIZATION_STAMP
-        if self._links.count(stamp):
-            self._links.remove(stamp)
-        all_files = self._files + list(set(self._links) - set(self.links))
-        return list(set(([
-            self.path_transformer.reverseTransformFilepath(filename) 
-            for filename in all_files])))
-
-    @property
-    def dirs(self):
-        stamp = CachedDirWalker.INITIALIZATION_STAMP
-        if self._dirs.count(stamp):
-            self._dirs.remove(stamp)
-        return list(set(([
-            self.path_transformer.reverseTransformDirpath(dirname) 
-            for dirname in self._dirs
-            ])))
-
-    @property
-    def links(self):
-        return filter(lambda link: not link.endswith(path_factory.PathTransformer.FILE_SUFFIX),
-                      self._links)
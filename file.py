@@ -3,6 +3,8 @@ import datetime
 import stat
 import os
 import calendar
+import threading
+import file_io
 
 class FsObject(object):
 
@@ -15,13 +17,42 @@ class FsObject(object):
 
 class File(FsObject):
 
-    def __init__(self, fh, name, st):
+    def __init__(self, fh, name, st, fileStat=None):
         FsObject.__init__(self, name)
         self.fh = fh
-        self.stat = Stat(stat.S_IFREG | 0555, st.st_size, 1, os.getuid(), os.getgid())
+        self.stat = fileStat or File.createStat(st)
         self.direct_io = False
         self.keep_cache = False
-        self.lseek = 0
+        self.lseek = 0 # offset following the last read, for sequential read detection
+        self.partial = False # content has to be fetched before read
+        self.buffer_size = 0 # reads smaller than that are served from buffer
+        self.buffer = ''
+        self.buffer_offset = 0
+        self.lock = threading.Lock() # guards buffer
+        self.entry = None # of OpenFileTable
+        self.frames = None # FrameReader when cached file is compressed
+        self.readahead_window = 0
+        self.readahead_end = 0
+
+    @staticmethod
+    def createStat(st):
+        result = Stat(stat.S_IFREG | 0555, st.st_size, 1, os.getuid(), os.getgid())
+        result.st_ino = st.st_ino # the same as getattr() and readdir() report
+        return result
+
+    def read(self, size, offset):
+        if self.frames:
+            return self.frames.read(size, offset) # frame cache is the buffer
+        if size >= self.buffer_size:
+            return file_io.pread(self.fh, size, offset)
+
+        with self.lock:
+            start = offset - self.buffer_offset
+            if start >= 0 and start + size <= len(self.buffer):
+                return self.buffer[start:start + size]
+            self.buffer = file_io.pread(self.fh, self.buffer_size, offset)
+            self.buffer_offset = offset
+            return self.buffer[:size]
 
     def __repr__(self):
         return "<File lseek=" + str(self.lseek) + ">"
@@ -0,0 +1,94 @@
+import os
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+
+# positional I/O doesn't depend on (and doesn't move) file offset, so one
+# descriptor can be used by many threads at once without lseek
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+def _raiseErrno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+def _libcFunction(name, argtypes, restype=ctypes.c_ssize_t):
+    function = getattr(_libc, name, None)
+    if function is not None:
+        function.argtypes = argtypes
+        function.restype = restype
+    return function
+
+if hasattr(os, 'pread'):
+
+    pread = os.pread
+    pwrite = os.pwrite
+
+else:
+
+    _libc.pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+    _libc.pread.restype = ctypes.c_ssize_t
+    _libc.pwrite.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64]
+    _libc.pwrite.restype = ctypes.c_ssize_t
+
+    def pread(fd, size, offset):
+        buf = ctypes.create_string_buffer(size)
+        read = _libc.pread(fd, buf, size, offset)
+        if read < 0:
+            _raiseErrno()
+        return buf.raw[:read]
+
+    def pwrite(fd, data, offset):
+        written = _libc.pwrite(fd, data, len(data), offset)
+        if written < 0:
+            _raiseErrno()
+        return written
+
+# in-kernel copies, both raise OSError with ENOSYS when libc doesn't have them
+
+if hasattr(os, 'copy_file_range'):
+
+    def copy_file_range(srcFd, dstFd, count, srcOffset, dstOffset):
+        return os.copy_file_range(srcFd, dstFd, count, srcOffset, dstOffset)
+
+else:
+
+    _copy_file_range = _libcFunction('copy_file_range',
+                                     [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+                                      ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t,
+                                      ctypes.c_uint])
+
+    def copy_file_range(srcFd, dstFd, count, srcOffset, dstOffset):
+        if _copy_file_range is None:
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        copied = _copy_file_range(srcFd, ctypes.byref(ctypes.c_int64(srcOffset)),
+                                  dstFd, ctypes.byref(ctypes.c_int64(dstOffset)), count, 0)
+        if copied < 0:
+            _raiseErrno()
+        return copied
+
+if hasattr(os, 'sendfile'):
+
+    sendfile = os.sendfile
+
+else:
+
+    _sendfile = _libcFunction('sendfile64', [ctypes.c_int, ctypes.c_int,
+                                             ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+
+    def sendfile(dstFd, srcFd, srcOffset, count):
+        '''Writes at (and moves) file offset of dstFd'''
+        if _sendfile is None:
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        sent = _sendfile(dstFd, srcFd, ctypes.byref(ctypes.c_int64(srcOffset)), count)
+        if sent < 0:
+            _raiseErrno()
+        return sent
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int)
+
+def clone(srcFd, dstFd):
+    '''Makes dst share extents of src (reflink), works within one filesystem
+    supporting it (btrfs, xfs, ...), raises EnvironmentError otherwise'''
+    fcntl.ioctl(dstFd, FICLONE, srcFd)
@@ -0,0 +1,180 @@
+import os
+import stat
+import time
+import errno
+import threading
+import collections
+
+import loclogger
+from loclogger import DEBUG
+import file_io
+
+# errors meaning the method can't be used for given pair of filesystems
+UNSUPPORTED = frozenset([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                         errno.ENOTTY, errno.EBADF, errno.ENOTSUP])
+
+
+class FillEngine(object):
+    '''Copies content from source to the disk cache without passing it
+    through python: reflink (FICLONE) of whole file when source and cache
+    share filesystem supporting it, then copy_file_range, then sendfile and
+    read/write loop as the last resort. Method failing as unsupported is not
+    tried again between the same devices.'''
+
+    METHODS = ['clone', 'copy_file_range', 'sendfile', 'copy']
+    COPY_BUFFER_SIZE = 2**20
+    CHUNK_SIZE = 2**30 # max bytes per in-kernel copy call
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._unsupported = set() # (method, source device, cache device)
+        self._files = collections.defaultdict(int) # method -> files filled
+        self._bytes = collections.defaultdict(int) # method -> bytes filled
+        self._seconds = 0.0
+
+    def fillFile(self, src, dst):
+        '''Creates dst with content and permissions of src, returns bytes copied'''
+        start = time.time()
+        srcFd = os.open(src, os.O_RDONLY)
+        try:
+            st = os.fstat(srcFd)
+            dstFd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                os.fchmod(dstFd, stat.S_IMODE(st.st_mode))
+                devices = (st.st_dev, os.fstat(dstFd).st_dev)
+                if st.st_size and self._clone(srcFd, dstFd, devices):
+                    copied, method = st.st_size, 'clone'
+                else:
+                    copied, method = self._fill(srcFd, dstFd, 0, st.st_size, devices)
+            finally:
+                os.close(dstFd)
+        finally:
+            os.close(srcFd)
+        self._account(src, method, copied, time.time() - start)
+        return copied
+
+    def fillRange(self, srcFd, dstFd, offset, length):
+        '''Copies length bytes at offset (less if source is shorter),
+        returns bytes copied'''
+        start = time.time()
+        devices = (os.fstat(srcFd).st_dev, os.fstat(dstFd).st_dev)
+        copied, method = self._fill(srcFd, dstFd, offset, length, devices)
+        self._account(None, method, copied, time.time() - start)
+        return copied
+
+    def getStatistics(self):
+        with self._lock:
+            total = sum(self._bytes.values())
+            statistics = {'fill_bytes': total,
+                          'fill_seconds': round(self._seconds, 3),
+                          'fill_mb_per_second': round(total / 2.0**20 / max(self._seconds, 1e-6), 1)}
+            for method in FillEngine.METHODS:
+                statistics['fill_%s_files' % method] = self._files[method]
+            return statistics
+
+    def _account(self, src, method, copied, seconds):
+        with self._lock:
+            self._files[method] += 1
+            self._bytes[method] += copied
+            self._seconds += seconds
+        if loclogger.debug:
+            DEBUG("Filled %s: %d bytes in %.6fs (%.1f MB/s) by %s"
+                  % (src or 'range', copied, seconds, copied / 2.0**20 / max(seconds, 1e-6), method))
+
+    def _supported(self, method, devices):
+        with self._lock:
+            return (method,) + devices not in self._unsupported
+
+    def _unsupportedBy(self, method, devices, e):
+        '''Returns False when e is a real error and has to be raised'''
+        if e.errno not in UNSUPPORTED:
+            return False
+        if loclogger.debug:
+            DEBUG("%s not usable between devices %s: %s" % (method, devices, e))
+        with self._lock:
+            self._unsupported.add((method,) + devices)
+        return True
+
+    def _clone(self, srcFd, dstFd, devices):
+        if not self._supported('clone', devices):
+            return False
+        try:
+            file_io.clone(srcFd, dstFd)
+            return True
+        except EnvironmentError, e:
+            if not self._unsupportedBy('clone', devices, e):
+                raise
+            return False
+
+    def _fill(self, srcFd, dstFd, offset, length, devices):
+        '''Returns (bytes copied, the last method used)'''
+        copied = 0
+        for method, copy in [('copy_file_range', self._copyFileRange),
+                             ('sendfile', self._sendfile)]:
+            if not self._supported(method, devices):
+                continue
+            try:
+                copied += copy(srcFd, dstFd, offset + copied, length - copied)
+                return copied, method
+            except _Partial, e:
+                copied += e.copied # e.g. cross filesystem copy_file_range on old kernel
+            except EnvironmentError, e:
+                if not self._unsupportedBy(method, devices, e):
+                    raise
+        return copied + self._copy(srcFd, dstFd, offset + copied, length - copied), 'copy'
+
+    def _copyFileRange(self, srcFd, dstFd, offset, length):
+        copied = 0
+        while copied < length:
+            try:
+                count = file_io.copy_file_range(srcFd, dstFd,
+                                                min(length - copied, FillEngine.CHUNK_SIZE),
+                                                offset + copied, offset + copied)
+            except EnvironmentError, e:
+                if not copied:
+                    raise
+                raise _Partial(copied, e)
+            if not count:
+                if copied or os.fstat(srcFd).st_size <= offset:
+                    break # source file got shorter
+                raise _Partial(0, None) # kernel refused without error
+            copied += count
+        return copied
+
+    def _sendfile(self, srcFd, dstFd, offset, length):
+        os.lseek(dstFd, offset, os.SEEK_SET)
+        copied = 0
+        while copied < length:
+            try:
+                count = file_io.sendfile(dstFd, srcFd, offset + copied,
+                                         min(length - copied, FillEngine.CHUNK_SIZE))
+            except EnvironmentError, e:
+                if not copied:
+                    raise
+                raise _Partial(copied, e)
+            if not count:
+                break # source file got shorter
+            copied += count
+        return copied
+
+    def _copy(self, srcFd, dstFd, offset, length):
+        copied = 0
+        while copied < length:
+            buf = file_io.pread(srcFd, min(length - copied, FillEngine.COPY_BUFFER_SIZE),
+                                offset + copied)
+            if not buf:
+                break # source file got shorter
+            while buf:
+                written = file_io.pwrite(dstFd, buf, offset + copied)
+                buf = buf[written:]
+                copied += written
+        return copied
+
+
+class _Partial(Exception):
+    '''Method stopped in the middle, the rest is copied by the next one'''
+
+    def __init__(self, copied, error):
+        Exception.__init__(self, copied, error)
+        self.copied = copied
+        self.error = error
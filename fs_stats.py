@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+
+from loclogger import INFO
+from path_factory import PathFactory
+
+
+class CacheUsage(object):
+    '''Bytes and inodes taken by the disk cache. DiskCache updates it on every
+    change, so reporting usage never needs to walk the cache directory.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.inodes = 0
+
+    def add(self, bytes=0, inodes=0):
+        with self._lock:
+            self.bytes += bytes
+            self.inodes += inodes
+
+    @staticmethod
+    def measure(root, seen=None):
+        '''Returns bytes and inodes taken by everything below root, hard
+        linked files are counted once (seen keeps their inodes). Private
+        directory of the disk cache is skipped, its parts are measured on
+        their own if at all.'''
+        if seen is None:
+            seen = set()
+        bytes, inodes = 0, 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == root and PathFactory.PRIVATE in dirnames:
+                dirnames.remove(PathFactory.PRIVATE)
+            inodes += len(dirnames)
+            for filename in filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                if st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                bytes += min(st.st_size, st.st_blocks * 512)
+                inodes += 1
+        return bytes, inodes
+
+    def scan(self, *roots):
+        '''Counts what is already in the cache, done once on startup'''
+        bytes, inodes = 0, 0
+        seen = set()
+        for root in roots:
+            rootBytes, rootInodes = CacheUsage.measure(root, seen)
+            bytes += rootBytes
+            inodes += rootInodes
+        with self._lock:
+            self.bytes, self.inodes = bytes, inodes
+        INFO("Disk cache usage: %d bytes, %d inodes" % (bytes, inodes))
+
+    def get(self):
+        with self._lock:
+            return self.bytes, self.inodes
+
+
+class FsStats(object):
+    '''Figures reported by statfs, either of the disk cache (capacity of
+    device holding cache root with cache usage) or of the source directory'''
+
+    def __init__(self, config, usage):
+        self._config = config
+        self._usage = usage
+        self._statvfsCache = {}
+
+    def get(self):
+        if self._config.statfs_source == 'source':
+            return self._fromStatvfs(self._statvfs(self._config.source_dir))
+        return self._cacheStats()
+
+    def _cacheStats(self):
+        st = self._statvfs(self._config.cache_root_dir)
+        usedBytes, usedInodes = self._usage.get()
+        blockSize = st.f_frsize or st.f_bsize
+        usedBlocks = (usedBytes + blockSize - 1) // blockSize
+        stats = self._fromStatvfs(st)
+        stats['f_bfree'] = max(0, min(st.f_bfree, st.f_blocks - usedBlocks))
+        stats['f_bavail'] = max(0, min(st.f_bavail, st.f_blocks - usedBlocks))
+        stats['f_files'] = usedInodes + st.f_ffree
+        return stats
+
+    def _fromStatvfs(self, st):
+        return dict(f_bsize=st.f_bsize,
+                    f_frsize=st.f_frsize,
+                    f_blocks=st.f_blocks,
+                    f_bfree=st.f_bfree,
+                    f_bavail=st.f_bavail,
+                    f_files=st.f_files,
+                    f_ffree=st.f_ffree,
+                    f_favail=st.f_favail,
+                    f_flag=st.f_flag,
+                    f_namemax=st.f_namemax)
+
+    def _statvfs(self, path):
+        '''statvfs of underlying device doesn't change quickly, cached
+        for memory_cache_lifetime'''
+        now = time.time()
+        entry = self._statvfsCache.get(path)
+        if entry is None or now - entry[0] >= self._config.memory_cache_lifetime:
+            entry = self._statvfsCache[path] = (now, os.statvfs(path))
+        return entry[1]
@@ -3,17 +3,23 @@ import os
 import traceback
 import inspect
 import datetime
+import threading
 
 __initialized = False
 debug = False
 
 currentLine = 0
-depth = 0
-offset = ''
+
+class _CallDepth(threading.local):
+    '''Call nesting is tracked per thread, so traces of concurrent FUSE
+    requests don't shift each other's indentation'''
+    depth = 0
+    offset = ''
+
+_callDepth = _CallDepth()
 
 def time_file_line_prefix(f):
     def wrapper(msg, filename=None, line=None):
-        global offset
         global currentLine
 
         currentLine += 1
@@ -33,7 +39,7 @@ def time_file_line_prefix(f):
                 line=currentLine,
                 time='{0:>2}.{1:>2}.{2:>2}:{3:>6}'.format(now.hour, now.minute, now.second, now.microsecond),
                 fileline=filename + ":" + str(line),
-                offset=offset,
+                offset=_callDepth.offset,
                 msg=str(msg_line))
             f(s)
     return wrapper
@@ -77,8 +83,6 @@ def NO_LOG(msg):
 
 def trace(f):
     def callWrapper(*args, **kw):
-        global depth
-        global offset
         global debug
         if not debug:
             return f(*args, **kw)
@@ -90,8 +94,9 @@ def trace(f):
             curr_filename = os.path.basename(invoker[1])
             curr_line = invoker[2]
             previous_line = curr_line
-            depth += 1
-            offset = depth * "\t"
+            _callDepth.depth += 1
+            depth = _callDepth.depth
+            _callDepth.offset = depth * "\t"
             s = str("{%s- %s.%s(args: %s, kw: %s)" %
                           (depth, class_name, func_name, args[1:], kw))
             DEBUG(s, curr_filename, curr_line)
@@ -100,8 +105,8 @@ def trace(f):
                           (depth, class_name, func_name, type(retval), retval))
             DEBUG(s, curr_filename, curr_line)
             curr_line = previous_line
-            depth -= 1
-            offset = depth * "\t"
+            _callDepth.depth -= 1
+            _callDepth.offset = _callDepth.depth * "\t"
             return retval
         except Exception, inst:
             ERROR("function: %s, exception: %r" % (f.func_name, inst))
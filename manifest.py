@@ -0,0 +1,92 @@
+import os
+import struct
+import tempfile
+
+from stat_codec import STAT, packStat, unpackStat
+
+
+class Manifest(object):
+    '''Listing of source directory stored in its disk cache counterpart: name,
+    type and source stat of every entry. Directory is initialized as soon as
+    its manifest is there, entries not fetched yet have nothing else on disk.
+
+    Stats are decoded on first access, so that loading a manifest of a huge
+    directory costs just one pass over names. Timestamp tells when the source
+    directory was listed.'''
+
+    MAGIC = 'CFDM'
+    VERSION = 2
+    HEADER = struct.Struct('<4sIId') # magic, version, number of entries, timestamp
+    ENTRY = struct.Struct('<BH') # file type >> 12, length of name
+
+    def __init__(self, path, entries=(), timestamp=0):
+        self.path = path
+        self.timestamp = timestamp
+        self._data = None
+        self._entries = {} # name -> (file type, stat or offset of packed stat in _data)
+        for name, fileType, st in entries:
+            self._entries[name] = (fileType, st)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < Manifest.HEADER.size:
+            raise ValueError("%s is not a manifest" % path)
+        magic, version, numOfEntries, timestamp = Manifest.HEADER.unpack_from(data)
+        if magic != Manifest.MAGIC or version != Manifest.VERSION:
+            raise ValueError("%s is not a manifest of version %d" % (path, Manifest.VERSION))
+
+        manifest = Manifest(path, timestamp=timestamp)
+        manifest._data = data
+        entries = manifest._entries
+        unpackEntry, entrySize, statSize = Manifest.ENTRY.unpack_from, Manifest.ENTRY.size, STAT.size
+        offset = Manifest.HEADER.size
+        for idx in xrange(numOfEntries):
+            fileType, nameLength = unpackEntry(data, offset)
+            offset += entrySize
+            name = data[offset:offset + nameLength]
+            offset += nameLength
+            entries[name] = (fileType << 12, offset)
+            offset += statSize
+        return manifest
+
+    def save(self):
+        chunks = [Manifest.HEADER.pack(Manifest.MAGIC, Manifest.VERSION,
+                                       len(self._entries), self.timestamp)]
+        for name in self._entries:
+            fileType, st = self.get(name)
+            chunks.append(Manifest.ENTRY.pack(fileType >> 12, len(name)))
+            chunks.append(name)
+            chunks.append(packStat(st))
+
+        # unique name, directory may be listed by another process at once
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                        prefix=os.path.basename(self.path) + '.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(''.join(chunks))
+        os.rename(tmp_path, self.path)
+
+    def get(self, name):
+        '''Returns (file type, stat) of entry or None when there is no such'''
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        fileType, st = entry
+        if isinstance(st, (int, long)):
+            st = unpackStat(self._data, st)
+            self._entries[name] = (fileType, st)
+        return fileType, st
+
+    def names(self):
+        return self._entries.keys()
+
+    def entries(self):
+        '''(name, file type, stat) of all entries'''
+        return [(name,) + self.get(name) for name in self._entries.keys()]
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,7 +1,15 @@
 import os
+import stat
+import threading
+import collections
+import struct
+import gc
 import loclogger
 
-from loclogger import DEBUG, trace
+from loclogger import DEBUG, INFO, ERROR, trace
+from sync import synchronized
+from timing_wheel import TimingWheel
+from stat_codec import STAT, packStat, unpackStat
 
 time = None
 
@@ -10,67 +18,72 @@ class MemoryCacheNotValid(Exception):
 
 class MemoryCache(object):
 
-    class TreeNode(object):
-
-        class Impl(object):
-
-            def __init__(self, parent=None):
-                self.parent = parent
-                self.timestamp = time.time()
-                self.stat = None
-                self.optionals = {}
-
-            @staticmethod
-            def optionalFieldNames():
-                return ['children', 'target', 'lock', 'has_all_children']
-
-        def __init__(self, parent=None):
-            self._impl = MemoryCache.TreeNode.Impl(parent)
-
-        def __getattribute__(self, item):
-
-            if item == '_impl':
-                return object.__getattribute__(self, item)
-
-            if hasattr(self._impl, item):
-                return getattr(self._impl, item)
-
-            if item in self._impl.optionals:
-                return self._impl.optionals[item]
-
-            if item in MemoryCache.TreeNode.Impl.optionalFieldNames():
-                self.optionals[item] = None
-                return self.optionals[item]
-
-            return object.__getattribute__(self, item)
-
-        def __setattr__(self, item, value):
-
-            if item == '_impl':
-                object.__setattr__(self, item, value)
-
-            if hasattr(self._impl, item):
-                return setattr(self._impl, item, value)
-
-            if item in MemoryCache.TreeNode.Impl.optionalFieldNames():
-                self.optionals[item] = value
-                return
+    SNAPSHOT_MAGIC = 'CFMS'
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_HEADER = struct.Struct('<4sIdQ') # magic, version, time of save, number of nodes
+    SNAPSHOT_NODE = struct.Struct('<IBdH') # parent index, flags, age, length of name
+    SNAPSHOT_LENGTH = struct.Struct('<I')
+    SNAPSHOT_STAT, SNAPSHOT_TARGET, SNAPSHOT_ALL_CHILDREN = 1, 2, 4
 
-            return object.__setattr__(self, item, value)
+    class TreeNode(object):
+        '''Fixed layout of node, there are millions of them and every
+        lookup touches several'''
+
+        __slots__ = ('parent', 'path', 'timestamp', 'stat', 'children', 'target',
+                     'has_all_children', 'referenced', 'generation', 'parent_generation')
+
+        def __init__(self, parent=None, path=os.sep):
+            self.parent = parent
+            self.path = path # key in MemoryCache._index
+            self.timestamp = time.time()
+            self.stat = None
+            self.children = None
+            self.target = None
+            self.has_all_children = None
+            self.referenced = True # for CLOCK eviction
+            # node is valid as long as parent_generation matches generation of parent
+            self.generation = 0
+            self.parent_generation = 0
 
         def __repr__(self):
-            return "<TreeNode>"
+            return "<TreeNode %s>" % self.path
 
-    def __init__(self, cache_lifetime):
+    def __init__(self, cache_lifetime, max_entries=0,
+                 negative_lifetime=None, negative_max_entries=100000):
         self._root = MemoryCache.TreeNode()
+        self._index = {os.sep: self._root} # normalized path -> node, kept in sync with tree
         self._cache_lifetime = cache_lifetime
-        self._locked = False
+        # nodes are expired by expire(), called periodically, lookups don't check time
+        self.sweep_interval = max(0.1, min(1.0, cache_lifetime / 4.0))
+        self._wheel = TimingWheel(self.sweep_interval, time.time())
+        self._wheel.schedule(self._root, self._root.timestamp + cache_lifetime)
+        self._lock = threading.RLock()
+        self._max_entries = max_entries # 0 means unbounded
+        self._size = 0
+        self._clock = collections.deque() # nodes in order of creation, for eviction
+        self.evictions = 0 # how many times budget forced eviction
+        self.evicted_entries = 0
+        # paths known not to exist -> time of check, oldest first
+        self._negative = collections.OrderedDict()
+        if negative_lifetime is None:
+            negative_lifetime = cache_lifetime
+        self._negative_lifetime = negative_lifetime
+        self._negative_max_entries = negative_max_entries # 0 disables negative entries
+        self.negative_hits = 0
+        self.expired_entries = 0
+        self._stale = [] # invalidated nodes, descendants of which are not reclaimed yet
+        self.invalidations = 0
+
+    def __len__(self):
+        return self._size
 
     @trace
+    @synchronized
     def getAttributes(self, path):
         return self._getAttributes(path)
 
     @trace
+    @synchronized
     def exists(self, path):
 
         attr = self._getAttributes(path)
@@ -84,20 +97,77 @@ class MemoryCache(object):
         return True
 
     @trace
+    @synchronized
     def listDirectory(self, path):
         node = self._get_node(path)
 
-        if not node.has_all_children:
+        if node is None or not node.has_all_children:
+            raise MemoryCacheNotValid()
+
+        return list(sorted(name for name, child in node.children.iteritems()
+                           if child.stat is not None
+                           and child.parent_generation == node.generation))
+
+    @trace
+    @synchronized
+    def listDirectoryEntries(self, path):
+        '''Returns sorted (name, file type, inode) of all existing children'''
+        node = self._get_node(path)
+
+        if node is None or not node.has_all_children:
             raise MemoryCacheNotValid()
 
-        return list(sorted(node.children.keys()))
+        return list(sorted((name, stat.S_IFMT(child.stat.st_mode), child.stat.st_ino)
+                           for name, child in node.children.iteritems()
+                           if child.stat is not None
+                           and child.parent_generation == node.generation))
 
     @trace
+    @synchronized
+    def isMissing(self, path):
+        '''True when path is known not to exist: a negative entry was cached
+        for it or its parent directory knows all its children'''
+        key = self._key(path)
+        stamp = self._negative.get(key)
+        if stamp is not None:
+            if time.time() - stamp < self._negative_lifetime:
+                self.negative_hits += 1
+                return True
+            del self._negative[key]
+
+        if key == os.sep:
+            return False
+        dirname, basename = key.rsplit(os.sep, 1)
+        parent = self._get_node(dirname or os.sep)
+        if parent is None or not parent.has_all_children:
+            return False
+        child = parent.children and parent.children.get(basename)
+        if not child or child.parent_generation != parent.generation:
+            self.negative_hits += 1
+            return True
+        return False
+
+    @trace
+    @synchronized
+    def cacheMissing(self, path):
+        if not self._negative_max_entries:
+            return
+        key = self._key(path)
+        self._negative.pop(key, None)
+        self._negative[key] = time.time()
+        if len(self._negative) > self._negative_max_entries:
+            self._negative.popitem(last=False)
+
+    @trace
+    @synchronized
     def cacheAttributes(self, path, st = None):
+        if self._negative and st is not None:
+            self._negative.pop(self._key(path), None)
         node = self._create_node(path)
         node.stat = st
 
     @trace
+    @synchronized
     def cacheLinkTarget(self, path, target):
         node = self._get_node(path)
         if not node:
@@ -105,76 +175,339 @@ class MemoryCache(object):
         node.target = target
 
     @trace
+    @synchronized
     def readLink(self, path):
         node = self._get_node(path)
         return node
 
     @trace
+    @synchronized
     def markAsChildrenCached(self, path, flag):
         node = self._get_node(path)
         if node is None:
             node = self._create_node(path)
         node.has_all_children = flag
 
+    @trace
+    @synchronized
+    def invalidate(self, path):
+        '''Drops path with everything below it in constant time: generation
+        of the node is bumped, which makes its descendants stale. Stale nodes
+        are reclaimed by expire()'''
+        self._negative.clear()
+        self.invalidations += 1
+        node = self._get_node(path)
+        if node is None:
+            return
+        node.generation += 1
+        node.has_all_children = False
+        if node is self._root:
+            node.stat = None
+        else:
+            node.parent_generation = -1 # node itself is stale too
+            node.parent.has_all_children = False
+        self._stale.append(node)
+
+    @trace
+    @synchronized
+    def expire(self):
+        '''Removes nodes older than cache lifetime, returns number of removed nodes'''
+        now = time.time()
+        removed = 0
+        for node in self._wheel.advance(now):
+            if node is not self._root and node.parent is None:
+                continue # already removed with its ancestor or evicted
+            if now - node.timestamp < self._cache_lifetime:
+                # refreshed meanwhile
+                self._wheel.schedule(node, node.timestamp + self._cache_lifetime)
+            elif node is self._root:
+                self._remove_subtree(node)
+                self._wheel.schedule(node, now + self._cache_lifetime)
+            else:
+                removed += self._remove_subtree(node)
+        self.expired_entries += removed
+
+        if self._stale:
+            self._reclaimStale()
+
+        negative = self._negative
+        while negative:
+            key, stamp = next(negative.iteritems())
+            if now - stamp < self._negative_lifetime:
+                break
+            del negative[key]
+        return removed
+
+    @trace
+    @synchronized
+    def save(self, path):
+        '''Writes all valid nodes to snapshot file, parents go before children.
+        Placeholders, nodes created only on the way to their descendants and
+        holding nothing themselves, are skipped together with their subtrees.'''
+        now = time.time()
+        chunks = []
+        numOfNodes = 0
+        stack = [(0xffffffff, '', self._root)]
+        while stack:
+            parentIdx, name, node = stack.pop()
+            children = []
+            if node.children:
+                children = [(childName, child) for childName, child in node.children.iteritems()
+                            if child.parent_generation == node.generation]
+            saved = [(childName, child) for childName, child in children
+                     if child.stat is not None or child.target is not None
+                     or child.has_all_children]
+            flags = 0
+            if node.stat is not None:
+                flags |= MemoryCache.SNAPSHOT_STAT
+            if node.target is not None:
+                flags |= MemoryCache.SNAPSHOT_TARGET
+            if node.has_all_children and len(saved) == len(children):
+                flags |= MemoryCache.SNAPSHOT_ALL_CHILDREN
+            chunks.append(MemoryCache.SNAPSHOT_NODE.pack(parentIdx, flags,
+                                                         now - node.timestamp, len(name)))
+            chunks.append(name)
+            if node.stat is not None:
+                chunks.append(packStat(node.stat))
+            if node.target is not None:
+                chunks.append(MemoryCache.SNAPSHOT_LENGTH.pack(len(node.target)))
+                chunks.append(node.target)
+            stack.extend((numOfNodes, childName, child) for childName, child in saved)
+            numOfNodes += 1
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MemoryCache.SNAPSHOT_HEADER.pack(MemoryCache.SNAPSHOT_MAGIC,
+                                                     MemoryCache.SNAPSHOT_VERSION,
+                                                     now, numOfNodes))
+            f.write(''.join(chunks))
+        os.rename(tmp_path, path)
+        INFO("Memory cache snapshot of %d nodes saved to %s" % (numOfNodes, path))
+
+    @trace
+    def load(self, path):
+        '''Replaces content of the cache with nodes saved by save() which
+        wouldn't have expired yet, time the file system was not mounted counts
+        to their age. Snapshot is decoded without holding the lock, so that
+        it can be loaded in background of running file system.'''
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, savedAt, numOfNodes = MemoryCache.SNAPSHOT_HEADER.unpack_from(data)
+        if magic != MemoryCache.SNAPSHOT_MAGIC or version != MemoryCache.SNAPSHOT_VERSION:
+            raise ValueError("%s is not a memory cache snapshot" % path)
+
+        loaded = MemoryCache(self._cache_lifetime, self._max_entries)
+        invalidations = self.invalidations
+        now = time.time()
+        downtime = max(0, now - savedAt) # clock might go backwards
+        lifetime = self._cache_lifetime
+        interval = self.sweep_interval
+        index = loaded._index
+        unpackNode = MemoryCache.SNAPSHOT_NODE.unpack_from
+        nodeSize = MemoryCache.SNAPSHOT_NODE.size
+        unpackLength = MemoryCache.SNAPSHOT_LENGTH.unpack_from
+        lengthSize = MemoryCache.SNAPSHOT_LENGTH.size
+        hasStat, hasTarget = MemoryCache.SNAPSHOT_STAT, MemoryCache.SNAPSHOT_TARGET
+        hasAllChildren = MemoryCache.SNAPSHOT_ALL_CHILDREN
+        TreeNode = MemoryCache.TreeNode
+        nodes = []
+        expiring = {} # deadline in sweep intervals -> nodes
+        offset = MemoryCache.SNAPSHOT_HEADER.size
+        gcEnabled = gc.isenabled()
+        gc.disable() # millions of objects none of which is garbage
+        try:
+            for idx in xrange(numOfNodes):
+                parentIdx, flags, age, nameLength = unpackNode(data, offset)
+                offset += nodeSize
+                name = data[offset:offset + nameLength]
+                offset += nameLength
+                st = target = None
+                if flags & hasStat:
+                    st = unpackStat(data, offset)
+                    offset += STAT.size
+                if flags & hasTarget:
+                    length, = unpackLength(data, offset)
+                    offset += lengthSize
+                    target = data[offset:offset + length]
+                    offset += length
+
+                age += downtime
+                if idx == 0:
+                    if age >= lifetime:
+                        break # whole tree is expired
+                    node = loaded._root
+                else:
+                    parent = nodes[parentIdx]
+                    if parent is None or age >= lifetime:
+                        # expired, together with its subtree
+                        if parent is not None:
+                            parent.has_all_children = False
+                        nodes.append(None)
+                        continue
+                    node = TreeNode(parent, (parent.path if parentIdx else '') + os.sep + name)
+                    if parent.children is None:
+                        parent.children = {}
+                    parent.children[name] = node
+                    index[node.path] = node
+                node.timestamp = now - age
+                node.stat = st
+                node.target = target
+                node.has_all_children = bool(flags & hasAllChildren)
+                nodes.append(node)
+                expiring.setdefault(int((lifetime - age) // interval), []).append(node)
+
+            for deadline, expiringNodes in expiring.iteritems():
+                loaded._wheel.scheduleMany(expiringNodes, now + (deadline + 1) * interval)
+            loaded._size = len(index) - 1
+            if self._max_entries:
+                loaded._clock.extend(node for node in nodes[1:] if node is not None)
+                if loaded._size > self._max_entries:
+                    loaded._evict()
+        finally:
+            if gcEnabled:
+                gc.enable()
+
+        with self._lock:
+            if invalidations != self.invalidations:
+                INFO("Memory cache snapshot dropped, cache was invalidated meanwhile")
+                return
+            # whatever got cached meanwhile is dropped, it is just looked up again
+            self._root, self._index, self._wheel = loaded._root, loaded._index, loaded._wheel
+            self._size, self._clock, self._stale = loaded._size, loaded._clock, []
+        INFO("Memory cache snapshot of %d nodes loaded, %d still valid" % (numOfNodes, self._size))
+
+    def _reclaimStale(self):
+        for node in self._stale:
+            if node is self._root:
+                for child in node.children.values() if node.children else []:
+                    if child.parent_generation != node.generation:
+                        self._remove_subtree(child)
+            elif node.parent is not None:
+                self._remove_subtree(node)
+        self._stale = []
+
+    def _isValid(self, node):
+        '''Checks generations up to the root, needed only while some
+        invalidated nodes are not reclaimed'''
+        while node is not self._root:
+            parent = node.parent
+            if parent is None or node.parent_generation != parent.generation:
+                return False
+            node = parent
+        return True
+
     def _split_path(self, path):
         parts = list(filter(lambda x: not x is '', path.split(os.path.sep))) # /a//b///c became ['a', 'b', 'c']
         return parts
 
+    def _key(self, path):
+        '''Paths coming from FUSE are already normalized, the others
+        (/a//b/, a/b) are brought to the same form'''
+        if path[:1] == os.sep and not '//' in path and (path[-1:] != os.sep or path == os.sep):
+            return path
+        return os.sep + os.sep.join(self._split_path(path))
+
     def _getAttributes(self, path):
         node = self._get_node(path)
-        if node:
-            if node.parent is None: # i.e. root
-                if node.stat is None:
-                    return None
-
-            if time.time() - node.timestamp < self._cache_lifetime:
-                if loclogger.debug:
-                    DEBUG("time now: " + str(time.time()) 
-                          + ", memory cache lifetime: " + str(self._cache_lifetime)
-                          + ", node timestamp is: " + str(node.timestamp))
-                return node
-            else:
-                self._remove_subtree(node)
-                return None
-        else:
+        if node is None or (node is self._root and node.stat is None):
             if loclogger.debug:
                 DEBUG("NO CACHE ENTRY FOR %s" % path)
             return None
+        node.referenced = True
+        return node
 
     @trace
     def _get_node(self, path):
-        parts = self._split_path(path)
-        curr_node = self._root
-        for part in parts:
-            if not curr_node.children or (not part in curr_node.children):
-                return None
-            else:
-                curr_node = curr_node.children[part]
-        return curr_node
+        node = self._index.get(self._key(path))
+        if node is not None and self._stale and not self._isValid(node):
+            return None
+        return node
 
     def _create_node(self, path):
-        parts = self._split_path(path)
+        key = self._key(path)
+        node = self._index.get(key)
+        if node is not None and (not self._stale or self._isValid(node)):
+            node.referenced = True
+            if node is self._root:
+                node.timestamp = time.time()
+            return node
+
+        # walk the tree only when something has to be created
         curr_node = self._root
-        for part in parts:
+        curr_path = ''
+        for part in self._split_path(key):
+            curr_path += os.sep + part
             if curr_node.children is None:
                 curr_node.children = {}
-            if not part in curr_node.children:
-                curr_node.children[part] = MemoryCache.TreeNode(curr_node)
+            child = curr_node.children.get(part)
+            if child is None or child.parent_generation != curr_node.generation:
+                if child is not None:
+                    # stale child is only replaced, its subtree is reclaimed by expire()
+                    self._stale.append(child)
+                child = MemoryCache.TreeNode(curr_node, curr_path)
+                child.parent_generation = curr_node.generation
+                curr_node.children[part] = child
+                self._index[curr_path] = child
+                self._wheel.schedule(child, child.timestamp + self._cache_lifetime)
+                self._size += 1
+                if self._max_entries:
+                    self._clock.append(child)
             curr_node = curr_node.children[part]
-        if curr_node is self._root:
-            curr_node.timestamp = time.time()
+            curr_node.referenced = True
+        if self._max_entries and self._size > self._max_entries:
+            self._evict()
         return curr_node
 
+    def _evict(self):
+        '''CLOCK: node referenced since the hand passed it gets second chance,
+        otherwise it is evicted together with its subtree'''
+        self.evictions += 1
+        clock = self._clock
+        while self._size > self._max_entries and clock:
+            node = clock.popleft()
+            if node.parent is None:
+                continue # already removed
+            if node.referenced:
+                node.referenced = False
+                clock.append(node)
+            else:
+                self.evicted_entries += self._remove_subtree(node)
+
+        if len(clock) > 2 * self._max_entries:
+            # drop nodes removed because of expiration
+            self._clock = collections.deque(node for node in clock if node.parent is not None)
+
     def _remove_subtree(self, node):
+        '''Returns number of removed nodes'''
         # NOTE: root is currently not removeable
-        #       method is not thread safe
+        #       callers have to hold self._lock
         if node.parent:
-            # search for key with given value
-            basename = [key for key, value in node.parent.children.iteritems() if value == node][0]
-            DEBUG("key to remove: " + key)
-            del node.parent.children[basename]
+            basename = node.path[node.path.rfind(os.sep) + 1:]
+            if loclogger.debug:
+                DEBUG("key to remove: " + basename)
+            if node.parent.children.get(basename) is node: # might be replaced when stale
+                del node.parent.children[basename]
+                # parent doesn't know all its children anymore
+                node.parent.has_all_children = False
+            return self._detach(node)
         else:
             node.stat = None # FIXME: ugly workaround - deinitialization of root
+            return 0
+
+    def _detach(self, node):
+        '''Marks removed nodes (parent is None), so that eviction skips them'''
+        removed = 0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node.parent = None
+            if self._index.get(node.path) is node:
+                del self._index[node.path]
+            removed += 1
+            if node.children:
+                stack.extend(node.children.itervalues())
+        self._size -= removed
+        return removed
 
 
 
@@ -0,0 +1,195 @@
+import os
+import stat
+import time
+import threading
+import collections
+
+import loclogger
+from loclogger import DEBUG, INFO, ERROR
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None # python built without it, index can't be enabled
+
+
+class MetadataIndex(object):
+    '''Optional sqlite database describing content of the disk cache: type,
+    source size and mtime, fetch time, last access and state of every path
+    the disk cache knows about. Disk cache layout stays the source of truth,
+    the index answers questions which would need walking the cache
+    otherwise: usage per state and least recently used files, the latter
+    including files fetched by other processes sharing the cache, which
+    eviction needs. Listings are revalidated from manifests, not from here.
+
+    Database runs in WAL mode, so reports may be read by another process
+    while cachefs writes. Accesses are just remembered in memory and written
+    in one transaction by flush(), called periodically, so that reads of
+    cached files don't pay for a database write.'''
+
+    UNFETCHED, PARTIAL, POPULATED = 0, 1, 2
+
+    SCHEMA_VERSION = 1
+
+    Entry = collections.namedtuple('Entry', 'path type size mtime fetched accessed state')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._accessed = {} # path -> time of last access not flushed yet
+        try:
+            self._db = self._open()
+        except sqlite3.DatabaseError, e:
+            # it is just an index, start from scratch
+            ERROR("Cannot open metadata index %s, recreating: %s" % (path, e))
+            self._remove()
+            self._db = self._open()
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.text_factory = str # paths are bytes, not necessarily utf-8
+        db.execute('PRAGMA journal_mode=WAL')
+        # losing last transactions on power failure is fine, cache gets rebuilt
+        db.execute('PRAGMA synchronous=NORMAL')
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version != MetadataIndex.SCHEMA_VERSION:
+            if version:
+                INFO("Metadata index has schema %d, recreating" % version)
+            db.execute('DROP TABLE IF EXISTS entries')
+        db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                          path TEXT PRIMARY KEY,
+                          parent TEXT NOT NULL,
+                          type INTEGER NOT NULL,
+                          size INTEGER NOT NULL DEFAULT 0,
+                          mtime REAL NOT NULL DEFAULT 0,
+                          fetched REAL,
+                          accessed REAL,
+                          state INTEGER NOT NULL DEFAULT 0)''')
+        db.execute('CREATE INDEX IF NOT EXISTS entries_by_access ON entries (state, accessed)')
+        db.execute('CREATE INDEX IF NOT EXISTS entries_by_parent ON entries (parent)')
+        db.execute('PRAGMA user_version=%d' % MetadataIndex.SCHEMA_VERSION)
+        db.commit()
+        return db
+
+    def _remove(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.lexists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def isEmpty(self):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM entries LIMIT 1').fetchone() is None
+
+    def recordListing(self, path, entries):
+        '''Records (name, file type, stat) of directory entries, state of
+        entries already known is kept'''
+        rows = [(os.path.join(path, name), fileType, st.st_size, st.st_mtime)
+                for name, fileType, st in entries]
+        with self._lock:
+            self._db.executemany('INSERT OR IGNORE INTO entries (path, parent, type) VALUES (?, ?, ?)',
+                                 [(entryPath, path, fileType) for entryPath, fileType, size, mtime in rows])
+            self._db.executemany('UPDATE entries SET type = ?, size = ?, mtime = ? WHERE path = ?',
+                                 [(fileType, size, mtime, entryPath) for entryPath, fileType, size, mtime in rows])
+            self._db.commit()
+
+    def setState(self, path, fileType, state, size=None, now=None):
+        '''Marks file as (partially) fetched or directory as listed now,
+        size is the one of fetched file, None keeps the listed one'''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._accessed.pop(path, None)
+            cursor = self._db.execute('UPDATE entries SET state = ?, size = COALESCE(?, size), '
+                                      'fetched = ?, accessed = ? WHERE path = ?',
+                                      (state, size, now, now, path))
+            if not cursor.rowcount:
+                # root or entry of directory listed before the index existed
+                self._db.execute('INSERT INTO entries (path, parent, type, size, fetched, accessed, state) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (path, os.path.dirname(path), fileType, size or 0, now, now, state))
+            self._db.commit()
+
+    def setUnfetched(self, path):
+        '''Cached copy of path was removed, it is still listed'''
+        with self._lock:
+            self._accessed.pop(path, None)
+            self._db.execute('UPDATE entries SET state = ?, fetched = NULL WHERE path = ?',
+                             (MetadataIndex.UNFETCHED, path))
+            self._db.commit()
+
+    def touch(self, path, now=None):
+        '''Remembers access to path, written by next flush()'''
+        with self._lock:
+            self._accessed[path] = now if now is not None else time.time()
+
+    def flush(self):
+        with self._lock:
+            if not self._accessed:
+                return
+            accessed, self._accessed = self._accessed, {}
+            self._db.executemany('UPDATE entries SET accessed = ? WHERE path = ?',
+                                 [(when, path) for path, when in accessed.iteritems()])
+            self._db.commit()
+        if loclogger.debug:
+            DEBUG("Metadata index: flushed %d accesses" % len(accessed))
+
+    def removeTree(self, path):
+        '''Forgets path and everything below it'''
+        with self._lock:
+            if path == os.sep:
+                self._accessed.clear()
+                self._db.execute('DELETE FROM entries')
+            else:
+                # '0' follows '/', so this is every path starting with path + '/'
+                prefix = path.rstrip(os.sep)
+                for accessedPath in [p for p in self._accessed
+                                     if p == path or p.startswith(prefix + os.sep)]:
+                    del self._accessed[accessedPath]
+                self._db.execute('DELETE FROM entries WHERE path = ? OR (path > ? AND path < ?)',
+                                 (prefix, prefix + os.sep, prefix + '0'))
+            self._db.commit()
+
+    def get(self, path):
+        with self._lock:
+            row = self._db.execute('SELECT path, type, size, mtime, fetched, accessed, state '
+                                   'FROM entries WHERE path = ?', (path,)).fetchone()
+        return row and MetadataIndex.Entry._make(row)
+
+    def leastRecentlyUsed(self, limit=-1, offset=0):
+        '''Returns (path, size) of up to limit (all by default) (partially)
+        fetched files, least recently accessed first, first offset skipped'''
+        self.flush()
+        with self._lock:
+            return self._db.execute('SELECT path, size FROM entries WHERE state > 0 AND type = ? '
+                                    'ORDER BY accessed, path LIMIT ? OFFSET ?',
+                                    (stat.S_IFREG, limit, offset)).fetchall()
+
+    def usage(self):
+        '''Returns number of entries known and number and source bytes
+        of files per state'''
+        with self._lock:
+            rows = self._db.execute('SELECT state, COUNT(*), TOTAL(size) FROM entries '
+                                    'WHERE type = ? GROUP BY state', (stat.S_IFREG,)).fetchall()
+            entries = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        byState = dict((state, (count, size)) for state, count, size in rows)
+        usage = dict(entries=entries)
+        for name, state in [('unfetched', MetadataIndex.UNFETCHED),
+                            ('partial', MetadataIndex.PARTIAL),
+                            ('populated', MetadataIndex.POPULATED)]:
+            count, size = byState.get(state, (0, 0))
+            usage[name + '_files'] = count
+            usage[name + '_bytes'] = int(size)
+        return usage
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+
+if __name__ == '__main__':
+    # usage report of a mounted (or unmounted) cache:
+    #   python metadata_index.py CACHE_DIR.index
+    import sys
+    for key, value in sorted(MetadataIndex(sys.argv[1]).usage().items()):
+        print "%-20s %d" % (key, value)
@@ -0,0 +1,122 @@
+import os
+import errno
+import threading
+import resource
+import collections
+
+import loclogger
+from loclogger import DEBUG, INFO
+from file import File
+from compressed_file import FrameReader
+from path_factory import PathTransformer
+
+
+class OpenFileTable(object):
+    '''Read-only descriptors of cached files shared by all handles opened on
+    the same file. Descriptors are reference counted, the ones nobody uses
+    stay open (to be reused) until the table reaches maxOpenFiles, then the
+    least recently used ones are closed. Compressed cached files (stored so
+    by PathFactory) get frame reader, which decompressed frames share
+    frameCache.'''
+
+    class Entry(object):
+
+        def __init__(self, cachePath, fd, st, generation, frames=None):
+            self.cachePath = cachePath
+            self.fd = fd
+            self.frames = frames # FrameReader of compressed file
+            self.stat = File.createStat(st)
+            self.generation = generation
+            self.refs = 0
+            self.opens = 0 # acquisitions, i.e. opens of this very file
+            self.detached = False # replaced by fresh descriptor, close when unused
+
+        def __repr__(self):
+            return "<OpenFileTable.Entry %s fd=%d refs=%d>" % (self.cachePath, self.fd, self.refs)
+
+    def __init__(self, maxOpenFiles=0, frameCache=None):
+        if not maxOpenFiles:
+            # leave the other half to the rest of the process
+            maxOpenFiles = max(1, resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2)
+        INFO("Max open files: %d" % maxOpenFiles)
+        self._maxOpenFiles = maxOpenFiles
+        self._frameCache = frameCache
+        self._transformer = PathTransformer()
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._idle = collections.OrderedDict() # cachePath -> Entry, oldest first
+        self._numOfFds = 0
+
+    def acquire(self, cachePath, st, generation=0):
+        '''generation has to change whenever the file was fetched again,
+        descriptor of old file is not reused then'''
+        with self._lock:
+            entry = self._entries.get(cachePath)
+            if entry and entry.generation != generation:
+                self._detach(entry)
+                entry = None
+
+            if entry is None:
+                self._makeRoom(1)
+                fd = os.open(cachePath, os.O_RDONLY)
+                try:
+                    frames = None
+                    if self._transformer.isCompressedPath(cachePath):
+                        frames = FrameReader.open(fd, self._frameCache)
+                        if frames is None:
+                            raise IOError(errno.EIO, "Corrupted compressed file", cachePath)
+                except:
+                    os.close(fd)
+                    raise
+                self._numOfFds += 1
+                entry = self._entries[cachePath] = OpenFileTable.Entry(cachePath, fd, st,
+                                                                       generation, frames)
+            elif not entry.refs:
+                del self._idle[cachePath]
+
+            entry.refs += 1
+            entry.opens += 1
+            return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            if entry.refs:
+                return
+            if entry.detached:
+                self._close(entry)
+            else:
+                self._idle[entry.cachePath] = entry
+                self._makeRoom(0)
+
+    def discard(self, cachePath):
+        '''Closes idle descriptor of file removed from the disk cache, so that
+        its space is freed; descriptor in use is closed on last release'''
+        with self._lock:
+            entry = self._entries.get(cachePath)
+            if entry:
+                self._detach(entry)
+
+    def __len__(self):
+        with self._lock:
+            return self._numOfFds
+
+    def _detach(self, entry):
+        del self._entries[entry.cachePath]
+        if entry.refs:
+            entry.detached = True
+        else:
+            del self._idle[entry.cachePath]
+            self._close(entry)
+
+    def _makeRoom(self, needed):
+        while self._idle and self._numOfFds + needed > self._maxOpenFiles:
+            cachePath, entry = self._idle.popitem(last=False)
+            del self._entries[cachePath]
+            self._close(entry)
+
+    def _close(self, entry):
+        if loclogger.debug:
+            DEBUG("Closing %r" % entry)
+        os.close(entry.fd)
+        self._numOfFds -= 1
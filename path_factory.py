@@ -4,25 +4,34 @@ class PathTransformer(object):
 
     FILE_SUFFIX = 'filecache'
     DIR_SUFFIX = 'dircache'
+    COMPRESSED_SUFFIX = 'cfz' # of compressed blobs
 
-    def transformFilepath(self, filepath):
-        return '.'.join([filepath, PathTransformer.FILE_SUFFIX])
+    # markers of files and directories not cached yet, they are not created
+    # anymore but directories cached by older versions might still have them
 
-    def reverseTransformFilepath(self, filepath):
-        if filepath.endswith(PathTransformer.FILE_SUFFIX):
-            return filepath[:-(len(PathTransformer.FILE_SUFFIX) + 1)]
-        return filepath
+    def isFileMarker(self, filepath):
+        return filepath.endswith('.' + PathTransformer.FILE_SUFFIX)
 
-    def transformDirpath(self, dirpath):
-        return '.'.join([dirpath, PathTransformer.DIR_SUFFIX])
+    def isDirectoryMarker(self, dirpath):
+        return dirpath.endswith('.' + PathTransformer.DIR_SUFFIX)
 
-    def reverseTransformDirpath(self, dirpath):
-        if dirpath.endswith(PathTransformer.DIR_SUFFIX):
-            return dirpath[:-(len(PathTransformer.DIR_SUFFIX) + 1)]
-        return dirpath
+    def transformCompressedPath(self, filepath):
+        return '.'.join([filepath, PathTransformer.COMPRESSED_SUFFIX])
+
+    def isCompressedPath(self, filepath):
+        '''True for compressed body of cached file, see PathFactory'''
+        return os.path.basename(os.path.dirname(filepath)) == PathFactory.COMPRESSED
 
 class PathFactory(object):
 
+    # names starting with .cache_ are reserved in every cached directory,
+    # what is stored about entries goes to directories of their own, so that
+    # no name of source entry (e.g. foo.cfz next to foo) can clash with it
+    MANIFEST = '.cache_manifest'
+    BLOCKMAPS = '.cache_blockmaps' # of partially fetched files, by name
+    COMPRESSED = '.cache_compressed' # bodies of files stored compressed, by name
+    PRIVATE = '.cache_private' # in cache root, never listed
+
     def __init__(self, config):
         self._config = config
         self._path_transformer = PathTransformer()
@@ -35,17 +44,52 @@ class PathFactory(object):
     def createPathToDiskCache(self, path):
         return self._createPathToDiskCache(path)
 
-    def createPathToDiskCacheFileMarker(self, path):
-        pathToCache = self._createPathToDiskCache(path)
-        return self._path_transformer.transformFilepath(pathToCache)
+    def createPathToDiskCacheBlockMap(self, path):
+        return self._createPathToDiskCacheOfEntry(path, PathFactory.BLOCKMAPS)
 
-    def createPathToDiskCacheDirectoryMarker(self, path):
-        pathToCache = self._createPathToDiskCache(path)
-        return self._path_transformer.transformDirpath(pathToCache)
+    def createPathToDiskCacheCompressed(self, path):
+        '''Compressed body of file, stored instead of plain one'''
+        return self._createPathToDiskCacheOfEntry(path, PathFactory.COMPRESSED)
 
-    def createPathInitializationMarker(self, path, initStamp):
+    def createPathToDiskCacheManifest(self, path):
         pathToCache = self._createPathToDiskCache(path)
-        return os.sep.join([pathToCache, initStamp])
+        return os.sep.join([pathToCache, PathFactory.MANIFEST])
+
+    def createPathToPrivateDirectory(self):
+        '''Bookkeeping of the disk cache which is renamed or linked into the
+        cache, so it is inside of cache root, i.e. on the same device'''
+        return os.path.join(self._config.cache_root_dir, PathFactory.PRIVATE)
+
+    def createPathToGraveyard(self):
+        '''Invalidated parts of the disk cache wait there to be deleted'''
+        return os.path.join(self.createPathToPrivateDirectory(), 'graveyard')
+
+    def createPathToMemoryCacheSnapshot(self):
+        return self._config.cache_root_dir.rstrip(os.sep) + '.snapshot'
+
+    def createPathToMetadataIndex(self):
+        return self._config.cache_root_dir.rstrip(os.sep) + '.index'
+
+    def createPathToBlobStore(self):
+        '''Content addressed bodies of cached files, linked into the cache'''
+        return os.path.join(self.createPathToPrivateDirectory(), 'blobs')
+
+    def createPathToFillDirectory(self):
+        '''Files being fetched, renamed into the cache when complete'''
+        return os.path.join(self.createPathToPrivateDirectory(), 'fills')
+
+    def createLegacyPathToPrivateDirectory(self, path):
+        '''Where older versions kept private directory at path, next to
+        cache root'''
+        return self._config.cache_root_dir.rstrip(os.sep) + '.' + os.path.basename(path)
+
+    def createPathToLockFile(self):
+        '''Fills of the cache are serialized through it between processes'''
+        return self._config.cache_root_dir.rstrip(os.sep) + '.lock'
+
+    def _createPathToDiskCacheOfEntry(self, path, directory):
+        dirname, basename = os.path.split(self._createPathToDiskCache(path))
+        return os.path.join(dirname, directory, basename)
 
     def _createPathToDiskCache(self, path):
         root = self._config.cache_root_dir
@@ -0,0 +1,83 @@
+import threading
+import Queue
+
+import loclogger
+from loclogger import DEBUG, ERROR
+
+
+class ReadaheadEngine(object):
+    '''Detects sequential reads on file handles and fetches the following part
+    of the file into the disk cache in background.
+
+    The window starts at initialWindow and doubles with every readahead of
+    still sequential stream up to maxWindow. Random access resets it.'''
+
+    QUEUE_SIZE = 64
+
+    def __init__(self, cacheManager, initialWindow, maxWindow, workers=2):
+        self._cacheManager = cacheManager
+        self._initialWindow = initialWindow
+        self._maxWindow = max(initialWindow, maxWindow)
+        self._queue = Queue.Queue(ReadaheadEngine.QUEUE_SIZE)
+        self._numOfWorkers = workers
+        self._workers = []
+
+    def start(self):
+        for idx in range(self._numOfWorkers):
+            worker = threading.Thread(target=self._loop, name="readahead-%d" % idx)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def onRead(self, path, fh, offset, size):
+        '''Has to be called before fh.lseek is moved past the current read'''
+
+        if offset != fh.lseek:
+            fh.readahead_window = 0
+            fh.readahead_end = 0
+            return
+
+        end = offset + size
+        if fh.readahead_end - end > fh.readahead_window // 2:
+            return # still far enough ahead of the reader
+
+        if fh.readahead_window:
+            fh.readahead_window = min(2 * fh.readahead_window, self._maxWindow)
+        else:
+            fh.readahead_window = self._initialWindow
+
+        start = max(end, fh.readahead_end)
+        fh.readahead_end = end + fh.readahead_window
+        self._schedule(path, start, fh.readahead_end - start)
+
+    def _schedule(self, path, offset, size):
+        if loclogger.debug:
+            DEBUG("Readahead of %s: %d bytes at %d" % (path, size, offset))
+        # fetched in pieces, so that reader waiting for the same file
+        # doesn't have to wait for the whole window
+        step = self._initialWindow
+        while size > 0:
+            try:
+                self._queue.put_nowait((path, offset, min(step, size)))
+            except Queue.Full:
+                return # readahead is only a hint
+            offset += step
+            size -= step
+
+    def _loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            path, offset, size = job
+            try:
+                self._cacheManager.fetchRange(path, offset, size)
+            except Exception, e:
+                ERROR("Readahead of %s failed: %r" % (path, e))
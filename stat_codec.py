@@ -0,0 +1,23 @@
+import os
+import struct
+
+# fixed size binary form of stat results, shared by metadata files written
+# into the cache (memory cache snapshot, directory manifests)
+
+# mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime, blksize, blocks, rdev
+STAT = struct.Struct('<IQQIIIqdddqqQ')
+
+
+def packStat(st):
+    return STAT.pack(st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid, st.st_gid,
+                     st.st_size, st.st_atime, st.st_mtime, st.st_ctime,
+                     st.st_blksize, st.st_blocks, st.st_rdev)
+
+
+def unpackStat(data, offset=0):
+    (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime,
+     blksize, blocks, rdev) = STAT.unpack_from(data, offset)
+    # integer times are in the sequence part, float ones are attributes
+    return os.stat_result((mode, ino, dev, nlink, uid, gid, size,
+                           int(atime), int(mtime), int(ctime),
+                           atime, mtime, ctime, blksize, blocks, rdev))
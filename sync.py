@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import zlib
+import errno
+import fcntl
+import threading
+
+
+def synchronized(f):
+    '''Runs method under self._lock (has to be reentrant lock)'''
+    def lockedCall(self, *args, **kw):
+        with self._lock:
+            return f(self, *args, **kw)
+    lockedCall.func_name = f.func_name
+    return lockedCall
+
+
+def isProcessAlive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, e:
+        return e.errno == errno.EPERM
+
+
+class KeyedLock(object):
+    '''Set of locks addressed by key (e.g. path), created on demand and
+    dropped as soon as nobody holds or waits for them'''
+
+    class _Entry(object):
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.users = 0
+
+    class _Guard(object):
+
+        def __init__(self, owner, key):
+            self._owner = owner
+            self._key = key
+
+        def __enter__(self):
+            self._owner.acquire(self._key)
+
+        def __exit__(self, type, value, traceback):
+            self._owner.release(self._key)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def locked(self, key):
+        return KeyedLock._Guard(self, key)
+
+    def acquire(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = KeyedLock._Entry()
+            entry.users += 1
+        entry.lock.acquire()
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            entry.users -= 1
+            if not entry.users:
+                del self._entries[key]
+        entry.lock.release()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class ProcessLocks(object):
+    '''Locks addressed by key shared with other processes using the same
+    lock file, e.g. cachefs and cachefs-warm filling one cache. Key is hashed
+    to one of stripes, byte of the file locked with lockf(). Record locks
+    don't exclude threads of one process, so stripe is guarded by thread lock
+    as well; holder of a stripe must not try to take another one.'''
+
+    STRIPES = 4096
+    RETRY_DELAY = 0.01 # seconds
+
+    class _Guard(object):
+
+        def __init__(self, owner, key):
+            self._owner = owner
+            # the same in every process, unlike hash()
+            self._stripe = (zlib.crc32(key) & 0xffffffff) % ProcessLocks.STRIPES
+
+        def __enter__(self):
+            self._owner._acquire(self._stripe)
+
+        def __exit__(self, type, value, traceback):
+            self._owner._release(self._stripe)
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        self._locks = [threading.Lock() for i in xrange(ProcessLocks.STRIPES)]
+
+    def locked(self, key):
+        return ProcessLocks._Guard(self, key)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd) # releases record locks
+            self._fd = None
+
+    def _acquire(self, stripe):
+        self._locks[stripe].acquire()
+        try:
+            while True:
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+                    return
+                except IOError, e:
+                    if e.errno != errno.EDEADLK:
+                        raise
+                # kernel sees processes waiting for each other, not threads,
+                # none of which waits holding a stripe, so it's not a deadlock
+                time.sleep(ProcessLocks.RETRY_DELAY)
+        except:
+            self._locks[stripe].release()
+            raise
+
+    def _release(self, stripe):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+        finally:
+            self._locks[stripe].release()
+
+
+class SingleFlight(object):
+    '''Concurrent calls with the same key share one execution: the first
+    caller runs the function, the others wait for it and get its result or
+    its exception. Call made after the first one finished runs again.'''
+
+    class _Call(object):
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None # exc_info
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function(*args)
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
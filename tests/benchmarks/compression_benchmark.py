@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+'''Compares compressed storage of the disk cache with plain copies.
+
+Every corpus (source code, text and binaries) is stored plain and with every
+available codec at each frame size, the benchmark reports compression ratio
+(stored size / content size), throughput of storing the file and of reading it
+back the way CacheFs.read() does: sequentially in FUSE sized requests and at
+random offsets in small requests, the latter through frame cache of given size.
+
+Source corpus is the python code of CacheFs, text is generated from a random
+vocabulary with skewed word frequencies, binaries are shared objects found
+under --binary-dir (python installation by default). Every corpus is repeated
+or cut to --size bytes.
+
+Usage: tests/benchmarks/compression_benchmark.py [--size=16777216]
+           [--frame-sizes=65536,262144,1048576] [--frame-cache-size=67108864]
+           [--binary-dir=DIR]
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import file_io
+import compressed_file
+from compressed_file import FrameCache, FrameReader, compressFile
+
+SEQUENTIAL_READ_SIZE = 2**17 # max_read of FUSE
+RANDOM_READ_SIZE = 4096
+RANDOM_READS = 5000
+
+
+def fill(chunks, size):
+    data = ''.join(chunks)
+    if not data:
+        return ''
+    return (data * (size // len(data) + 1))[:size]
+
+
+def sourceCorpus(size):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+    chunks = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for name in sorted(filenames):
+            if name.endswith('.py'):
+                with open(os.path.join(dirpath, name), 'rb') as f:
+                    chunks.append(f.read())
+    return fill(chunks, size)
+
+
+def textCorpus(size):
+    rand = random.Random(0)
+    letters = 'etaoinshrdlucmfwypvbgkjqxz'
+    vocabulary = [''.join(rand.choice(letters[:rand.randint(8, 26)])
+                          for i in xrange(rand.randint(1, 10))) for w in xrange(10000)]
+    chunks = []
+    length = 0
+    while length < size:
+        words = [vocabulary[min(int(rand.paretovariate(1.0)) - 1, len(vocabulary) - 1)
+                            if rand.random() < 0.7 else rand.randint(0, len(vocabulary) - 1)]
+                 for i in xrange(rand.randint(5, 15))]
+        line = ' '.join(words).capitalize() + '.\n'
+        chunks.append(line)
+        length += len(line)
+    return ''.join(chunks)[:size]
+
+
+def binaryCorpus(size, binaryDir):
+    chunks = []
+    length = 0
+    for dirpath, dirnames, filenames in os.walk(binaryDir):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if '.so' in name and os.path.isfile(path) and not os.path.islink(path):
+                with open(path, 'rb') as f:
+                    chunks.append(f.read())
+                length += len(chunks[-1])
+                if length >= size:
+                    return fill(chunks, size)
+    return fill(chunks, size)
+
+
+def mbps(bytes, seconds):
+    return bytes / 2.0**20 / max(seconds, 1e-9)
+
+
+def measureReads(read, size):
+    start = time.time()
+    for offset in xrange(0, size, SEQUENTIAL_READ_SIZE):
+        read(SEQUENTIAL_READ_SIZE, offset)
+    sequential = mbps(size, time.time() - start)
+
+    rand = random.Random(1)
+    offsets = [rand.randint(0, max(0, size - RANDOM_READ_SIZE)) for i in xrange(RANDOM_READS)]
+    start = time.time()
+    for offset in offsets:
+        read(RANDOM_READ_SIZE, offset)
+    return sequential, mbps(RANDOM_READS * RANDOM_READ_SIZE, time.time() - start)
+
+
+def benchmark(corpus, content, workdir, frameSizes, frameCacheSize):
+    src = os.path.join(workdir, corpus)
+    with open(src, 'wb') as f:
+        f.write(content)
+
+    dst = os.path.join(workdir, corpus + '.plain')
+    start = time.time()
+    shutil.copyfile(src, dst)
+    write = mbps(len(content), time.time() - start)
+    fd = os.open(dst, os.O_RDONLY)
+    try:
+        reads = measureReads(lambda size, offset: file_io.pread(fd, size, offset), len(content))
+    finally:
+        os.close(fd)
+    report(corpus, 'none', '-', 1.0, write, reads)
+
+    for codec in compressed_file.CODECS:
+        for frameSize in frameSizes:
+            dst = os.path.join(workdir, '%s.%s.%d' % (corpus, codec, frameSize))
+            start = time.time()
+            stored = compressFile(src, dst, codec, frameSize)
+            write = mbps(len(content), time.time() - start)
+            fd = os.open(dst, os.O_RDONLY)
+            try:
+                reader = FrameReader.open(fd, FrameCache(frameCacheSize))
+                assert reader.read(len(content), 0) == content
+                reader = FrameReader.open(fd, FrameCache(frameCacheSize)) # cold frame cache
+                reads = measureReads(reader.read, len(content))
+            finally:
+                os.close(fd)
+            report(corpus, codec, frameSize, float(stored) / max(len(content), 1), write, reads)
+
+
+def report(corpus, codec, frameSize, ratio, write, reads):
+    print("{0:>8} {1:>6} {2:>8} {3:>7.3f} {4:>10.1f} {5:>10.1f} {6:>10.1f}".format(
+        corpus, codec, frameSize, ratio, write, reads[0], reads[1]))
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--size', dest='size', type='int', default=2**24)
+    parser.add_option('--frame-sizes', dest='frame_sizes', default='65536,262144,1048576')
+    parser.add_option('--frame-cache-size', dest='frame_cache_size', type='int', default=2**26)
+    parser.add_option('--binary-dir', dest='binary_dir', default=sys.prefix)
+    options, arguments = parser.parse_args()
+    frameSizes = [int(frameSize) for frameSize in options.frame_sizes.split(',')]
+
+    corpora = [('source', sourceCorpus(options.size)),
+               ('text', textCorpus(options.size)),
+               ('binary', binaryCorpus(options.size, options.binary_dir))]
+
+    workdir = tempfile.mkdtemp(prefix='cachefs_bench_')
+    try:
+        print("{0:>8} {1:>6} {2:>8} {3:>7} {4:>10} {5:>10} {6:>10}".format(
+            'corpus', 'codec', 'frame', 'ratio', 'store MB/s', 'seq MB/s', 'rand MB/s'))
+        for corpus, content in corpora:
+            if not content:
+                print("%s: empty corpus, skipped" % corpus)
+                continue
+            benchmark(corpus, content, workdir, frameSizes, options.frame_cache_size)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+'''Concurrency stress benchmark for CacheManager.
+
+Worker threads hammer warm metadata (getAttributes, listDirectory) while a
+separate thread keeps fetching cold files into the disk cache. The benchmark
+prints metadata throughput for increasing number of worker threads, so one
+can see that metadata hits are not stalled by a file being copied.
+
+Usage: tests/benchmarks/concurrency_benchmark.py [--threads=1,2,4,8,16]
+'''
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import threading
+import time
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import config
+import memory_cache
+from cache_manager import CacheManager
+
+
+def createSourceTree(root, dirs, files, coldFiles, coldFileSize):
+    paths = []
+    for d in range(dirs):
+        dirpath = os.path.join(root, 'dir%d' % d)
+        os.makedirs(dirpath)
+        for f in range(files):
+            path = os.path.join(dirpath, 'file%d.h' % f)
+            open(path, 'w').write('#define X %d\n' % f)
+            paths.append('/dir%d/file%d.h' % (d, f))
+
+    os.makedirs(os.path.join(root, 'cold'))
+    chunk = 'x' * 2**20
+    cold = []
+    for c in range(coldFiles):
+        path = os.path.join(root, 'cold', 'image%d.bin' % c)
+        with open(path, 'w') as f:
+            for i in range(coldFileSize):
+                f.write(chunk)
+        cold.append('/cold/image%d.bin' % c)
+    return paths, cold
+
+
+def runRound(cfg, numThreads, paths, cold, duration):
+    if os.path.exists(cfg.cache_root_dir):
+        shutil.rmtree(cfg.cache_root_dir)
+    cacheManager = CacheManager(cfg)
+
+    dirs = sorted(set(os.path.dirname(path) for path in paths))
+    for path in paths:
+        cacheManager.getAttributes(path)
+    for path in dirs:
+        cacheManager.listDirectory(path)
+    cacheManager.getAttributes('/cold')
+
+    stop = threading.Event()
+    counters = [0] * numThreads
+    fetched = [0]
+
+    def worker(idx):
+        rand = random.Random(idx)
+        ops = 0
+        while not stop.is_set():
+            if ops % 10:
+                cacheManager.getAttributes(rand.choice(paths))
+            else:
+                cacheManager.listDirectory(rand.choice(dirs))
+            ops += 1
+        counters[idx] = ops
+
+    def fetcher():
+        for path in cold:
+            if stop.is_set():
+                break
+            cacheManager.getPathToCachedFile(path)
+            fetched[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(numThreads)]
+    threads.append(threading.Thread(target=fetcher))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return sum(counters) / float(duration), fetched[0]
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--threads', dest='threads', default='1,2,4,8,16')
+    parser.add_option('--dirs', dest='dirs', type='int', default=50)
+    parser.add_option('--files', dest='files', type='int', default=100)
+    parser.add_option('--cold-files', dest='cold_files', type='int', default=8)
+    parser.add_option('--cold-file-size', dest='cold_file_size', type='int', default=64,
+                      help='size of cold file in MB')
+    parser.add_option('--duration', dest='duration', type='float', default=3.0)
+    options, arguments = parser.parse_args()
+
+    memory_cache.time = time
+    workdir = tempfile.mkdtemp(prefix='cachefs_bench_')
+    try:
+        cfg = config.Config.CacheManagerConfig()
+        cfg.source_dir = os.path.join(workdir, 'source')
+        cfg.cache_root_dir = os.path.join(workdir, 'cache')
+        cfg.memory_cache_lifetime = 3600
+        paths, cold = createSourceTree(cfg.source_dir, options.dirs, options.files,
+                                       options.cold_files, options.cold_file_size)
+
+        print("{0:>8} {1:>16} {2:>16}".format('threads', 'metadata ops/s', 'cold fetches'))
+        for numThreads in [int(n) for n in options.threads.split(',')]:
+            opsPerSec, fetched = runRound(cfg, numThreads, paths, cold, options.duration)
+            print("{0:>8} {1:>16.0f} {2:>16}".format(numThreads, opsPerSec, fetched))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''Compares throughput of the ways the disk cache is filled from source.
+
+Files of given size are copied from --source-dir (temporary directory by
+default) to --cache-dir (the same by default) with shutil.copyfile and
+copymode, as the disk cache used to, and by FillEngine limited to each of
+its methods: reflink, copy_file_range, sendfile and read/write loop. Method
+the filesystems don't support is reported as such. Page cache is not dropped,
+run with cold cache (echo 3 > /proc/sys/vm/drop_caches between runs) to see
+device speed.
+
+Usage: tests/benchmarks/fill_benchmark.py [--files=20] [--size=67108864]
+           [--source-dir=DIR] [--cache-dir=DIR]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from fill_engine import FillEngine
+
+
+def createSources(sourceDir, files, size):
+    block = os.urandom(2**20)
+    paths = []
+    for idx in xrange(files):
+        path = os.path.join(sourceDir, 'f%d' % idx)
+        with open(path, 'wb') as f:
+            for written in xrange(0, size, len(block)):
+                f.write(block[:min(len(block), size - written)])
+        paths.append(path)
+    return paths
+
+
+def shutilCopy(src, dst):
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
+
+def limitedTo(method, devices):
+    engine = FillEngine()
+    for other in FillEngine.METHODS:
+        if other != method:
+            engine._unsupported.add((other,) + devices)
+    return engine
+
+
+def run(name, fill, sources, cacheDir, size):
+    start = time.time()
+    for src in sources:
+        fill(src, os.path.join(cacheDir, os.path.basename(src)))
+    seconds = time.time() - start
+    for src in sources:
+        os.unlink(os.path.join(cacheDir, os.path.basename(src)))
+    print("{0:>16} {1:>10.1f} {2:>10.1f}".format(
+        name, len(sources) * size / 2.0**20 / max(seconds, 1e-9), len(sources) / max(seconds, 1e-9)))
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--files', dest='files', type='int', default=20)
+    parser.add_option('--size', dest='size', type='int', default=2**26)
+    parser.add_option('--source-dir', dest='source_dir', default=None)
+    parser.add_option('--cache-dir', dest='cache_dir', default=None)
+    options, arguments = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cachefs_bench_', dir=options.source_dir)
+    cacheDir = tempfile.mkdtemp(prefix='cachefs_bench_', dir=options.cache_dir)
+    try:
+        sources = createSources(workdir, options.files, options.size)
+        devices = (os.lstat(workdir).st_dev, os.lstat(cacheDir).st_dev)
+
+        print("{0:>16} {1:>10} {2:>10}".format('method', 'MB/s', 'files/s'))
+        run('shutil', shutilCopy, sources, cacheDir, options.size)
+        for method in FillEngine.METHODS:
+            engine = limitedTo(method, devices)
+            if method != 'copy':
+                probe = os.path.join(cacheDir, 'probe')
+                engine.fillFile(sources[0], probe)
+                os.unlink(probe)
+                if engine.getStatistics()['fill_%s_files' % method] != 1:
+                    print("{0:>16} {1:>21}".format(method, 'unsupported'))
+                    continue
+            run(method, engine.fillFile, sources, cacheDir, options.size)
+    finally:
+        shutil.rmtree(workdir)
+        shutil.rmtree(cacheDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''Memory per node and lookups per second of MemoryCache.
+
+Builds a tree of --entries nodes (directories of --fanout entries each),
+reports resident memory growth per node and then the rate of getAttributes
+hits on random existing paths.
+
+Usage: tests/benchmarks/memory_cache_benchmark.py [--entries=10000000]
+'''
+
+import os
+import sys
+import time
+import random
+import resource
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import memory_cache
+from memory_cache import MemoryCache
+
+
+def maxRss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def generatePaths(entries, fanout):
+    '''Breadth first: /d0, /d1, ..., /d0/d0, /d0/d1, ...'''
+    level = ['']
+    produced = 0
+    while produced < entries:
+        nextLevel = []
+        for parent in level:
+            for idx in xrange(fanout):
+                path = '%s/d%d' % (parent, idx)
+                yield path
+                nextLevel.append(path)
+                produced += 1
+                if produced == entries:
+                    return
+        level = nextLevel
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--entries', dest='entries', type='int', default=10**7)
+    parser.add_option('--fanout', dest='fanout', type='int', default=100)
+    parser.add_option('--lookups', dest='lookups', type='int', default=10**6)
+    options, arguments = parser.parse_args()
+
+    memory_cache.time = time
+    st = os.lstat('.')
+
+    cache = MemoryCache(3600)
+    cache.cacheAttributes('/', st)
+
+    rssBefore = maxRss()
+    timeStart = time.time()
+    sample = []
+    for idx, path in enumerate(generatePaths(options.entries, options.fanout)):
+        cache.cacheAttributes(path, st)
+        if idx % 97 == 0:
+            sample.append(path)
+    buildTime = time.time() - timeStart
+    rssAfter = maxRss()
+
+    print("entries:          %d" % options.entries)
+    print("build time:       %.1f s" % buildTime)
+    print("memory per node:  %.0f B" % ((rssAfter - rssBefore) / float(options.entries)))
+
+    rand = random.Random(0)
+    paths = [rand.choice(sample) for idx in xrange(options.lookups)]
+    timeStart = time.time()
+    for path in paths:
+        cache.getAttributes(path)
+    elapsed = time.time() - timeStart
+    print("lookups/s:        %.0f" % (options.lookups / elapsed))
+
+
+if __name__ == '__main__':
+    main()
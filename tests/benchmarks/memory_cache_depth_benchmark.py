@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''Rate of MemoryCache hits depending on depth of the path.
+
+For every depth a chain of --width directories per level is cached and then
+getAttributes is called on random paths of the deepest level.
+
+Usage: tests/benchmarks/memory_cache_depth_benchmark.py [--depths=5,15,30]
+'''
+
+import os
+import sys
+import time
+import random
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import memory_cache
+from memory_cache import MemoryCache
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--depths', dest='depths', default='5,15,30')
+    parser.add_option('--width', dest='width', type='int', default=10)
+    parser.add_option('--lookups', dest='lookups', type='int', default=10**6)
+    options, arguments = parser.parse_args()
+
+    memory_cache.time = time
+    st = os.lstat('.')
+    rand = random.Random(0)
+
+    print("{0:>6} {1:>12}".format('depth', 'lookups/s'))
+    for depth in [int(depth) for depth in options.depths.split(',')]:
+        cache = MemoryCache(3600)
+        cache.cacheAttributes('/', st)
+        paths = []
+        for idx in xrange(options.width):
+            path = ''.join('/level%d_%d' % (level, idx) for level in xrange(depth))
+            cache.cacheAttributes(path, st)
+            paths.append(path)
+
+        lookups = [rand.choice(paths) for idx in xrange(options.lookups)]
+        timeStart = time.time()
+        for path in lookups:
+            cache.getAttributes(path)
+        elapsed = time.time() - timeStart
+        print("{0:>6} {1:>12.0f}".format(depth, options.lookups / elapsed))
+
+
+if __name__ == '__main__':
+    main()
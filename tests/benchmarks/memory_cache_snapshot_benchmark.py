@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''Startup time of CacheFs with warm memory cache.
+
+Builds MemoryCache of --entries nodes (directories of --fanout entries each),
+saves its snapshot as on unmount and reports how long it takes to load it
+as on mount.
+
+Usage: tests/benchmarks/memory_cache_snapshot_benchmark.py [--entries=1000000]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import memory_cache
+from memory_cache import MemoryCache
+from memory_cache_benchmark import generatePaths
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--entries', dest='entries', type='int', default=10**6)
+    parser.add_option('--fanout', dest='fanout', type='int', default=100)
+    options, arguments = parser.parse_args()
+
+    memory_cache.time = time
+    st = os.lstat('.')
+
+    cache = MemoryCache(3600)
+    cache.cacheAttributes('/', st)
+    for path in generatePaths(options.entries, options.fanout):
+        cache.cacheAttributes(path, st)
+        cache.markAsChildrenCached(path, True)
+
+    workdir = tempfile.mkdtemp(prefix='cachefs_bench_')
+    try:
+        snapshot = os.path.join(workdir, 'snapshot')
+        timeStart = time.time()
+        cache.save(snapshot)
+        saveTime = time.time() - timeStart
+
+        timeStart = time.time()
+        restored = MemoryCache(3600)
+        restored.load(snapshot)
+        loadTime = time.time() - timeStart
+
+        print("entries:          %d" % len(restored))
+        print("snapshot size:    %.1f MB" % (os.path.getsize(snapshot) / 2.0**20))
+        print("save time:        %.2f s" % saveTime)
+        print("load time:        %.2f s" % loadTime)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''Counts FUSE operations `find` issues on a tree served by CacheFs.
+
+find descends the tree with opendir/readdir. When readdir doesn't report the
+type of an entry, find (and ls -l) has to getattr every entry to know whether
+it is a directory. The benchmark runs the same traversal directly against
+CacheFs methods, once honouring entry types (typed readdir) and once ignoring
+them (untyped readdir), and reports the number of FUSE operations and lstat
+syscalls each variant needed, on a cold cache and after memory cache expiry.
+
+Usage: tests/benchmarks/readdir_benchmark.py [--entries=100000]
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import optparse
+import collections
+import stat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import config
+import memory_cache
+import cachefs
+from cache_manager import CacheManager
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.ops = collections.defaultdict(int)
+
+    def wrap(self, obj, name):
+        impl = getattr(obj, name)
+        def counted(*args, **kw):
+            self.ops[name] += 1
+            return impl(*args, **kw)
+        setattr(obj, name, counted)
+
+    def reset(self):
+        self.ops.clear()
+
+    def total(self):
+        return sum(self.ops.values())
+
+
+def createSourceTree(root, entries, filesPerDir):
+    os.makedirs(root)
+    created = 0
+    dirIdx = 0
+    while created < entries:
+        dirpath = os.path.join(root, 'd%d' % (dirIdx // 100), 'd%d' % dirIdx)
+        os.makedirs(dirpath)
+        for f in range(filesPerDir):
+            open(os.path.join(dirpath, 'f%d.c' % f), 'w').close()
+        created += filesPerDir + 1
+        dirIdx += 1
+
+
+def find(fs, path, useTypes):
+    fs.opendir(path)
+    for entry in fs.readdir(path, 0):
+        if entry is None or entry.name in ['.', '..']:
+            continue
+        entryPath = os.path.join(path, entry.name)
+        if useTypes and entry.type:
+            isDir = entry.type == stat.S_IFDIR >> 12
+        else:
+            st = fs.getattr(entryPath)
+            isDir = stat.S_ISDIR(st.st_mode)
+        if isDir:
+            fs.getattr(entryPath) # lookup done by kernel when entering dir
+            find(fs, entryPath, useTypes)
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--entries', dest='entries', type='int', default=100000)
+    parser.add_option('--files-per-dir', dest='files_per_dir', type='int', default=50)
+    options, arguments = parser.parse_args()
+
+    clock = Clock()
+    memory_cache.time = clock
+
+    counter = Counter()
+    for name in ['opendir', 'readdir', 'getattr']:
+        counter.wrap(cachefs.CacheFs, name)
+    lstats = Counter()
+    lstats.wrap(os, 'lstat')
+
+    workdir = tempfile.mkdtemp(prefix='cachefs_bench_')
+    try:
+        source_dir = os.path.join(workdir, 'source')
+        createSourceTree(source_dir, options.entries, options.files_per_dir)
+
+        print("{0:>10} {1:>18} {2:>10} {3:>10} {4:>10}".format(
+            'readdir', 'scenario', 'fuse ops', 'getattr', 'lstat'))
+        for useTypes in [False, True]:
+            cfg = config.Config.CacheManagerConfig()
+            cfg.source_dir = source_dir
+            cfg.cache_root_dir = os.path.join(workdir, 'cache_%s' % useTypes)
+            fs = cachefs.CacheFs.__new__(cachefs.CacheFs)
+            fs.cacheManager = CacheManager(cfg)
+
+            for scenario in ['cold', 'memory expired']:
+                counter.reset()
+                lstats.reset()
+                fs.getattr('/')
+                find(fs, '/', useTypes)
+                print("{0:>10} {1:>18} {2:>10} {3:>10} {4:>10}".format(
+                    useTypes and 'typed' or 'untyped', scenario, counter.total(),
+                    counter.ops['getattr'], lstats.total()))
+                clock.now += cfg.memory_cache_lifetime + 1
+                fs.cacheManager.expire()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
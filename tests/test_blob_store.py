@@ -0,0 +1,133 @@
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+
+import blob_store
+from blob_store import BlobStore
+from compressed_file import FrameReader
+
+class BlobStoreUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.workdir, 'source')
+        self.cache = os.path.join(self.workdir, 'cache')
+        os.mkdir(self.source)
+        os.mkdir(self.cache)
+        self.store = BlobStore(os.path.join(self.workdir, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def createSource(self, name, content):
+        path = os.path.join(self.source, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_identicalContentStoredOnce(self):
+        first = self.createSource('first', 'x' * 5000)
+        second = self.createSource('second', 'x' * 5000)
+        taken = self.store.link(first, os.path.join(self.cache, 'first'))
+        self.assertEqual(3, taken[1]) # blob, its fan-out directory and index entry
+        self.assertTrue(taken[0] >= 5000)
+        self.assertEqual((0, 0), self.store.link(second, os.path.join(self.cache, 'second')))
+        self.assertEqual(1, self.store.hits)
+        self.assertEqual(0, self.store.identityHits)
+        self.assertEqual(os.lstat(os.path.join(self.cache, 'first')).st_ino,
+                         os.lstat(os.path.join(self.cache, 'second')).st_ino)
+
+        # the same source again, not even read
+        self.assertEqual((0, 0), self.store.link(first, os.path.join(self.cache, 'again')))
+        self.assertEqual(1, self.store.identityHits)
+
+        self.assertEqual((0, 0), self.store.unlink(os.path.join(self.cache, 'first')))
+        self.assertEqual((0, 0), self.store.unlink(os.path.join(self.cache, 'again')))
+        self.assertEqual((taken[0], 2), self.store.unlink(os.path.join(self.cache, 'second')))
+
+    def test_blobWithTooManyLinksCopied(self):
+        content = 'x' * 5000
+        self.store.link(self.createSource('first', content), os.path.join(self.cache, 'first'))
+        copying = []
+        def tooManyLinks(src, dst):
+            raise OSError(errno.EMLINK, os.strerror(errno.EMLINK))
+        def copyfileobj(src, dst, length):
+            # store is not held up by the copy
+            copying.append(self.store._lock.acquire(False))
+            self.store._lock.release()
+            copy(src, dst, length)
+        link, copy = os.link, shutil.copyfileobj
+        os.link, blob_store.shutil.copyfileobj = tooManyLinks, copyfileobj
+        try:
+            taken = self.store.link(self.createSource('second', content),
+                                    os.path.join(self.cache, 'second'))
+        finally:
+            os.link, blob_store.shutil.copyfileobj = link, copy
+        self.assertEqual([True], copying)
+        self.assertEqual(1, taken[1])
+        self.assertEqual(content, open(os.path.join(self.cache, 'second')).read())
+        self.assertEqual(['first', 'second'], sorted(os.listdir(self.cache)))
+        self.assertEqual(1, os.lstat(os.path.join(self.cache, 'second')).st_nlink)
+
+    def test_lastUnlinkDropsBlob(self):
+        source = self.createSource('file', 'content')
+        self.store.link(source, os.path.join(self.cache, 'file'))
+        self.store.unlink(os.path.join(self.cache, 'file'))
+        self.assertEqual([], [f for d, dirs, files in os.walk(self.store.root) for f in files])
+
+        # identity is known, content is not stored any more
+        self.store.link(source, os.path.join(self.cache, 'file'))
+        self.assertEqual('content', open(os.path.join(self.cache, 'file')).read())
+        self.assertEqual(0, self.store.identityHits)
+
+    def test_identitiesSurviveRestart(self):
+        source = self.createSource('file', 'content')
+        self.store.link(source, os.path.join(self.cache, 'file'))
+        self.store.close()
+
+        restarted = BlobStore(self.store.root)
+        restarted.link(source, os.path.join(self.cache, 'copy'))
+        self.assertEqual(1, restarted.identityHits)
+        self.assertEqual((0, 0), restarted.unlink(os.path.join(self.cache, 'file')))
+        self.assertEqual(2, restarted.unlink(os.path.join(self.cache, 'copy'))[1])
+
+    def test_blobOfOtherProcessDropped(self):
+        other = BlobStore(self.store.root) # e.g. cachefs-warm sharing the store
+        taken = other.link(self.createSource('file', 'content'), os.path.join(self.cache, 'file'))
+        self.assertEqual((taken[0], 2), self.store.unlink(os.path.join(self.cache, 'file')))
+        self.assertEqual([], [f for d, dirs, files in os.walk(self.store.root) for f in files])
+
+    def test_indexRepairedOnStart(self):
+        self.store.link(self.createSource('file', 'content'), os.path.join(self.cache, 'file'))
+        inodes = os.path.join(self.store.root, BlobStore.INODES)
+        entry = os.path.join(inodes, os.listdir(inodes)[0])
+        os.unlink(entry) # stored by older version
+        os.symlink('../xx/gone', os.path.join(inodes, '12345')) # blob dropped behind its back
+
+        restarted = BlobStore(self.store.root)
+        self.assertEqual([os.path.basename(entry)], os.listdir(inodes))
+        self.assertEqual(2, restarted.unlink(os.path.join(self.cache, 'file'))[1])
+
+    def test_garbageDroppedOnStart(self):
+        source = self.createSource('file', 'content')
+        self.store.link(source, os.path.join(self.cache, 'file'))
+        os.unlink(os.path.join(self.cache, 'file')) # cache wiped behind its back
+        BlobStore(self.store.root)
+        self.assertEqual([], [f for d, dirs, files in os.walk(self.store.root) for f in files])
+
+    def test_compressedBlobs(self):
+        store = BlobStore(os.path.join(self.workdir, 'compressed'), ('zlib', 4096))
+        content = 'compressible ' * 1000
+        first = self.createSource('first', content)
+        second = self.createSource('second', content)
+        taken = store.link(first, os.path.join(self.cache, 'first'))
+        self.assertTrue(taken[0] < len(content))
+        self.assertEqual((0, 0), store.link(second, os.path.join(self.cache, 'second')))
+
+        fd = os.open(os.path.join(self.cache, 'second'), os.O_RDONLY)
+        try:
+            self.assertEqual(content, FrameReader.open(fd).read(len(content), 0))
+        finally:
+            os.close(fd)
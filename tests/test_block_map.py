@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from block_map import BlockMap
+
+class BlockMapUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'file.blockmap')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_missingRanges(self):
+        blockMap = BlockMap(self.path, 10 * 4096 + 1, 4096)
+        self.assertEqual(11, blockMap.numOfBlocks)
+        self.assertEqual([(0, 1)], blockMap.missingRanges(0, 1))
+        self.assertEqual([(1, 3)], blockMap.missingRanges(4096, 8192))
+
+        blockMap.markPresent(2, 5)
+        self.assertEqual([(0, 2), (5, 7)], blockMap.missingRanges(0, 7 * 4096))
+        self.assertEqual([(10, 11)], blockMap.missingRanges(10 * 4096, 2**20))
+        self.assertEqual([], blockMap.missingRanges(11 * 4096, 1))
+
+    def test_complete(self):
+        blockMap = BlockMap(self.path, 3 * 4096, 4096)
+        self.assertFalse(blockMap.isComplete())
+        blockMap.markPresent(0, 3)
+        self.assertTrue(blockMap.isComplete())
+        self.assertTrue(BlockMap(self.path, 0, 4096).isComplete())
+
+    def test_saveAndLoad(self):
+        blockMap = BlockMap(self.path, 20 * 4096, 4096)
+        blockMap.markPresent(3, 9)
+        blockMap.save()
+
+        loaded = BlockMap.load(self.path)
+        self.assertEqual(20 * 4096, loaded.fileSize)
+        self.assertEqual(4096, loaded.blockSize)
+        self.assertEqual([(0, 3), (9, 20)], loaded.missingRanges(0, 20 * 4096))
+        self.assertFalse(loaded.isComplete())
@@ -4,9 +4,11 @@ import unittest
 import time
 import errno
 import os
+import stat
 import fuse
 
 from test_helper import TestHelper
+from cache_manager import Lookup
 
 class CacheFsUnitTest(unittest.TestCase):
 
@@ -18,14 +20,20 @@ class CacheFsUnitTest(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def _lookup(self, path, fileType=None):
+        st = None
+        if fileType is not None:
+            st = os.stat_result((fileType | 0644, 1, 0, 1, 0, 0, 0, 0, 0, 0))
+        return Lookup(path, st)
+
     def test_access(self):
         # inject mock
         cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
 
         # setup mock
-        cacheManagerMock.exists('file1').AndReturn(True)
-        cacheManagerMock.exists('file2').AndReturn(False)
-        cacheManagerMock.exists('file3').AndReturn(True)
+        cacheManagerMock.lookup('file1').AndReturn(self._lookup('file1', stat.S_IFREG))
+        cacheManagerMock.lookup('file2').AndReturn(self._lookup('file2'))
+        cacheManagerMock.lookup('file3').AndReturn(self._lookup('file3', stat.S_IFREG))
         mox.Replay(cacheManagerMock)
 
         failure = -errno.EACCES
@@ -36,23 +44,37 @@ class CacheFsUnitTest(unittest.TestCase):
         self.assertEqual(failure, self.sut.access('file3', os.W_OK));
         self.assertEqual(success, self.sut.access('file4', os.R_OK | os.X_OK));
 
+    def test_setxattr_invalidates(self):
+        cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
+        cacheManagerMock.invalidate('/dir')
+        mox.Replay(cacheManagerMock)
+
+        self.assertEqual(0, self.sut.setxattr('/dir', cachefs.CacheFs.INVALIDATE_XATTR, '', 0))
+        self.assertEqual(-errno.EOPNOTSUPP, self.sut.setxattr('/dir', 'user.other', '1', 0))
+        mox.Verify(cacheManagerMock)
+
     def test_readdir(self):
         DIRPATH = '/DIR'
-        dir_entries = ['file', 'subdir', 'file2']
+        dir_entries = [('file', stat.S_IFREG, 11),
+                       ('subdir', stat.S_IFDIR, 12),
+                       ('file2', stat.S_IFREG, 13)]
 
         cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
-        cacheManagerMock.exists(DIRPATH).AndReturn(True)
-        cacheManagerMock.isDirectory(DIRPATH).AndReturn(True)
-        cacheManagerMock.listDirectory(DIRPATH).AndReturn(dir_entries)
+        lookup = self._lookup(DIRPATH, stat.S_IFDIR)
+        cacheManagerMock.lookup(DIRPATH).AndReturn(lookup)
+        cacheManagerMock.listDirectoryEntries(DIRPATH, lookup).AndReturn(dir_entries)
         mox.Replay(cacheManagerMock)
 
-        dir_entries_match = dir_entries + ['.', '..']
+        dir_entries_match = [name for name, fileType, ino in dir_entries] + ['.', '..']
         readdir_entries = []
 
         for entry in self.sut.readdir(DIRPATH, 0, ''):
             self.assertTrue(isinstance(entry, fuse.Direntry))
             self.assertTrue(entry.name in dir_entries_match)
             readdir_entries.append(entry.name)
+            if entry.name == 'subdir':
+                self.assertEqual(stat.S_IFDIR >> 12, entry.type)
+                self.assertEqual(12, entry.ino)
 
         self.assertEqual(sorted(dir_entries_match), sorted(readdir_entries))
 
@@ -60,7 +82,7 @@ class CacheFsUnitTest(unittest.TestCase):
         DIRPATH = '/DIR'
 
         cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
-        cacheManagerMock.exists(DIRPATH).AndReturn(False)
+        cacheManagerMock.lookup(DIRPATH).AndReturn(self._lookup(DIRPATH))
         mox.Replay(cacheManagerMock)
 
         self.assertEqual(None, self.sut.readdir(DIRPATH).next())
@@ -69,8 +91,7 @@ class CacheFsUnitTest(unittest.TestCase):
         DIRPATH = '/DIR'
 
         cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
-        cacheManagerMock.exists(DIRPATH).AndReturn(True)
-        cacheManagerMock.isDirectory(DIRPATH).AndReturn(False)
+        cacheManagerMock.lookup(DIRPATH).AndReturn(self._lookup(DIRPATH, stat.S_IFREG))
         mox.Replay(cacheManagerMock)
 
         self.assertEqual(None, self.sut.readdir(DIRPATH).next())
@@ -79,8 +100,7 @@ class CacheFsUnitTest(unittest.TestCase):
         DIRPATH = '/DIR'
 
         cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
-        cacheManagerMock.exists(DIRPATH).AndReturn(True)
-        cacheManagerMock.isDirectory(DIRPATH).AndReturn(True)
+        cacheManagerMock.lookup(DIRPATH).AndReturn(self._lookup(DIRPATH, stat.S_IFDIR))
         mox.Replay(cacheManagerMock)
 
         self.assertEqual(None, self.sut.opendir(DIRPATH))
@@ -89,8 +109,7 @@ class CacheFsUnitTest(unittest.TestCase):
         FILEPATH = '/FILE'
 
         cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
-        cacheManagerMock.exists(FILEPATH).AndReturn(True)
-        cacheManagerMock.isDirectory(FILEPATH).AndReturn(False)
+        cacheManagerMock.lookup(FILEPATH).AndReturn(self._lookup(FILEPATH, stat.S_IFREG))
         mox.Replay(cacheManagerMock)
 
         self.assertEqual(-errno.ENOENT, self.sut.opendir(FILEPATH))
@@ -99,9 +118,30 @@ class CacheFsUnitTest(unittest.TestCase):
         DIRPATH = '/DIR'
 
         cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
-        cacheManagerMock.exists(DIRPATH).AndReturn(False)
+        cacheManagerMock.lookup(DIRPATH).AndReturn(self._lookup(DIRPATH))
         mox.Replay(cacheManagerMock)
 
         self.assertEqual(-errno.ENOENT, self.sut.opendir(DIRPATH))
 
+    def test_statfs(self):
+        cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
+        cacheManagerMock.getFsStats().AndReturn(dict(f_bsize=4096, f_blocks=100, f_bfree=40))
+        mox.Replay(cacheManagerMock)
+
+        stats = self.sut.statfs()
+        self.assertTrue(isinstance(stats, fuse.StatVfs))
+        self.assertEqual(100, stats.f_blocks)
+        self.assertEqual(40, stats.f_bfree)
+
+    def test_readlink(self):
+        cacheManagerMock = self.sut.cacheManager = mox.MockObject(cachefs.CacheManager)
+        link = self._lookup('/link', stat.S_IFLNK)
+        link.target = 'target'
+        cacheManagerMock.lookup('/link').AndReturn(link)
+        cacheManagerMock.lookup('/file').AndReturn(self._lookup('/file', stat.S_IFREG))
+        cacheManagerMock.lookup('/none').AndReturn(self._lookup('/none'))
+        mox.Replay(cacheManagerMock)
 
+        self.assertEqual('target', self.sut.readlink('/link'))
+        self.assertEqual(-errno.EINVAL, self.sut.readlink('/file'))
+        self.assertEqual(-errno.ENOENT, self.sut.readlink('/none'))
@@ -0,0 +1,79 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import compressed_file
+from compressed_file import FrameCache, FrameReader, compressFile
+
+class CompressedFileUnitTest(unittest.TestCase):
+
+    FRAME_SIZE = 1000
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.workdir, 'src')
+        self.dst = os.path.join(self.workdir, 'dst')
+        rand = random.Random(0)
+        # compressible text followed by frames that don't shrink
+        self.content = ('line of text %d\n' * 200 % tuple(range(200))
+                        + ''.join(chr(rand.randint(0, 255)) for i in xrange(2500)))
+        with open(self.src, 'wb') as f:
+            f.write(self.content)
+        self.fds = []
+
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+        shutil.rmtree(self.workdir)
+
+    def openReader(self, path, cache=None):
+        fd = os.open(path, os.O_RDONLY)
+        self.fds.append(fd)
+        return FrameReader.open(fd, cache)
+
+    def test_randomReads(self):
+        for codec in compressed_file.CODECS:
+            size = compressFile(self.src, self.dst, codec, CompressedFileUnitTest.FRAME_SIZE)
+            self.assertEqual(os.lstat(self.dst).st_size, size)
+            self.assertTrue(size < len(self.content))
+
+            reader = self.openReader(self.dst, FrameCache(10 * CompressedFileUnitTest.FRAME_SIZE))
+            self.assertEqual(len(self.content), reader.size)
+            self.assertEqual(self.content, reader.read(len(self.content) + 100, 0))
+            for offset, length in [(0, 1), (999, 2), (1000, 1000), (1500, 3000),
+                                   (len(self.content) - 1, 10), (len(self.content), 10)]:
+                self.assertEqual(self.content[offset:offset + length], reader.read(length, offset))
+
+    def test_frameCache(self):
+        compressFile(self.src, self.dst, 'zlib', CompressedFileUnitTest.FRAME_SIZE)
+        cache = FrameCache(2 * CompressedFileUnitTest.FRAME_SIZE)
+        reader = self.openReader(self.dst, cache)
+        reader.read(10, 0)
+        reader.read(10, 500)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        reader.read(10, 1000)
+        reader.read(10, 2000) # first frame dropped
+        self.assertEqual(2, len(cache))
+        reader.read(10, 0)
+        self.assertEqual((1, 4), (cache.hits, cache.misses))
+
+        # other file doesn't see frames of this one
+        self.assertEqual(self.content[:10], self.openReader(self.dst, cache).read(10, 0))
+        self.assertEqual(5, cache.misses)
+
+    def test_emptyFile(self):
+        open(self.src, 'wb').close()
+        compressFile(self.src, self.dst, 'zlib', CompressedFileUnitTest.FRAME_SIZE)
+        reader = self.openReader(self.dst)
+        self.assertEqual(0, reader.size)
+        self.assertEqual('', reader.read(10, 0))
+
+    def test_notCompressed(self):
+        self.assertEqual(None, self.openReader(self.src))
+        compressFile(self.src, self.dst, 'zlib', CompressedFileUnitTest.FRAME_SIZE)
+        with open(self.dst, 'r+b') as f:
+            f.truncate(os.lstat(self.dst).st_size - 1)
+        self.assertEqual(None, self.openReader(self.dst))
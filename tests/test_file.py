@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+from file import File
+
+class FileUnitTest(unittest.TestCase):
+
+    CONTENT = ''.join(chr(i % 256) for i in range(10000))
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, FileUnitTest.CONTENT)
+        os.close(fd)
+        self.sut = File(os.open(self.path, os.O_RDONLY), 'file', os.lstat(self.path))
+
+    def tearDown(self):
+        os.close(self.sut.fh)
+        os.unlink(self.path)
+
+    def test_read_is_positional(self):
+        content = FileUnitTest.CONTENT
+        self.assertEqual(content[5000:5100], self.sut.read(100, 5000))
+        self.assertEqual(content[0:100], self.sut.read(100, 0))
+        self.assertEqual(content[9990:], self.sut.read(100, 9990))
+        self.assertEqual(0, os.lseek(self.sut.fh, 0, os.SEEK_CUR))
+
+    def test_stat_keeps_inode_of_source(self):
+        self.assertEqual(os.lstat(self.path).st_ino, File.createStat(os.lstat(self.path)).st_ino)
+
+    def test_small_reads_served_from_buffer(self):
+        content = FileUnitTest.CONTENT
+        self.sut.buffer_size = 4096
+        self.assertEqual(content[100:110], self.sut.read(10, 100))
+        self.assertEqual(100, self.sut.buffer_offset)
+        self.assertEqual(content[200:300], self.sut.read(100, 200))
+        self.assertEqual(100, self.sut.buffer_offset)
+
+        self.assertEqual(content[9000:9010], self.sut.read(10, 9000))
+        self.assertEqual(9000, self.sut.buffer_offset)
+        self.assertEqual(content[9995:], self.sut.read(10, 9995))
+        self.assertEqual(content[50:60], self.sut.read(10, 50))
@@ -0,0 +1,85 @@
+import os
+import stat
+import errno
+import shutil
+import tempfile
+import unittest
+
+import file_io
+from fill_engine import FillEngine
+
+class FillEngineUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.workdir, 'src')
+        self.dst = os.path.join(self.workdir, 'dst')
+        self.content = ''.join(chr(i % 251) for i in xrange(300000))
+        with open(self.src, 'wb') as f:
+            f.write(self.content)
+        os.chmod(self.src, 0750)
+        self.engine = FillEngine()
+        self.patched = {}
+
+    def tearDown(self):
+        for name, impl in self.patched.iteritems():
+            setattr(file_io, name, impl)
+        shutil.rmtree(self.workdir)
+
+    def disable(self, name, err):
+        calls = []
+        def unsupported(*args):
+            calls.append(args)
+            raise OSError(err, os.strerror(err))
+        self.patched.setdefault(name, getattr(file_io, name))
+        setattr(file_io, name, unsupported)
+        return calls
+
+    def test_fillFile(self):
+        self.assertEqual(len(self.content), self.engine.fillFile(self.src, self.dst))
+        self.assertEqual(self.content, open(self.dst, 'rb').read())
+        self.assertEqual(0750, stat.S_IMODE(os.lstat(self.dst).st_mode))
+        statistics = self.engine.getStatistics()
+        self.assertEqual(len(self.content), statistics['fill_bytes'])
+        self.assertEqual(1, sum(statistics['fill_%s_files' % method]
+                                for method in FillEngine.METHODS))
+
+    def test_fallback(self):
+        clones = self.disable('clone', errno.EOPNOTSUPP)
+        ranges = self.disable('copy_file_range', errno.EXDEV)
+        self.engine.fillFile(self.src, self.dst)
+        self.assertEqual(self.content, open(self.dst, 'rb').read())
+        self.assertEqual(1, self.engine.getStatistics()['fill_sendfile_files'])
+
+        # methods found unsupported are not tried again
+        self.disable('sendfile', errno.ENOSYS)
+        self.engine.fillFile(self.src, self.dst)
+        self.assertEqual(self.content, open(self.dst, 'rb').read())
+        self.assertEqual((1, 1), (len(clones), len(ranges)))
+        self.assertEqual(1, self.engine.getStatistics()['fill_copy_files'])
+
+    def test_realErrorRaised(self):
+        self.disable('clone', errno.EOPNOTSUPP)
+        self.disable('copy_file_range', errno.EIO)
+        self.assertRaises(OSError, self.engine.fillFile, self.src, self.dst)
+
+    def test_fillRange(self):
+        self.disable('clone', errno.EOPNOTSUPP)
+        for method in ['copy_file_range', 'sendfile', None]:
+            with open(self.dst, 'wb') as f:
+                f.truncate(len(self.content))
+            srcFd = os.open(self.src, os.O_RDONLY)
+            dstFd = os.open(self.dst, os.O_WRONLY)
+            try:
+                self.assertEqual(1000, self.engine.fillRange(srcFd, dstFd, 70000, 1000))
+                # source shorter than requested
+                self.assertEqual(5, self.engine.fillRange(srcFd, dstFd, len(self.content) - 5, 100))
+            finally:
+                os.close(srcFd)
+                os.close(dstFd)
+            content = open(self.dst, 'rb').read()
+            self.assertEqual(self.content[70000:71000], content[70000:71000])
+            self.assertEqual('\0' * 1000, content[69000:70000])
+            self.assertEqual(self.content[-5:], content[-5:])
+            if method:
+                self.disable(method, errno.ENOSYS)
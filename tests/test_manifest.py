@@ -0,0 +1,47 @@
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from manifest import Manifest
+
+class ManifestUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, '.cache_manifest')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_saveAndLoad(self):
+        dirStat = os.lstat(self.workdir)
+        fileStat = os.lstat(__file__)
+        Manifest(self.path, [('dir', stat.S_IFDIR, dirStat),
+                             ('file.txt', stat.S_IFREG, fileStat)], timestamp=1234.5).save()
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        loaded = Manifest.load(self.path)
+        self.assertEqual(1234.5, loaded.timestamp)
+        self.assertEqual(2, len(loaded))
+        self.assertEqual(['dir', 'file.txt'], sorted(loaded.names()))
+        self.assertTrue('dir' in loaded)
+        self.assertFalse('missing' in loaded)
+        self.assertEqual(None, loaded.get('missing'))
+
+        fileType, st = loaded.get('file.txt')
+        self.assertEqual(stat.S_IFREG, fileType)
+        self.assertEqual(fileStat.st_size, st.st_size)
+        self.assertEqual(fileStat.st_ino, st.st_ino)
+        self.assertEqual(fileStat.st_mtime, st.st_mtime)
+        self.assertEqual(stat.S_IFDIR, loaded.get('dir')[0])
+
+    def test_emptyDirectory(self):
+        Manifest(self.path).save()
+        self.assertEqual([], Manifest.load(self.path).entries())
+
+    def test_notManifest(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 64)
+        self.assertRaises(ValueError, Manifest.load, self.path)
@@ -3,6 +3,17 @@ import memory_cache
 import unittest
 from test_helper import TestHelper
 import time
+import os
+import shutil
+import tempfile
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
 
 class CacheFsUnitTest(unittest.TestCase):
 
@@ -60,5 +71,169 @@ class CacheFsUnitTest(unittest.TestCase):
         memory_cache.markAsChildrenCached('/home', True)
         self.assertEqual(['a', 'b'], memory_cache.listDirectory('/home'))
 
+    def test_memory_cache_max_entries(self):
+        memory_cache = cachefs.MemoryCache(self.sut.cfg.cache_manager.memory_cache_lifetime, 3)
+        memory_cache.cacheAttributes('/', 1)
+        memory_cache.cacheAttributes('/home', 2)
+        memory_cache.cacheAttributes('/home/a', 3)
+        memory_cache.markAsChildrenCached('/home', True)
+        memory_cache.cacheAttributes('/tmp', 4)
+        memory_cache.markAsChildrenCached('/', True)
+        self.assertEqual(3, len(memory_cache))
+        self.assertEqual(0, memory_cache.evictions)
+
+        # all entries were referenced, /home is evicted with its subtree
+        # after second pass of the clock hand
+        memory_cache.cacheAttributes('/var', 5)
+        self.assertEqual(1, memory_cache.evictions)
+        self.assertEqual(None, memory_cache.getAttributes('/home/a'))
+        self.assertEqual(5, memory_cache.getAttributes('/var').stat)
+        self.assertTrue(len(memory_cache) <= 3)
+        self.assertFalse(memory_cache.getAttributes('/').has_all_children)
+
+    def test_memory_cache_path_normalization(self):
+        memory_cache = self._create_memory_cache()
+        memory_cache.cacheAttributes('/', 1)
+        memory_cache.cacheAttributes('//home//a/', 2)
+        self.assertEqual(2, memory_cache.getAttributes('/home/a').stat)
+        self.assertEqual(2, memory_cache.getAttributes('home/a').stat)
+        self.assertEqual(2, len(memory_cache))
+
+        memory_cache._remove_subtree(memory_cache.getAttributes('/home'))
+        self.assertEqual(None, memory_cache.getAttributes('/home/a'))
+        self.assertEqual(0, len(memory_cache))
+
+    def test_memory_cache_negative_entries(self):
+        memory_cache = cachefs.MemoryCache(60, negative_lifetime=10, negative_max_entries=1)
+        memory_cache.cacheAttributes('/', 1)
+        self.assertFalse(memory_cache.isMissing('/a.h'))
+
+        memory_cache.cacheMissing('/a.h')
+        self.assertTrue(memory_cache.isMissing('/a.h'))
+        memory_cache.cacheMissing('/b.h') # pushes out /a.h
+        self.assertFalse(memory_cache.isMissing('/a.h'))
+        self.assertTrue(memory_cache.isMissing('/b.h'))
+
+        memory_cache.cacheAttributes('/b.h', 2)
+        self.assertFalse(memory_cache.isMissing('/b.h'))
+
+    def test_memory_cache_missing_in_complete_directory(self):
+        memory_cache = self._create_memory_cache()
+        memory_cache.cacheAttributes('/', 1)
+        memory_cache.cacheAttributes('/include/a.h', 2)
+        self.assertFalse(memory_cache.isMissing('/include/b.h'))
+
+        memory_cache.markAsChildrenCached('/include', True)
+        self.assertTrue(memory_cache.isMissing('/include/b.h'))
+        self.assertFalse(memory_cache.isMissing('/include/a.h'))
+        self.assertEqual(1, memory_cache.negative_hits)
+
+    def test_memory_cache_expire(self):
+        clock = Clock()
+        cachefs.memory_cache.time = clock
+        memory_cache = cachefs.MemoryCache(10)
+        memory_cache.cacheAttributes('/', 1)
+        memory_cache.cacheAttributes('/old', 2)
+        clock.now += 5
+        memory_cache.cacheAttributes('/', 1)
+        memory_cache.cacheAttributes('/new', 3)
+        memory_cache.markAsChildrenCached('/', True)
+
+        clock.now += 6
+        self.assertEqual(1, memory_cache.expire())
+        self.assertEqual(None, memory_cache.getAttributes('/old'))
+        self.assertEqual(3, memory_cache.getAttributes('/new').stat)
+        self.assertFalse(memory_cache.getAttributes('/').has_all_children)
+
+        clock.now += 5
+        memory_cache.expire()
+        self.assertEqual(None, memory_cache.getAttributes('/'))
+        self.assertEqual(0, len(memory_cache))
+
+    def test_memory_cache_invalidate(self):
+        memory_cache = self._create_memory_cache()
+        memory_cache.cacheAttributes('/', 1)
+        memory_cache.cacheAttributes('/src/a/b', 2)
+        memory_cache.cacheAttributes('/src/c', 3)
+        memory_cache.cacheAttributes('/doc', 4)
+        memory_cache.markAsChildrenCached('/', True)
+
+        memory_cache.invalidate('/src')
+        self.assertEqual(None, memory_cache.getAttributes('/src'))
+        self.assertEqual(None, memory_cache.getAttributes('/src/a/b'))
+        self.assertEqual(4, memory_cache.getAttributes('/doc').stat)
+        self.assertFalse(memory_cache.getAttributes('/').has_all_children)
+
+        memory_cache.cacheAttributes('/src/c', 5)
+        self.assertEqual(5, memory_cache.getAttributes('/src/c').stat)
+        self.assertEqual(None, memory_cache.getAttributes('/src/a'))
+
+        memory_cache.expire()
+        self.assertEqual(3, len(memory_cache)) # /doc, /src, /src/c
+        self.assertEqual(None, memory_cache.getAttributes('/src/a/b'))
+
+        memory_cache.invalidate('/')
+        self.assertEqual(None, memory_cache.getAttributes('/'))
+        self.assertEqual(None, memory_cache.getAttributes('/doc'))
+        memory_cache.expire()
+        self.assertEqual(0, len(memory_cache))
+
+    def test_memory_cache_snapshot(self):
+        clock = Clock()
+        cachefs.memory_cache.time = clock
+        snapshot = os.path.join(tempfile.mkdtemp(), 'snapshot')
+        st = os.lstat('.')
+
+        memory_cache = cachefs.MemoryCache(10)
+        memory_cache.cacheAttributes('/', st)
+        memory_cache.cacheAttributes('/dir', st)
+        memory_cache.cacheLinkTarget('/dir/link', 'target')
+        memory_cache.markAsChildrenCached('/dir', True)
+        clock.now += 5
+        memory_cache.cacheAttributes('/', st) # refreshes root
+        memory_cache.cacheAttributes('/new', st)
+        memory_cache.save(snapshot)
+
+        clock.now += 3 # /dir is 8 seconds old now and /new 3 seconds
+        restored = cachefs.MemoryCache(10)
+        restored.load(snapshot)
+        self.assertEqual(st, restored.getAttributes('/').stat)
+        self.assertEqual('target', restored.readLink('/dir/link').target)
+        self.assertTrue(restored.getAttributes('/dir').has_all_children)
+        self.assertEqual(3, len(restored))
+
+        clock.now += 3
+        restored.expire()
+        self.assertEqual(None, restored.getAttributes('/dir'))
+        self.assertEqual(st, restored.getAttributes('/new').stat)
+
+        restored = cachefs.MemoryCache(10)
+        restored.load(snapshot)
+        self.assertEqual(None, restored.getAttributes('/dir'))
+        self.assertFalse(restored.getAttributes('/').has_all_children)
+        shutil.rmtree(os.path.dirname(snapshot))
+
+    def test_memory_cache_snapshot_skips_placeholders(self):
+        snapshot = os.path.join(tempfile.mkdtemp(), 'snapshot')
+        st = os.lstat('.')
+
+        memory_cache = cachefs.MemoryCache(10)
+        memory_cache.cacheAttributes('/', st)
+        memory_cache.cacheAttributes('/file', st)
+        memory_cache.cacheAttributes('/dir/sub/file', st) # /dir and /dir/sub are placeholders
+        memory_cache.markAsChildrenCached('/', True)
+        memory_cache.save(snapshot)
+
+        restored = cachefs.MemoryCache(10)
+        restored.load(snapshot)
+        self.assertEqual(st, restored.getAttributes('/file').stat)
+        self.assertEqual(None, restored.getAttributes('/dir'))
+        self.assertEqual(None, restored.getAttributes('/dir/sub/file'))
+        # /dir is not known, so root can't tell it doesn't exist
+        self.assertFalse(restored.getAttributes('/').has_all_children)
+        self.assertFalse(restored.isMissing('/dir'))
+        self.assertEqual(1, len(restored))
+        shutil.rmtree(os.path.dirname(snapshot))
+
     def _create_memory_cache(self):
         return cachefs.MemoryCache(self.sut.cfg.cache_manager.memory_cache_lifetime)
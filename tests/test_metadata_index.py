@@ -0,0 +1,77 @@
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from metadata_index import MetadataIndex
+
+class MetadataIndexUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'cache.index')
+        self.index = MetadataIndex(self.path)
+        self.st = os.lstat(__file__)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.workdir)
+
+    def test_listingAndStates(self):
+        self.assertTrue(self.index.isEmpty())
+        self.index.recordListing('/dir', [('a', stat.S_IFREG, self.st),
+                                          ('b', stat.S_IFREG, self.st),
+                                          ('sub', stat.S_IFDIR, self.st)])
+        self.index.setState('/dir/a', stat.S_IFREG, MetadataIndex.POPULATED, 10, now=100)
+        self.index.setState('/dir/b', stat.S_IFREG, MetadataIndex.PARTIAL, now=200)
+
+        entry = self.index.get('/dir/a')
+        self.assertEqual((stat.S_IFREG, 10, 100, 100, MetadataIndex.POPULATED),
+                         (entry.type, entry.size, entry.fetched, entry.accessed, entry.state))
+        self.assertEqual(self.st.st_mtime, entry.mtime)
+        self.assertEqual(MetadataIndex.UNFETCHED, self.index.get('/dir/sub').state)
+        self.assertEqual(None, self.index.get('/dir/missing'))
+
+        usage = self.index.usage()
+        self.assertEqual(3, usage['entries'])
+        self.assertEqual((1, self.st.st_size), (usage['partial_files'], usage['partial_bytes']))
+        self.assertEqual((1, 10), (usage['populated_files'], usage['populated_bytes']))
+        self.assertEqual(0, usage['unfetched_files'])
+
+        # listing again keeps what is fetched
+        self.index.recordListing('/dir', [('a', stat.S_IFREG, self.st)])
+        self.assertEqual(MetadataIndex.POPULATED, self.index.get('/dir/a').state)
+
+    def test_leastRecentlyUsed(self):
+        for idx, name in enumerate(['a', 'b', 'c']):
+            self.index.setState('/' + name, stat.S_IFREG, MetadataIndex.POPULATED, 1, now=idx)
+        self.index.touch('/a', now=10)
+        self.assertEqual(['/b', '/c'], [path for path, size in self.index.leastRecentlyUsed(2)])
+        self.assertEqual(['/c', '/a'], [path for path, size in self.index.leastRecentlyUsed(offset=1)])
+        self.index.setUnfetched('/b')
+        self.assertEqual(['/c', '/a'], [path for path, size in self.index.leastRecentlyUsed()])
+
+    def test_removeTree(self):
+        for path in ['/d', '/d/x', '/d/x/y', '/d0', '/e']:
+            self.index.setState(path, stat.S_IFREG, MetadataIndex.POPULATED)
+        self.index.removeTree('/d')
+        self.assertEqual(None, self.index.get('/d/x/y'))
+        self.assertEqual(None, self.index.get('/d'))
+        self.assertNotEqual(None, self.index.get('/d0'))
+        self.index.removeTree('/')
+        self.assertTrue(self.index.isEmpty())
+
+    def test_reopen(self):
+        self.index.setState('/a', stat.S_IFREG, MetadataIndex.POPULATED)
+        self.index.touch('/a', now=1234)
+        self.index.close()
+        self.index = MetadataIndex(self.path)
+        self.assertEqual(1234, self.index.get('/a').accessed)
+
+    def test_corrupted(self):
+        self.index.close()
+        with open(self.path, 'wb') as f:
+            f.write('garbage' * 1000)
+        self.index = MetadataIndex(self.path)
+        self.assertTrue(self.index.isEmpty())
@@ -11,6 +11,8 @@ import tempfile
 import stat
 import errno
 import logging
+import threading
+import copy
 
 import unittest
 import mox
@@ -27,6 +29,11 @@ import mocks.time_mock
 from test_helper import TestHelper
 import disk_cache
 import path_factory
+import fs_stats
+import cachefs_warm
+import file_io
+from open_file_table import OpenFileTable
+from compressed_file import FrameCache
 
 class ModuleTestCase(unittest.TestCase):
 
@@ -130,24 +137,790 @@ class ListDir(CacheManagerModuleTest):
         self.assertEqual(sorted(input), sorted(listDir_out))
 
         cache_root_path = self.sut._cfg.cache_root_dir
-        cache_dir_walker = disk_cache.CachedDirWalker(cache_root_path)
-        path_transformer = path_factory.PathTransformer()
+        cached_dir_path = cache_root_path + dir_path
 
-        cached_subdir_path = os.sep.join(
-            [cache_root_path, dir_path, path_transformer.transformDirpath(subdir_name)])
+        # listing is kept in manifest, nothing is created for entries not cached yet
+        self.assertEqual(['.cache_manifest'], os.listdir(cached_dir_path))
+        manifest_path = path_factory.PathFactory(self.sut._cfg).createPathToDiskCacheManifest(dir_path)
+        manifest = disk_cache.Manifest.load(manifest_path)
+        self.assertEqual(sorted(input), sorted(manifest.names()))
+        self.assertEqual(stat.S_IFDIR, manifest.get(subdir_name)[0])
+        self.assertEqual(stat.S_IFREG, manifest.get(file_name)[0])
 
-        self.assertTrue(os.path.exists(cached_subdir_path))
-
-        cached_file_path = os.sep.join(
-            [cache_root_path, path_transformer.transformFilepath(file_name)])
-
-        self.assertFalse(os.path.exists(cached_file_path))
+        self.assertTrue(self.sut.isDirectory(dir_path2))
+        self.assertFalse(self.sut.exists(os.sep.join([dir_path, 'missing'])))
 
 
 class Getattr(CacheManagerModuleTest):
     def test(self):
         self.sut.getAttributes('.')
 
+class Lookup(CacheManagerModuleTest):
+    def test(self):
+        dir_path = '/TestCacheManager.test_lookup'
+        TestHelper.create_source_dir(self.cfg.cache_manager, dir_path)
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/file', 'content')
+        os.symlink('file', os.sep.join([self.cfg.cache_manager.source_dir, dir_path, 'link']))
+
+        lookup = self.sut.lookup(dir_path)
+        self.assertTrue(lookup.exists)
+        self.assertTrue(lookup.isDirectory)
+        self.assertTrue(lookup.childrenCached)
+
+        lookup = self.sut.lookup(dir_path + '/link')
+        self.assertTrue(lookup.isLink)
+        self.assertEqual('file', lookup.target)
+
+        lookup = self.sut.lookup(dir_path + '/file')
+        self.assertFalse(lookup.isDirectory)
+        self.assertEqual(len('content'), lookup.stat.st_size)
+
+        self.assertFalse(self.sut.lookup(dir_path + '/missing').exists)
+
+class LookupAfterEviction(CacheManagerModuleTest):
+    def test(self):
+        TestHelper.create_source_dir(self.cfg.cache_manager, '/a')
+        TestHelper.create_source_dir(self.cfg.cache_manager, '/a/b')
+        TestHelper.create_source_file(self.cfg.cache_manager, '/a/b/c', 'content')
+        for path in ['/a', '/a/b', '/a/b/c']:
+            self.assertTrue(self.sut.lookup(path).exists)
+
+        memoryCache = self.sut._memoryCache
+        with memoryCache._lock:
+            memoryCache._remove_subtree(memoryCache._index['/a'])
+
+        # ancestors are recreated as placeholders without stat
+        self.assertTrue(self.sut.lookup('/a/b/c').exists)
+        self.assertTrue(self.sut.lookup('/a').isDirectory)
+        self.assertTrue(self.sut.lookup('/a/b').isDirectory)
+
+class ConcurrentFetch(CacheManagerModuleTest):
+    def test(self):
+        file_path = '/TestCacheManager.test_concurrentFetch.bin'
+        content = 'x' * 2**20
+        TestHelper.create_source_file(self.cfg.cache_manager, file_path, content)
+        self.sut.getAttributes(file_path)
+
+        results = []
+        def fetch():
+            results.append(self.sut.getPathToCachedFile(file_path))
+
+        threads = [threading.Thread(target=fetch) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(content, open(results[0]).read())
+
+class ConcurrentListing(CacheManagerModuleTest):
+
+    def test(self):
+        cfg = self.cfg.cache_manager
+        for dir_path in ['/slow', '/fast']:
+            TestHelper.create_source_dir(cfg, dir_path)
+            TestHelper.create_source_file(cfg, dir_path + '/file', 'content')
+        TestHelper.create_source_file(cfg, '/file', 'content')
+        diskCache = self.sut._diskCache
+        diskCache.cacheDirectory('/')
+
+        listing = threading.Event()
+        proceed = threading.Event()
+        listings = []
+        createWalker = diskCache._createDirectoryWalker
+        def slowWalker(rootpath, path):
+            listings.append(path)
+            if path == '/slow':
+                listing.set()
+                proceed.wait()
+            return createWalker(rootpath, path)
+        diskCache._createDirectoryWalker = slowWalker
+
+        threads = [threading.Thread(target=diskCache.cacheDirectory, args=('/slow',))
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(listing.wait(5))
+        # slow listing doesn't hold up other directories and files
+        results = []
+        def other():
+            diskCache.cacheDirectory('/fast')
+            results.append(open(diskCache.getPathToCachedFile('/file')).read())
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join(5)
+        finished = list(results)
+        proceed.set()
+        for thread in threads + [thread]:
+            thread.join()
+        self.assertEqual(['content'], finished)
+        self.assertEqual(['/slow', '/fast'], listings)
+        self.assertEqual(['file'], diskCache.listDirectory('/slow'))
+
+class SingleFlightFetch(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        CacheManagerModuleTest.setUpImpl(self)
+        self.diskCache = self.sut._diskCache
+        self.fill = self.diskCache._fill
+        self.fills = []
+
+    def slowFill(self, src, tmp):
+        self.fills.append(tmp)
+        time.sleep(0.2) # other threads arrive meanwhile
+        return self.fill(src, tmp)
+
+    def failingFill(self, src, tmp):
+        self.fills.append(tmp)
+        with open(tmp, 'wb') as f:
+            f.write('trunc') # interrupted in the middle
+        time.sleep(0.2)
+        raise IOError(errno.EIO, 'Input/output error')
+
+    def fetchConcurrently(self, path):
+        results = []
+        def fetch():
+            try:
+                results.append(self.sut.getPathToCachedFile(path))
+            except EnvironmentError, e:
+                results.append(e.errno)
+        threads = [threading.Thread(target=fetch) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test(self):
+        cfg = self.cfg.cache_manager
+        TestHelper.create_source_file(cfg, '/file', 'content')
+        TestHelper.create_source_file(cfg, '/failing', 'content')
+        self.sut.getAttributes('/file')
+        pathToCache = path_factory.PathFactory(cfg).createPathToDiskCache('/failing')
+        fillDirectory = path_factory.PathFactory(cfg).createPathToFillDirectory()
+
+        self.diskCache._fill = self.slowFill
+        results = self.fetchConcurrently('/file')
+        self.assertEqual(1, len(self.fills))
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual('content', open(results[0]).read())
+
+        # waiters get error of the fetch, nothing looks cached
+        self.diskCache._fill = self.failingFill
+        self.assertEqual([errno.EIO] * 8, self.fetchConcurrently('/failing'))
+        self.assertEqual(2, len(self.fills))
+        self.assertFalse(os.path.lexists(pathToCache))
+        self.assertEqual([], os.listdir(fillDirectory))
+
+        self.diskCache._fill = self.fill
+        self.assertEqual('content', open(self.sut.getPathToCachedFile('/failing')).read())
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(cfg.cache_root_dir)
+        self.assertEqual(scanned.get(), self.diskCache.usage.get())
+
+        # fetch of crashed process is removed on start, the one of live process stays
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        open(os.path.join(fillDirectory, '%d.0' % pid), 'wb').close()
+        open(os.path.join(fillDirectory, '%d.0' % os.getppid()), 'wb').close()
+        disk_cache.DiskCache(cfg, cachefs_warm.NoMemoryCache()).close()
+        self.assertEqual(['%d.0' % os.getppid()], os.listdir(fillDirectory))
+
+class CacheUsage(CacheManagerModuleTest):
+    def test(self):
+        dir_path = '/TestCacheManager.test_cacheUsage'
+        file_path = os.sep.join([dir_path, 'file'])
+        TestHelper.create_source_dir(self.cfg.cache_manager, dir_path)
+        TestHelper.create_source_file(self.cfg.cache_manager, file_path, 'x' * 12345)
+
+        self.sut.getAttributes(file_path)
+        self.sut.getPathToCachedFile(file_path)
+
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(self.cfg.cache_manager.cache_root_dir)
+        self.assertEqual(scanned.get(), self.sut._diskCache.usage.get())
+
+        stats = self.sut.getFsStats()
+        self.assertTrue(stats['f_bfree'] <= stats['f_blocks'])
+        self.assertTrue(stats['f_files'] >= scanned.inodes)
+
+class Invalidate(CacheManagerModuleTest):
+    def test(self):
+        dir_path = '/TestCacheManager.test_invalidate'
+        TestHelper.create_source_dir(self.cfg.cache_manager, dir_path)
+        TestHelper.create_source_dir(self.cfg.cache_manager, dir_path + '/sub')
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/sub/old', 'old')
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/file', 'v1')
+
+        self.assertTrue(self.sut.lookup(dir_path + '/sub/old').exists)
+        self.assertEqual('v1', open(self.sut.getPathToCachedFile(dir_path + '/file')).read())
+        generation = self.sut.getFileGeneration(dir_path + '/file')
+
+        # republish source
+        source_dir = self.cfg.cache_manager.source_dir + dir_path
+        os.remove(source_dir + '/sub/old')
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/sub/new', 'new')
+        os.remove(source_dir + '/file')
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/file', 'v2')
+
+        self.sut.invalidate(dir_path)
+
+        self.assertFalse(self.sut.lookup(dir_path + '/sub/old').exists)
+        self.assertTrue(self.sut.lookup(dir_path + '/sub/new').exists)
+        self.assertEqual(['new'], self.sut.listDirectory(dir_path + '/sub'))
+        self.assertEqual('v2', open(self.sut.getPathToCachedFile(dir_path + '/file')).read())
+        self.assertNotEqual(generation, self.sut.getFileGeneration(dir_path + '/file'))
+
+        self.sut.expire()
+        self.assertTrue(self.sut.lookup(dir_path + '/sub/new').exists)
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(self.cfg.cache_manager.cache_root_dir)
+        self.assertEqual(scanned.get(), self.sut._diskCache.usage.get())
+
+class PrivateDirectory(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.dedup = True
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def test(self):
+        cfg = self.cfg.cache_manager
+        factory = path_factory.PathFactory(cfg)
+        TestHelper.create_source_dir(cfg, '/dir')
+        TestHelper.create_source_file(cfg, '/dir/file', 'content')
+        TestHelper.create_source_file(cfg, '/file', 'content')
+        self.assertEqual('content', open(self.sut.getPathToCachedFile('/dir/file')).read())
+        self.assertEqual('content', open(self.sut.getPathToCachedFile('/file')).read())
+
+        # renames and links never cross devices, even with cache root mounted
+        private = factory.createPathToPrivateDirectory()
+        self.assertEqual(cfg.cache_root_dir, os.path.dirname(private))
+        for path in [factory.createPathToFillDirectory(), factory.createPathToBlobStore()]:
+            self.assertEqual(private, os.path.dirname(path))
+            self.assertTrue(os.path.isdir(path))
+        self.assertEqual(['dir', 'file'], sorted(self.sut.listDirectory('/')))
+
+        self.sut.invalidate('/')
+        self.assertTrue(os.path.isdir(factory.createPathToGraveyard()))
+        self.assertEqual([path_factory.PathFactory.PRIVATE], os.listdir(cfg.cache_root_dir))
+        self.sut.expire()
+        self.assertEqual([], os.listdir(factory.createPathToGraveyard()))
+        self.assertEqual(['dir', 'file'], sorted(self.sut.listDirectory('/')))
+        self.assertEqual('content', open(self.sut.getPathToCachedFile('/dir/file')).read())
+
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(cfg.cache_root_dir, factory.createPathToBlobStore())
+        self.assertEqual(scanned.get(), self.sut._diskCache.usage.get())
+
+    def test_legacy_directories_moved_in(self):
+        cfg = self.cfg.cache_manager
+        factory = path_factory.PathFactory(cfg)
+        graveyard = factory.createPathToGraveyard()
+        legacy = factory.createLegacyPathToPrivateDirectory(graveyard)
+        os.makedirs(os.path.join(legacy, 'grave', 'data'))
+
+        restarted = cachefs.CacheManager(cfg)
+        self.assertFalse(os.path.exists(legacy))
+        self.assertEqual(['grave'], os.listdir(graveyard))
+        restarted.expire()
+        self.assertEqual([], os.listdir(graveyard))
+
+class Snapshot(CacheManagerModuleTest):
+    def test(self):
+        dir_path = '/TestCacheManager.test_snapshot'
+        TestHelper.create_source_dir(self.cfg.cache_manager, dir_path)
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/file', 'content')
+        st = self.sut.lookup(dir_path + '/file').stat
+        self.sut.saveSnapshot()
+
+        restarted = cachefs.CacheManager(self.cfg.cache_manager)
+        restarted.loadSnapshot()
+        os.remove(self.cfg.cache_manager.source_dir + dir_path + '/file')
+        self.assertEqual(st, restarted.lookup(dir_path + '/file').stat)
+        self.assertTrue(restarted.lookup(dir_path).childrenCached)
+
+        restarted.loadSnapshot() # used only once
+        self.assertEqual(st, restarted.lookup(dir_path + '/file').stat)
+
+class DiskCacheRevalidation(CacheManagerModuleTest):
+
+    class Clock(object):
+        def __init__(self):
+            self.now = 1000.0
+        def time(self):
+            return self.now
+
+    def setUpImpl(self):
+        CacheManagerModuleTest.setUpImpl(self)
+        self.clock = DiskCacheRevalidation.Clock()
+        disk_cache.time = self.clock
+
+    def tearDownImpl(self):
+        disk_cache.time = time
+
+    def test(self):
+        dir_path = '/TestCacheManager.test_diskCacheRevalidation'
+        cfg = self.cfg.cache_manager
+        TestHelper.create_source_dir(cfg, dir_path)
+        TestHelper.create_source_dir(cfg, dir_path + '/sub')
+        TestHelper.create_source_file(cfg, dir_path + '/sub/file', 'sub')
+        for name in ['same', 'changed', 'removed']:
+            TestHelper.create_source_file(cfg, dir_path + '/' + name, name)
+        diskCache = self.sut._diskCache
+
+        self.assertTrue(self.sut.lookup(dir_path + '/sub/file').exists)
+        cached = dict((name, diskCache.getPathToCachedFile(dir_path + '/' + name))
+                      for name in ['same', 'changed', 'removed', 'sub/file'])
+        inodes = dict((name, os.lstat(path).st_ino) for name, path in cached.items())
+        generation = diskCache.getFileGeneration(dir_path + '/changed')
+
+        source_dir = cfg.source_dir + dir_path
+        TestHelper.create_source_file(cfg, dir_path + '/changed', 'changed again')
+        os.remove(source_dir + '/removed')
+        TestHelper.create_source_file(cfg, dir_path + '/added', 'added')
+
+        # still within lifetime
+        self.clock.now += cfg.disk_cache_lifetime - 1
+        self.assertTrue(diskCache.exists(dir_path + '/removed'))
+        self.assertEqual('changed', open(diskCache.getPathToCachedFile(dir_path + '/changed')).read())
+
+        self.clock.now += 1
+        self.assertEqual(['added', 'changed', 'same', 'sub'], sorted(diskCache.listDirectory(dir_path)))
+        self.assertFalse(diskCache.exists(dir_path + '/removed'))
+        self.assertFalse(os.path.lexists(cached['removed']))
+        self.assertEqual(len('changed again'), diskCache.getAttributes(dir_path + '/changed').st_size)
+        self.assertEqual('changed again', open(diskCache.getPathToCachedFile(dir_path + '/changed')).read())
+        self.assertNotEqual(generation, diskCache.getFileGeneration(dir_path + '/changed'))
+
+        # unchanged entries are not fetched again
+        self.assertEqual(inodes['same'], os.lstat(diskCache.getPathToCachedFile(dir_path + '/same')).st_ino)
+        self.assertEqual(inodes['sub/file'], os.lstat(diskCache.getPathToCachedFile(dir_path + '/sub/file')).st_ino)
+
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(cfg.cache_root_dir)
+        self.assertEqual(scanned.get(), diskCache.usage.get())
+
+class CapacityLimit(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.cache_max_bytes = 10 * 4096
+        self.cfg.cache_manager.cache_high_watermark = 90
+        self.cfg.cache_manager.cache_low_watermark = 50
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def test(self):
+        dir_path = '/TestCacheManager.test_capacityLimit'
+        cfg = self.cfg.cache_manager
+        TestHelper.create_source_dir(cfg, dir_path)
+        names = ['file%d' % idx for idx in range(4)]
+        for name in names:
+            TestHelper.create_source_file(cfg, dir_path + '/' + name, name[-1] * 3 * 4096)
+        evicted = []
+        self.sut.setEvictionCallback(evicted.append)
+
+        pinned = self.sut.getPathToCachedFile(dir_path + '/file0', pin=True)
+        cached = [self.sut.getPathToCachedFile(dir_path + '/' + name) for name in names[1:3]]
+        self.sut.getPathToCachedFile(dir_path + '/file1') # most recently used now
+        self.assertEqual(0, self.sut.getStatistics()['disk_cache_evicted_files'])
+
+        # doesn't fit, file2 goes as file0 is pinned
+        self.sut.getPathToCachedFile(dir_path + '/file3')
+        self.assertEqual([cached[1]], evicted)
+        self.assertFalse(os.path.lexists(cached[1]))
+        self.assertTrue(os.path.lexists(pinned))
+        self.assertTrue(self.sut._diskCache.usage.bytes <= cfg.cache_max_bytes)
+
+        # evicted file is still listed and fetched again on access
+        self.assertEqual(sorted(names), sorted(self.sut.listDirectory(dir_path)))
+        self.assertTrue(self.sut.lookup(dir_path + '/file2').exists)
+        self.assertEqual('2' * 3 * 4096, open(self.sut.getPathToCachedFile(dir_path + '/file2')).read())
+        self.assertTrue(os.path.lexists(pinned))
+
+        self.sut.unpin(dir_path + '/file0')
+        self.sut._diskCache.evict()
+        self.assertFalse(os.path.lexists(pinned))
+        # nothing is kept for files no longer cached
+        self.assertEqual(0, self.sut.getFileGeneration(dir_path + '/file0'))
+        self.assertEqual(set(dir_path + '/' + name for name in names
+                             if os.path.lexists(cfg.cache_root_dir + dir_path + '/' + name)),
+                         set(self.sut._diskCache._generations))
+        self.assertTrue(self.sut._diskCache.usage.bytes <= cfg.cache_max_bytes // 2)
+
+        stats = self.sut.getStatistics()
+        self.assertEqual(len(evicted), stats['disk_cache_evicted_files'])
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(cfg.cache_root_dir)
+        self.assertEqual(scanned.get(), self.sut._diskCache.usage.get())
+
+class CapacityLimitManyPinned(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.cache_max_bytes = 100 * 4096
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def test(self):
+        cfg = self.cfg.cache_manager
+        count = disk_cache.DiskCache.EVICTION_BATCH + 36
+        for idx in range(count + 1):
+            TestHelper.create_source_file(cfg, '/file%d' % idx, 'x' * 4096)
+        for idx in range(count):
+            self.sut.getPathToCachedFile('/file%d' % idx, pin=True)
+
+        # nothing can go, eviction gives up instead of spinning
+        self.assertEqual(0, self.sut._diskCache.evict(0))
+        cached = self.sut.getPathToCachedFile('/file%d' % count)
+        self.assertEqual('x' * 4096, open(cached).read())
+
+        self.sut.unpin('/file0')
+        self.assertEqual(2, self.sut._diskCache.evict(self.sut._diskCache.usage.bytes - 2 * 4096))
+        self.assertFalse(os.path.lexists(cached))
+
+class Dedup(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.dedup = True
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def assertUsageConsistent(self):
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(self.cfg.cache_manager.cache_root_dir,
+                     path_factory.PathFactory(self.cfg.cache_manager).createPathToBlobStore())
+        self.assertEqual(scanned.get(), self.sut._diskCache.usage.get())
+
+    def test(self):
+        cfg = self.cfg.cache_manager
+        content = 'vendored library ' * 1000
+        for branch in ['/branch1', '/branch2']:
+            TestHelper.create_source_dir(cfg, branch)
+            TestHelper.create_source_file(cfg, branch + '/lib', content)
+            TestHelper.create_source_file(cfg, branch + '/version', branch)
+
+        paths = [self.sut.getPathToCachedFile(path)
+                 for path in ['/branch1/lib', '/branch2/lib', '/branch1/version', '/branch2/version']]
+        self.assertEqual(content, open(paths[1]).read())
+        self.assertEqual('/branch2', open(paths[3]).read())
+        self.assertEqual(os.lstat(paths[0]).st_ino, os.lstat(paths[1]).st_ino)
+        self.assertNotEqual(os.lstat(paths[2]).st_ino, os.lstat(paths[3]).st_ino)
+        self.assertEqual(1, self.sut.getStatistics()['disk_cache_dedup_hits'])
+        self.assertUsageConsistent()
+
+        self.sut.invalidate('/branch1')
+        self.sut.expire()
+        self.assertEqual(content, open(paths[1]).read())
+        self.assertUsageConsistent()
+
+        # source not changed, fetched again without reading it
+        self.assertEqual(content, open(self.sut.getPathToCachedFile('/branch1/lib')).read())
+        self.assertEqual(1, self.sut.getStatistics()['disk_cache_dedup_identity_hits'])
+
+        self.sut.invalidate('/')
+        self.sut.expire()
+        self.assertUsageConsistent()
+        self.assertEqual(0, self.sut._diskCache.usage.bytes)
+
+class Compression(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.compression = 'zlib'
+        self.cfg.cache_manager.compression_frame_size = 4096
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def test(self):
+        cfg = self.cfg.cache_manager
+        content = ''.join('int f%d() { return %d; }\n' % (i, i) for i in xrange(2000))
+        TestHelper.create_source_file(cfg, '/source.c', content)
+        self.sut.lookup('/source.c')
+        cached = self.sut.getPathToCachedFile('/source.c')
+        self.assertTrue(os.lstat(cached).st_size < len(content) // 2)
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(cfg.cache_root_dir)
+        self.assertEqual(scanned.get(), self.sut._diskCache.usage.get())
+
+        table = OpenFileTable(frameCache=FrameCache(2**20))
+        entry = table.acquire(cached, os.lstat(cfg.source_dir + '/source.c'))
+        try:
+            self.assertEqual(len(content), entry.stat.st_size)
+            self.assertEqual(content[5000:15000], entry.frames.read(10000, 5000))
+        finally:
+            table.release(entry)
+            table.discard(cached)
+
+        # source file which is compressed container itself comes back as it is
+        container = open(cached, 'rb').read()
+        TestHelper.create_source_file(cfg, '/container', container)
+        self.sut.lookup('/container')
+        cached = self.sut.getPathToCachedFile('/container')
+        entry = table.acquire(cached, os.lstat(cfg.source_dir + '/container'))
+        try:
+            self.assertEqual(container, entry.frames.read(len(container) + 1, 0))
+        finally:
+            table.release(entry)
+            table.discard(cached)
+
+        # names of source files never clash with how they are stored
+        TestHelper.create_source_file(cfg, '/source.c.cfz', 'plain')
+        self.sut.lookup('/source.c.cfz')
+        other = self.sut.getPathToCachedFile('/source.c.cfz')
+        entry = table.acquire(other, os.lstat(cfg.source_dir + '/source.c.cfz'))
+        try:
+            self.assertEqual('plain', entry.frames.read(100, 0))
+        finally:
+            table.release(entry)
+        self.assertEqual(path_factory.PathFactory(cfg).createPathToDiskCacheCompressed('/source.c'),
+                         self.sut.getPathToCachedFile('/source.c'))
+        limited = copy.copy(cfg)
+        limited.cache_max_bytes = 10**9
+        restarted = disk_cache.DiskCache(limited, cachefs_warm.NoMemoryCache())
+        self.assertEqual(['/container', '/source.c', '/source.c.cfz'], sorted(restarted._lru))
+        restarted.close()
+
+        # files compressed before stay readable when compression is turned off
+        self.sut._diskCache.close()
+        cfg.compression = None
+        diskCache = disk_cache.DiskCache(cfg, cachefs_warm.NoMemoryCache())
+        self.assertEqual(cached, diskCache.getPathToCachedFile('/container'))
+        diskCache.invalidate('/container')
+        self.assertFalse(os.path.lexists(cached))
+        self.assertEqual(container, open(diskCache.getPathToCachedFile('/container'), 'rb').read())
+        diskCache.close()
+
+class Warm(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.cache_max_bytes = 10**6
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager) # as mounted
+
+    def warm(self, paths, **kw):
+        cfg = copy.copy(self.cfg.cache_manager)
+        cfg.cache_max_bytes = 0
+        diskCache = disk_cache.DiskCache(cfg, cachefs_warm.NoMemoryCache())
+        warmer = cachefs_warm.Warmer(diskCache, cfg, workers=4, **kw)
+        try:
+            warmer.warm(paths)
+        finally:
+            diskCache.close()
+        return warmer
+
+    def test(self):
+        cfg = self.cfg.cache_manager
+        for dir_path in ['/src', '/src/lib', '/src/lib/deep', '/doc']:
+            TestHelper.create_source_dir(cfg, dir_path)
+            for idx in range(3):
+                TestHelper.create_source_file(cfg, '%s/file%d' % (dir_path, idx), 'x' * 1000)
+        os.symlink('file0', os.path.join(cfg.source_dir, 'src', 'link'))
+        self.assertTrue(self.sut.lookup('/src/file0').exists)
+        self.sut.getPathToCachedFile('/src/file0') # fetched by the mount
+
+        warmer = self.warm(['/src'], maxDepth=1)
+        self.assertEqual((2, 6, 1, 0), (warmer.directories, warmer.files, warmer.cached, warmer.errors))
+        pathFactory = path_factory.PathFactory(cfg)
+        self.assertTrue(os.path.islink(pathFactory.createPathToDiskCache('/src/link')))
+        self.assertEqual('x' * 1000, open(pathFactory.createPathToDiskCache('/src/lib/file2')).read())
+        self.assertFalse(os.path.exists(pathFactory.createPathToDiskCache('/src/lib/deep')))
+
+        # the mount counts files warmed behind its back on first access
+        usage = self.sut._diskCache.usage.bytes
+        self.sut.getPathToCachedFile('/src/lib/file1')
+        self.assertEqual(usage + 1000, self.sut._diskCache.usage.bytes)
+
+        warmer = self.warm(['/'], maxBytes=2500)
+        self.assertEqual(2, warmer.files)
+        self.assertTrue(warmer.skipped > 0)
+
+class MetadataIndex(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.metadata_index = True
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def cleanupWorkspaceImpl(self):
+        self.sut.close()
+        CacheManagerModuleTest.cleanupWorkspaceImpl(self)
+        index_path = path_factory.PathFactory(self.cfg.cache_manager).createPathToMetadataIndex()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.lexists(index_path + suffix):
+                os.remove(index_path + suffix)
+
+    def test(self):
+        dir_path = '/TestCacheManager.test_metadataIndex'
+        TestHelper.create_source_dir(self.cfg.cache_manager, dir_path)
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/file', 'x' * 100)
+        TestHelper.create_source_file(self.cfg.cache_manager, dir_path + '/other', 'y' * 10)
+
+        self.assertTrue(self.sut.lookup(dir_path + '/file').exists)
+        self.sut.getPathToCachedFile(dir_path + '/file')
+        stats = self.sut.getStatistics()
+        self.assertEqual(1, stats['disk_cache_populated_files'])
+        self.assertEqual(100, stats['disk_cache_populated_bytes'])
+        self.assertEqual(1, stats['disk_cache_unfetched_files'])
+
+        # index of existing cache is rebuilt from its content
+        self.sut.close()
+        os.remove(path_factory.PathFactory(self.cfg.cache_manager).createPathToMetadataIndex())
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+        rebuilt = self.sut.getStatistics()
+        for key in stats:
+            if key.startswith('disk_cache_') and not key.startswith('disk_cache_fill_'):
+                self.assertEqual(stats[key], rebuilt[key], msg=key)
+
+        self.sut.invalidate(dir_path)
+        self.assertEqual(0, self.sut.getStatistics()['disk_cache_populated_files'])
+
+    def test_eviction(self):
+        cfg = self.cfg.cache_manager
+        cfg.cache_max_bytes = 10**6
+        self.sut.close()
+        self.sut = cachefs.CacheManager(cfg)
+        for name in ['old', 'new']:
+            TestHelper.create_source_file(cfg, '/' + name, name * 1000)
+        # fetched by another process sharing the cache, e.g. cachefs-warm
+        other = disk_cache.DiskCache(cfg, cachefs_warm.NoMemoryCache())
+        old = other.getPathToCachedFile('/old')
+        other.close()
+        self.sut.lookup('/new')
+        new = self.sut.getPathToCachedFile('/new')
+
+        diskCache = self.sut._diskCache
+        self.assertEqual(2, diskCache.evict(0))
+        self.assertFalse(os.path.lexists(old))
+        self.assertFalse(os.path.lexists(new))
+        self.assertEqual(0, self.sut.getStatistics()['disk_cache_populated_files'])
+        scanned = fs_stats.CacheUsage()
+        scanned.scan(cfg.cache_root_dir)
+        self.assertEqual(scanned.get(), diskCache.usage.get())
+
+class ChunkedFetch(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.fetch_policy = 'chunked'
+        self.cfg.cache_manager.block_size = 4096
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def test(self):
+        file_path = '/TestCacheManager.test_chunkedFetch.bin'
+        content = ''.join(chr(i % 251) for i in range(10 * 4096 + 10))
+        TestHelper.create_source_file(self.cfg.cache_manager, file_path, content)
+        self.sut.getAttributes(file_path)
+
+        cache_path = self.sut.getPathToCachedFile(file_path)
+        self.assertEqual(len(content), os.lstat(cache_path).st_size)
+        self.assertEqual('\0' * 4096, open(cache_path).read(4096))
+
+        self.assertTrue(self.sut.fetchRange(file_path, 5000, 10))
+        data = open(cache_path).read()
+        self.assertEqual(content[4096:8192], data[4096:8192])
+        self.assertEqual('\0' * 4096, data[:4096])
+
+        self.assertFalse(self.sut.fetchRange(file_path, 0, len(content)))
+        self.assertEqual(content, open(cache_path).read())
+        self.assertEqual(sorted([os.path.basename(file_path)]),
+                         sorted(self.sut.listDirectory('/')))
+
+    def test_names_of_source_files_never_clash(self):
+        content = 'x' * (3 * 4096)
+        for path in ['/file', '/file.blockmap']:
+            TestHelper.create_source_file(self.cfg.cache_manager, path, content)
+        self.sut.lookup('/file')
+        self.sut.getPathToCachedFile('/file')
+        self.assertTrue(self.sut.fetchRange('/file', 0, 10))
+
+        # cached copy of file.blockmap is not block map of file
+        self.sut.lookup('/file.blockmap')
+        cache_path = self.sut.getPathToCachedFile('/file.blockmap')
+        self.assertFalse(self.sut.fetchRange('/file.blockmap', 0, len(content)))
+        self.assertEqual(content, open(cache_path).read())
+        self.assertTrue(self.sut.fetchRange('/file', 4096, 10))
+        self.assertFalse(self.sut.fetchRange('/file', 0, len(content)))
+
+class ChunkedFetchDroppedWhileOpen(CacheManagerModuleTest):
+
+    def setUpImpl(self):
+        cachefs.memory_cache.time = time
+        self.cfg = TestHelper.get_cfg()
+        self.cfg.cache_manager.fetch_policy = 'chunked'
+        self.cfg.cache_manager.block_size = 4096
+        self.clock = DiskCacheRevalidation.Clock()
+        disk_cache.time = self.clock
+        self.sut = cachefs.CacheManager(self.cfg.cache_manager)
+
+    def tearDownImpl(self):
+        disk_cache.time = time
+
+    def test(self):
+        dir_path = '/TestCacheManager.test_chunkedFetchDroppedWhileOpen'
+        cfg = self.cfg.cache_manager
+        content = ''.join(chr(i % 251) for i in range(10 * 4096))
+        TestHelper.create_source_dir(cfg, dir_path)
+        TestHelper.create_source_dir(cfg, dir_path + '/sub')
+        for name in ['changed', 'sub/invalidated']:
+            TestHelper.create_source_file(cfg, dir_path + '/' + name, content)
+        diskCache = self.sut._diskCache
+
+        opened = {}
+        for name in ['changed', 'sub/invalidated']:
+            path = dir_path + '/' + name
+            self.assertTrue(self.sut.lookup(path).exists)
+            fd = os.open(self.sut.getPathToCachedFile(path, pin=True), os.O_RDONLY)
+            opened[name] = (path, fd, self.sut.getFileGeneration(path))
+            self.assertTrue(self.sut.fetchRange(path, 5000, 10, opened[name][2]))
+
+        path, fd, generation = opened['changed']
+        source_path = cfg.source_dir + path
+        os.utime(source_path, (1, 1))
+        self.clock.now += cfg.disk_cache_lifetime
+        diskCache.listDirectory(dir_path) # revalidates, changed file is dropped
+        self.assertNotEqual(generation, self.sut.getFileGeneration(path))
+
+        # what was fetched is still there, the rest is never served as holes
+        self.assertTrue(self.sut.fetchRange(path, 5000, 10, generation))
+        self.assertEqual(content[4096:8192], file_io.pread(fd, 4096, 4096))
+        try:
+            self.sut.fetchRange(path, 20000, 10, generation)
+            self.fail("Read past fetched range of dropped copy")
+        except IOError, e:
+            self.assertEqual(errno.ESTALE, e.errno)
+
+        # fresh copy for everyone else
+        fresh_path = self.sut.getPathToCachedFile(path)
+        self.assertTrue(self.sut.fetchRange(path, 20000, 10))
+        self.assertFalse(self.sut.fetchRange(path, 0, len(content)))
+        self.assertEqual(content, open(fresh_path).read())
+
+        path, fd, generation = opened['sub/invalidated']
+        self.sut.invalidate(dir_path + '/sub')
+        self.assertTrue(self.sut.fetchRange(path, 5000, 10, generation))
+        try:
+            self.sut.fetchRange(path, 20000, 10, generation)
+            self.fail("Read past fetched range of invalidated copy")
+        except IOError, e:
+            self.assertEqual(errno.ESTALE, e.errno)
+
+        for path, fd, generation in opened.values():
+            os.close(fd)
+            self.sut.unpin(path)
+        self.assertEqual({}, diskCache._retiredBlockMaps)
+
 class CachefsSystemTest(ModuleTestCase):
 
     def __init__(self, *args, **kw):
@@ -824,6 +1597,8 @@ class MemoryCacheExpiration(CacheFsWithMockedTimerTestCase):
             self.timeController._timeImpl().MultipleTimes().AndReturn(newTime)
             self.moxConfig.ReplayAll()
 
+        time.sleep(1.5) # let sweeper expire memory cache
+
         self._getstat("/dir/file")
 
         self.assertEqual([], TestHelper.fetch_all(self.source_memfs_inport))
@@ -846,14 +1621,15 @@ class DiscCacheExpiration(CacheFsWithMockedTimerTestCase):
         self._getstat("/dir/file")
         self.assertEqual([], TestHelper.fetch_all(self.source_memfs_inport))
 
-        # TODO
-        '''
         # move time forward to trigger time expiration
-        self.moxConfig.ResetAll()
-        newTime = self.initialTimeValue + self.cfg.cache_manager.disk_cache_lifetime + 1
-        self.timeController.time().MultipleTimes().AndReturn(newTime)
-        self.moxConfig.ReplayAll()
+        with locked(self.timeController):
+            self.moxConfig.UnsetStubs()
+            self.moxConfig.StubOutWithMock(self.timeController, "_timeImpl")
+            newTime = self.initialTimeValue + self.cfg.cache_manager.disk_cache_lifetime + 1
+            self.timeController._timeImpl().MultipleTimes().AndReturn(newTime)
+            self.moxConfig.ReplayAll()
+
+        time.sleep(1.5) # let sweeper expire memory cache
 
         self._getstat("/dir/file")
         self.assertNotEqual([], TestHelper.fetch_all(self.source_memfs_inport))
-        '''
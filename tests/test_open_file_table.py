@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from open_file_table import OpenFileTable
+from compressed_file import compressFile
+from path_factory import PathFactory
+
+class OpenFileTableUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.paths = []
+        for idx in range(3):
+            path = os.path.join(self.workdir, 'file%d' % idx)
+            open(path, 'w').write('content %d' % idx)
+            self.paths.append(path)
+        self.sut = OpenFileTable(2)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def acquire(self, idx, generation=0):
+        path = self.paths[idx]
+        return self.sut.acquire(path, os.lstat(path), generation)
+
+    def test_descriptor_is_shared(self):
+        first = self.acquire(0)
+        second = self.acquire(0)
+        self.assertTrue(first is second)
+        self.assertEqual(2, first.refs)
+        self.assertEqual(1, len(self.sut))
+        self.assertEqual(len('content 0'), first.stat.st_size)
+
+    def test_idle_descriptors_closed_lru(self):
+        entries = [self.acquire(0), self.acquire(1)]
+        for entry in entries:
+            self.sut.release(entry)
+        self.assertEqual(2, len(self.sut))
+
+        self.assertTrue(entries[1] is self.acquire(1))
+        self.acquire(2)
+        self.assertEqual(2, len(self.sut))
+        self.assertFalse(entries[0] is self.acquire(0))
+
+    def test_busy_descriptors_not_closed(self):
+        entries = [self.acquire(idx) for idx in range(3)]
+        self.assertEqual(3, len(self.sut))
+        for entry in entries:
+            self.sut.release(entry)
+        self.assertEqual(2, len(self.sut))
+
+    def test_new_generation_reopens(self):
+        old = self.acquire(0)
+        self.assertEqual(2, self.acquire(0).opens)
+        new = self.acquire(0, generation=1)
+        self.assertFalse(old is new)
+        self.assertEqual(1, new.opens) # kernel has to drop pages of old one
+        self.sut.release(old)
+        self.assertEqual(2, len(self.sut))
+        self.sut.release(old)
+        self.assertEqual(1, len(self.sut))
+        self.assertEqual('content 0', os.read(new.fd, 100))
+
+    def test_discard(self):
+        idle, busy = self.acquire(0), self.acquire(1)
+        self.sut.release(idle)
+        self.sut.discard(self.paths[0])
+        self.sut.discard(self.paths[1])
+        self.sut.discard(self.paths[2])
+        self.assertEqual(1, len(self.sut))
+        self.assertFalse(busy is self.acquire(1))
+        self.sut.release(busy)
+        self.assertEqual(1, len(self.sut))
+
+    def test_only_compressed_paths_decompressed(self):
+        compressed = os.path.join(self.workdir, PathFactory.COMPRESSED)
+        os.mkdir(compressed)
+        container = os.path.join(compressed, 'file0')
+        compressFile(self.paths[0], container, 'zlib', 4)
+        plain = os.path.join(self.workdir, 'container.cfz') # source file in CFZF format
+        shutil.copyfile(container, plain)
+
+        entry = self.sut.acquire(container, os.lstat(self.paths[0]))
+        self.assertEqual('content 0', entry.frames.read(100, 0))
+        entry = self.sut.acquire(plain, os.lstat(plain))
+        self.assertTrue(entry.frames is None)
+
+        corrupted = os.path.join(compressed, 'corrupted')
+        shutil.copyfile(self.paths[1], corrupted)
+        self.assertRaises(IOError, self.sut.acquire, corrupted, os.lstat(corrupted))
@@ -0,0 +1,49 @@
+import unittest
+
+from readahead import ReadaheadEngine
+
+class ReadaheadUnitTest(unittest.TestCase):
+
+    class CacheManagerStub(object):
+        def __init__(self):
+            self.fetched = []
+
+        def fetchRange(self, path, offset, size):
+            self.fetched.append((path, offset, size))
+
+    class FileStub(object):
+        def __init__(self):
+            self.lseek = 0
+            self.readahead_window = 0
+            self.readahead_end = 0
+
+    def setUp(self):
+        self.cacheManager = ReadaheadUnitTest.CacheManagerStub()
+        self.sut = ReadaheadEngine(self.cacheManager, 4, 16)
+        self.fh = ReadaheadUnitTest.FileStub()
+
+    def read(self, offset, size):
+        self.sut.onRead('/file', self.fh, offset, size)
+        self.fh.lseek = offset + size
+
+    def fetchAll(self):
+        self.sut.start()
+        self.sut.stop()
+        return sorted(self.cacheManager.fetched)
+
+    def test_window_grows_for_sequential_reads(self):
+        for offset in range(0, 40, 2):
+            self.read(offset, 2)
+        self.assertEqual(16, self.fh.readahead_window)
+        fetched = self.fetchAll()
+        self.assertEqual(('/file', 2, 4), fetched[0])
+        covered = sum(size for path, offset, size in fetched)
+        self.assertEqual(self.fh.readahead_end - 2, covered)
+
+    def test_random_read_resets_window(self):
+        self.read(0, 2)
+        self.read(2, 2)
+        self.assertNotEqual(0, self.fh.readahead_window)
+        self.read(100, 2)
+        self.assertEqual(0, self.fh.readahead_window)
+        self.assertEqual(0, self.fh.readahead_end)
@@ -0,0 +1,113 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from sync import KeyedLock, ProcessLocks, SingleFlight
+
+class KeyedLockUnitTest(unittest.TestCase):
+
+    def test_entriesDropped(self):
+        locks = KeyedLock()
+        with locks.locked('/a'):
+            with locks.locked('/b'):
+                self.assertEqual(2, len(locks))
+        self.assertEqual(0, len(locks))
+
+class ProcessLocksUnitTest(unittest.TestCase):
+
+    HOLD_TIME = 0.3
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'cache.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_excludesOtherProcess(self):
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                locks = ProcessLocks(self.path)
+                with locks.locked('/file'):
+                    os.write(writeFd, 'x')
+                    time.sleep(ProcessLocksUnitTest.HOLD_TIME)
+            finally:
+                os._exit(0)
+        os.read(readFd, 1) # child holds the lock
+        start = time.time()
+        locks = ProcessLocks(self.path)
+        with locks.locked('/file'):
+            waited = time.time() - start
+        with locks.locked('/other'):
+            pass
+        locks.close()
+        os.waitpid(pid, 0)
+        os.close(readFd)
+        os.close(writeFd)
+        self.assertTrue(waited >= ProcessLocksUnitTest.HOLD_TIME / 2)
+
+    def test_excludesThreads(self):
+        locks = ProcessLocks(self.path)
+        acquired = threading.Event()
+        def lock():
+            with locks.locked('/file'):
+                acquired.set()
+        with locks.locked('/file'):
+            thread = threading.Thread(target=lock)
+            thread.daemon = True
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+        locks.close()
+
+class SingleFlightUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.calls = []
+
+    def leader(self, error=None):
+        self.calls.append(None)
+        self.started.set()
+        self.proceed.wait()
+        if error:
+            raise error
+        return len(self.calls)
+
+    def runConcurrently(self, function, count):
+        results = []
+        def call():
+            try:
+                results.append(self.flights.do('/file', function))
+            except Exception, e:
+                results.append(e)
+        threads = [threading.Thread(target=call) for i in range(count)]
+        threads[0].start()
+        self.started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1) # followers wait for the leader
+        self.proceed.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_sharesExecution(self):
+        self.assertEqual([1] * 4, self.runConcurrently(self.leader, 4))
+        self.assertEqual(0, len(self.flights))
+        self.assertEqual(2, self.flights.do('/file', self.leader))
+
+    def test_errorPropagated(self):
+        error = IOError(5, 'Input/output error')
+        results = self.runConcurrently(lambda: self.leader(error), 4)
+        self.assertEqual([error] * 4, results)
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(0, len(self.flights))
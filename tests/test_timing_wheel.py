@@ -0,0 +1,33 @@
+import unittest
+
+from timing_wheel import TimingWheel
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def test_expires_in_order_of_deadlines(self):
+        wheel = TimingWheel(1, now=0, slots=4, levels=2)
+        wheel.schedule('a', 2.5)
+        wheel.schedule('b', 10)
+        wheel.schedule('c', 100) # beyond the last level
+        self.assertEqual(3, len(wheel))
+
+        self.assertEqual([], wheel.advance(2))
+        self.assertEqual(['a'], wheel.advance(3))
+        self.assertEqual([], wheel.advance(9.5))
+        self.assertEqual(['b'], wheel.advance(10))
+        self.assertEqual([], wheel.advance(99))
+        self.assertEqual(['c'], wheel.advance(100))
+        self.assertEqual(0, len(wheel))
+
+    def test_past_deadline_expires_on_next_tick(self):
+        wheel = TimingWheel(1, now=50)
+        wheel.schedule('a', 10)
+        self.assertEqual(['a'], wheel.advance(51))
+
+    def test_long_jump(self):
+        wheel = TimingWheel(1, now=0, slots=4, levels=2)
+        wheel.schedule('a', 5)
+        wheel.schedule('b', 10**6 + 5)
+        self.assertEqual(['a'], wheel.advance(10**6))
+        self.assertEqual(['b'], wheel.advance(10**6 + 5))
@@ -0,0 +1,109 @@
+import itertools
+
+
+class TimingWheel(object):
+    '''Hierarchical timing wheel. Items are scheduled for a deadline and
+    advance(now) hands back those whose deadline passed.
+
+    Level 0 has a slot per tick, every next level has a slot per whole
+    rotation of the level below. When the lower level wraps, the slot of
+    the upper level is cascaded down. Scheduling is O(1), every item is
+    moved at most once per level. Deadlines are rounded up to whole ticks,
+    so items may expire up to one tick late, never early. Number of slots
+    has to be power of two.'''
+
+    def __init__(self, tick, now, slots=64, levels=4):
+        assert slots & (slots - 1) == 0
+        self._tick = float(tick)
+        self._numOfSlots = slots
+        self._bits = slots.bit_length() - 1
+        self._levels = [[[] for slot in xrange(slots)] for level in xrange(levels)]
+        self._overflow = [] # beyond the last level
+        self._current = self._toTick(now)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def schedule(self, item, deadline):
+        tick = -int(-deadline // self._tick) # ceil
+        if tick <= self._current:
+            tick = self._current + 1
+        self._slot(tick).append((tick, item))
+        self._len += 1
+
+    def scheduleMany(self, items, deadline):
+        '''Schedules items with the same deadline at once'''
+        tick = -int(-deadline // self._tick)
+        if tick <= self._current:
+            tick = self._current + 1
+        self._slot(tick).extend(zip(itertools.repeat(tick, len(items)), items))
+        self._len += len(items)
+
+    def advance(self, now):
+        '''Returns list of items which expired up to now'''
+        expired = []
+        target = self._toTick(now)
+        if target - self._current >= self._numOfSlots ** len(self._levels):
+            # long jump (suspend, clock change), ticking one by one would take ages
+            return self._rebuild(target)
+
+        while self._current < target:
+            self._current += 1
+            self._cascade()
+            slot = self._levels[0][self._current % self._numOfSlots]
+            expired.extend(item for tick, item in slot)
+            del slot[:]
+        self._len -= len(expired)
+        return expired
+
+    def _toTick(self, now):
+        return int(now // self._tick)
+
+    def _slot(self, tick):
+        # level l takes deltas of (bits * l + 1) to bits * (l + 1) bits
+        level = (((tick - self._current) | 1).bit_length() - 1) // self._bits
+        if level < len(self._levels):
+            return self._levels[level][(tick >> (self._bits * level)) & (self._numOfSlots - 1)]
+        return self._overflow
+
+    def _place(self, tick, item):
+        self._slot(tick).append((tick, item))
+
+    def _cascade(self):
+        '''Moves items of upper levels whose rotation just started down,
+        top level first, so that they can still fall to a lower slot due now'''
+        due = []
+        span = self._numOfSlots
+        for level in xrange(1, len(self._levels) + 1):
+            if self._current % span:
+                break
+            due.append((level, span))
+            span *= self._numOfSlots
+
+        for level, span in reversed(due):
+            if level == len(self._levels):
+                items, self._overflow = self._overflow, []
+            else:
+                slot = self._levels[level][(self._current // span) % self._numOfSlots]
+                items, slot[:] = slot[:], []
+            for tick, item in items:
+                self._place(tick, item)
+
+    def _rebuild(self, target):
+        items = self._overflow
+        self._overflow = []
+        for slots in self._levels:
+            for slot in slots:
+                items.extend(slot)
+                del slot[:]
+
+        self._current = target
+        expired = []
+        for tick, item in items:
+            if tick <= target:
+                expired.append(item)
+            else:
+                self._place(tick, item)
+        self._len -= len(expired)
+        return expired